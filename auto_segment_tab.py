@@ -1,9 +1,19 @@
+import os
+import re
+
 from PySide6 import QtCore, QtWidgets
 from PySide6.QtGui import QTextCursor
+from PySide6.QtWidgets import QFileDialog
 
+from auto_segmentation import PREVIEW_TASKS, ROI_SUBSET_TASKS, task_structures
 from auto_segmentation_controller import AutoSegmentationController
+from resource_profile import available_cpus
+from segmentation_job_queue import SegmentationJob
 from StyleSheetReader import StyleSheetReader
 
+# Lines kept in the progress text, older lines are dropped
+MAX_CONSOLE_LINES = 2000
+
 
 class AutoSegmentationTab(QtWidgets.QWidget):
     """
@@ -29,12 +39,21 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         self._auto_segmentation_layout: QtWidgets.QFormLayout = QtWidgets.QFormLayout()  # Declaring the layout of the User interface
         self._make_segmentation_task_selection()  # Adding Segmentation Task Combo Box
         self._make_fast_checkbox()  # Adding Fast Option Checkbox
+        self._make_preview_checkbox()  # Adding Preview Then Refine Option Checkbox
+        self._make_structure_picker()  # Adding Searchable Structure Subset Selection
+        self._make_result_cache_checkbox()  # Adding Result Cache Option Checkbox
+        self._make_resource_controls()  # Adding CPU Thread and Pinning Options
+        self._make_queue_controls()  # Adding Priority and Concurrent Job Options
         self._make_progress_bar()  # Adding a progress bar
+        self._make_job_table()  # Adding the Job Queue Table
         self._make_progress_text()  # Adding Progress Text
         self._make_start_button(self._start_button_clicked)  # Adding Start Button Button
+        self._make_stop_button(self._stop_button_clicked)  # Adding Stop Study Button
+        self._make_cancel_job_button(self._cancel_job_button_clicked)  # Adding Cancel Selected Job Button
+        self._make_add_study_button(self._add_study_button_clicked)  # Adding Queue Another Study Button
         self.dicom_dir = dicom_dir
         self.setLayout(self._auto_segmentation_layout)  # Setting the layout to the Main Window
-        self._start_button_enabled = True
+        self.set_stop_button_status(False)
 
         # Create Controller Class if one does not already exist
         # or Change view to new instance of view
@@ -47,6 +66,11 @@ class AutoSegmentationTab(QtWidgets.QWidget):
 
         # Check task setting against fast mode - set check box false if not compatible
         self._task_combo.currentIndexChanged.connect(self._check_task_is_fast_compatible)
+        # List the structures of the selected task in the structure picker
+        self._task_combo.currentIndexChanged.connect(self._populate_structure_picker)
+        self._populate_structure_picker()
+        self._task_combo.currentIndexChanged.connect(self._check_preview_is_available)
+        self._check_preview_is_available()
 
     def _make_segmentation_task_selection(self) -> None:
         """
@@ -89,6 +113,215 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         self._fast_checkbox.setStyleSheet(self.style_sheet())
         self._auto_segmentation_layout.addWidget(self._fast_checkbox)
 
+    def _make_preview_checkbox(self) -> None:
+        """
+        Protected method to create the checkbox to show a fast, low
+        resolution preview before the full resolution segmentation.
+        :rtype: None
+        """
+        self._preview_checkbox: QtWidgets.QCheckBox = QtWidgets.QCheckBox("Preview, Then Refine")
+        self._preview_checkbox.setChecked(True)
+        self._preview_checkbox.setToolTip("When Activated a low resolution segmentation is run first and shown \n"
+                                          "in the viewer, then replaced structure by structure by the full \n"
+                                          "resolution segmentation once it finishes.\n"
+                                          "Only available for full resolution runs of the total tasks.")
+        self._preview_checkbox.setStyleSheet(self.style_sheet())
+        self._fast_checkbox.toggled.connect(self._check_preview_is_available)
+        self._auto_segmentation_layout.addWidget(self._preview_checkbox)
+
+    def _check_preview_is_available(self, *_) -> None:
+        """
+        Protected method to only enable the preview option for
+        full resolution runs of tasks with a fastest mode.
+        :rtype: None
+        """
+        self._preview_checkbox.setEnabled(self._task_combo.currentText() in PREVIEW_TASKS
+                                          and not self._fast_checkbox.isChecked())
+
+    def _make_structure_picker(self) -> None:
+        """
+        Protected method to create the search box and checkable list
+        for restricting the task to a subset of its structures.
+        :rtype: None
+        """
+        _structures_label: QtWidgets.QLabel = QtWidgets.QLabel("Structures (none checked segments all):")
+        _structures_label.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(_structures_label)
+
+        self._structure_search: QtWidgets.QLineEdit = QtWidgets.QLineEdit()
+        self._structure_search.setPlaceholderText("Search structures...")
+        self._structure_search.setClearButtonEnabled(True)
+        self._structure_search.setStyleSheet(self.style_sheet())
+        self._structure_search.textChanged.connect(self._filter_structure_picker)
+        self._auto_segmentation_layout.addWidget(self._structure_search)
+
+        self._structure_list: QtWidgets.QListWidget = QtWidgets.QListWidget()
+        self._structure_list.setMaximumHeight(160)
+        self._structure_list.setStyleSheet(self.style_sheet())
+        self._structure_list.itemChanged.connect(self._update_structure_selection_text)
+        self._auto_segmentation_layout.addWidget(self._structure_list)
+
+        self._clear_structures_button: QtWidgets.QPushButton = QtWidgets.QPushButton("Segment All Structures")
+        self._clear_structures_button.setToolTip("Clear the selected structures, the whole task is segmented")
+        self._clear_structures_button.setStyleSheet(self.style_sheet())
+        self._clear_structures_button.clicked.connect(self._clear_structure_selection)
+        self._auto_segmentation_layout.addWidget(self._clear_structures_button)
+
+    def _populate_structure_picker(self) -> None:
+        """
+        Protected method to list the structures of the selected task in the
+        structure picker. Tasks which cannot be restricted disable the picker.
+        :rtype: None
+        """
+        task = self._task_combo.currentText()
+        structures = task_structures(task) if task in ROI_SUBSET_TASKS else []
+
+        self._structure_list.blockSignals(True)
+        self._structure_list.clear()
+        for name in structures:
+            item = QtWidgets.QListWidgetItem(name)
+            item.setFlags(item.flags() | QtCore.Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.CheckState.Unchecked)
+            self._structure_list.addItem(item)
+        self._structure_list.blockSignals(False)
+
+        enabled = bool(structures)
+        for widget in (self._structure_search, self._structure_list, self._clear_structures_button):
+            widget.setEnabled(enabled)
+        self._structure_list.setToolTip(
+            "Check the structures to segment, only those are computed and converted.\n"
+            "Leave all unchecked to segment every structure of the task." if enabled else
+            f"The {task} task always segments all of its structures."
+        )
+        self._filter_structure_picker(self._structure_search.text())
+        self._update_structure_selection_text()
+
+    def _filter_structure_picker(self, text: str) -> None:
+        """
+        Protected method to show only the structures whose name contains the search text.
+        Checked structures stay visible.
+        :param text: str
+        :rtype: None
+        """
+        needle = text.strip().lower().replace(" ", "_")
+        for row in range(self._structure_list.count()):
+            item = self._structure_list.item(row)
+            checked = item.checkState() == QtCore.Qt.CheckState.Checked
+            item.setHidden(bool(needle) and needle not in item.text().lower() and not checked)
+
+    def _clear_structure_selection(self) -> None:
+        """
+        Protected method to uncheck every structure, selecting the whole task.
+        :rtype: None
+        """
+        self._structure_list.blockSignals(True)
+        for row in range(self._structure_list.count()):
+            self._structure_list.item(row).setCheckState(QtCore.Qt.CheckState.Unchecked)
+        self._structure_list.blockSignals(False)
+        self._filter_structure_picker(self._structure_search.text())
+        self._update_structure_selection_text()
+
+    def _update_structure_selection_text(self, *_) -> None:
+        """
+        Protected method to show how many structures are selected on the clear button.
+        :rtype: None
+        """
+        count = len(self.get_roi_subset() or [])
+        self._clear_structures_button.setText(f"Segment All Structures ({count} selected)" if count
+                                              else "Segment All Structures")
+
+    def _make_result_cache_checkbox(self) -> None:
+        """
+        Protected method to create the checkbox for restoring earlier
+        results of the same task on an unchanged study.
+        :rtype: None
+        """
+        self._result_cache_checkbox: QtWidgets.QCheckBox = QtWidgets.QCheckBox("Use Result Cache")
+        self._result_cache_checkbox.setChecked(True)
+        self._result_cache_checkbox.setToolTip("Restore the segmentation of an earlier run of the same task\n"
+                                               "on the same series instead of running it again.")
+        self._result_cache_checkbox.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(self._result_cache_checkbox)
+
+    def _make_resource_controls(self) -> None:
+        """
+        Protected method to create the CPU thread count spin box and
+        the checkbox to pin the segmentation run to CPU cores.
+        :rtype: None
+        """
+        _threads_label: QtWidgets.QLabel = QtWidgets.QLabel("CPU Threads:")
+        _threads_label.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(_threads_label)
+
+        cpu_count = len(available_cpus())
+        self._threads_spinbox: QtWidgets.QSpinBox = QtWidgets.QSpinBox()
+        self._threads_spinbox.setRange(1, cpu_count)
+        self._threads_spinbox.setValue(cpu_count)
+        self._threads_spinbox.setToolTip("Number of CPU threads the segmentation may use.\n"
+                                         "Preprocessing and saving threads are derived from this value.\n"
+                                         "Lower it to leave cores free for other work.")
+        self._threads_spinbox.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(self._threads_spinbox)
+
+        self._pin_cpus_checkbox: QtWidgets.QCheckBox = QtWidgets.QCheckBox("Pin to CPU Cores")
+        self._pin_cpus_checkbox.setToolTip("When Activated the segmentation only runs on as many CPU cores \n"
+                                           "as it has threads, so concurrent runs do not slow each other down.")
+        self._pin_cpus_checkbox.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(self._pin_cpus_checkbox)
+
+    def _make_queue_controls(self) -> None:
+        """
+        Protected method to create the spin boxes for the priority of
+        the next queued job and the number of jobs running at once.
+        :rtype: None
+        """
+        _priority_label: QtWidgets.QLabel = QtWidgets.QLabel("Priority:")
+        _priority_label.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(_priority_label)
+
+        self._priority_spinbox: QtWidgets.QSpinBox = QtWidgets.QSpinBox()
+        self._priority_spinbox.setRange(0, 10)
+        self._priority_spinbox.setToolTip("Priority of the queued task.\n"
+                                          "Tasks with a higher priority start before tasks with a lower one.")
+        self._priority_spinbox.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(self._priority_spinbox)
+
+        _concurrent_label: QtWidgets.QLabel = QtWidgets.QLabel("Concurrent Jobs:")
+        _concurrent_label.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(_concurrent_label)
+
+        self._concurrent_spinbox: QtWidgets.QSpinBox = QtWidgets.QSpinBox()
+        self._concurrent_spinbox.setRange(1, max(1, len(available_cpus())))
+        self._concurrent_spinbox.setValue(1)
+        self._concurrent_spinbox.setToolTip("Number of queued tasks which may run at the same time.\n"
+                                            "The CPU threads are shared out between the running tasks.")
+        self._concurrent_spinbox.setStyleSheet(self.style_sheet())
+        self._concurrent_spinbox.valueChanged.connect(self._concurrent_jobs_changed)
+        self._auto_segmentation_layout.addWidget(self._concurrent_spinbox)
+
+    def _make_job_table(self) -> None:
+        """
+        Protected method to create the table listing the queued,
+        running and completed segmentation jobs.
+        :rtype: None
+        """
+        _jobs_label: QtWidgets.QLabel = QtWidgets.QLabel("Jobs:")
+        _jobs_label.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(_jobs_label)
+
+        self._job_table: QtWidgets.QTableWidget = QtWidgets.QTableWidget(0, 5)
+        self._job_table.setHorizontalHeaderLabels(["Study", "Task", "Priority", "Status", "Progress"])
+        self._job_table.horizontalHeader().setStretchLastSection(True)
+        self._job_table.verticalHeader().setVisible(False)
+        self._job_table.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.NoEditTriggers)
+        self._job_table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectionBehavior.SelectRows)
+        self._job_table.setToolTip("Segmentation tasks which are queued, running or completed")
+        self._job_table.setStyleSheet(self.style_sheet())
+        self._auto_segmentation_layout.addWidget(self._job_table)
+
+        # Row of each job in the table
+        self._job_rows: dict[int, int] = {}
+
     def _make_progress_bar(self) -> None:
         """
         Protected method to create the progress bar label and progress bar.
@@ -100,7 +333,7 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         _progress_bar_label.setStyleSheet(self.style_sheet())
         self._auto_segmentation_layout.addWidget(_progress_bar_label)
 
-        self._progress_bar: QtWidgets.QProgressBar = QtWidgets.QProgressBar(minimum=0, maximum=100, value=20)
+        self._progress_bar: QtWidgets.QProgressBar = QtWidgets.QProgressBar(minimum=0, maximum=100, value=0)
         self._progress_bar.setToolTip("The progress of the task currently being processed.")
         self._progress_bar.setStyleSheet(self.style_sheet())
         self._auto_segmentation_layout.addWidget(self._progress_bar)
@@ -116,8 +349,11 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         self._auto_segmentation_layout.addWidget(_progress_text_label)
 
         self._progress_text = QtWidgets.QTextEdit()
+        self._progress_text.document().setMaximumBlockCount(MAX_CONSOLE_LINES)
         self._progress_text.setText("Waiting...")
         self._progress_text.setReadOnly(True)
+        # Set when console output ended with a carriage return, the next text replaces the line
+        self._console_line_returned = False
         self._progress_text.setToolTip("What task the auto-segmentator is currently performing")
         self._progress_text.setStyleSheet(self.style_sheet())
         self._auto_segmentation_layout.addWidget(self._progress_text)
@@ -137,13 +373,95 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         self._start_button.clicked.connect(button_action)
         self._auto_segmentation_layout.addWidget(self._start_button)
 
+    def _make_stop_button(self, button_action: ()) -> None:
+        """
+        Protected Method to create the button which stops
+        every queued or running job of the study.
+        :param button_action: function
+        :rtype: None
+        """
+        self._stop_button: QtWidgets.QPushButton = QtWidgets.QPushButton("Stop")
+        self._stop_button.setObjectName("stop_button")
+        self._stop_button.setStyleSheet(self.style_sheet())
+        self._stop_button.clicked.connect(button_action)
+        self._auto_segmentation_layout.addWidget(self._stop_button)
+
+    def _make_cancel_job_button(self, button_action: ()) -> None:
+        """
+        Protected Method to create the button which cancels
+        the jobs selected in the job table.
+        :param button_action: function
+        :rtype: None
+        """
+        self._cancel_job_button: QtWidgets.QPushButton = QtWidgets.QPushButton("Cancel Selected Job")
+        self._cancel_job_button.setStyleSheet(self.style_sheet())
+        self._cancel_job_button.clicked.connect(button_action)
+        self._auto_segmentation_layout.addWidget(self._cancel_job_button)
+
+    def _make_add_study_button(self, button_action: ()) -> None:
+        """
+        Protected Method to create the button which queues the
+        selected task for another DICOM study.
+        :param button_action: function
+        :rtype: None
+        """
+        self._add_study_button: QtWidgets.QPushButton = QtWidgets.QPushButton("Queue Another Study...")
+        self._add_study_button.setStyleSheet(self.style_sheet())
+        self._add_study_button.clicked.connect(button_action)
+        self._auto_segmentation_layout.addWidget(self._add_study_button)
+
+    def _add_study_button_clicked(self) -> None:
+        """
+        Protected method to be called when the queue another study button is clicked.
+        :rtype: None
+        """
+        dicom_dir = QFileDialog.getExistingDirectory(self, "Select DICOM CT Series")
+        if not dicom_dir:
+            return
+        self._controller.start_button_clicked(dicom_dir)
+
+    def _concurrent_jobs_changed(self, value: int) -> None:
+        """
+        Protected method to be called when the number of concurrent jobs is changed.
+        Shares the CPU threads out between the concurrent jobs.
+        :param value: int
+        :rtype: None
+        """
+        self._threads_spinbox.setValue(max(1, len(available_cpus()) // value))
+        self._controller.set_max_concurrent_jobs(value)
+
+    def warm_up(self) -> None:
+        """
+        Load the segmentation models' dependencies in the background, ahead of the first run
+        :rtype: None
+        """
+        self._controller.warm_up()
+
     def _start_button_clicked(self) -> None:
         """
         Protected method to be called when the start button is clicked.
+        Queues the selected task, also while other jobs of the study are queued or running.
         :rtype: None
         """
         self._controller.start_button_clicked(self.dicom_dir)
 
+    def _stop_button_clicked(self) -> None:
+        """
+        Protected method to be called when the stop button is clicked.
+        :rtype: None
+        """
+        self._controller.stop_button_clicked(self.dicom_dir)
+
+    def _cancel_job_button_clicked(self) -> None:
+        """
+        Protected method to be called when the cancel selected job button is clicked.
+        :rtype: None
+        """
+        selected_rows = {index.row() for index in self._job_table.selectionModel().selectedRows()}
+        for job_id, row in self._job_rows.items():
+            if row in selected_rows:
+                self._controller.cancel_job(job_id)
+
     def get_segmentation_task(self) -> str:
         """
         Public Method to retrieve the current selection
@@ -160,6 +478,105 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         """
         return self._fast_checkbox.isChecked()
 
+    def get_preview_value(self) -> bool:
+        """
+        Public Method to retrieve whether a preview is shown before the full resolution run.
+        :rtype: bool
+        """
+        return self._preview_checkbox.isEnabled() and self._preview_checkbox.isChecked()
+
+    def set_viewer(self, viewer) -> None:
+        """
+        Public Method to show the structures segmented for the study in the viewer.
+        :param viewer: DicomViewer
+        :rtype: None
+        """
+        self._controller.set_viewer(viewer)
+
+    def get_roi_subset(self) -> list[str] | None:
+        """
+        Public Method to retrieve the structures checked in the structure picker.
+        :return: list of structure names, None to segment every structure of the task
+        :rtype: list[str] | None
+        """
+        checked = [
+            self._structure_list.item(row).text() for row in range(self._structure_list.count())
+            if self._structure_list.item(row).checkState() == QtCore.Qt.CheckState.Checked
+        ]
+        return checked or None
+
+    def get_thread_count(self) -> int:
+        """
+        Public Method to retrieve the number of CPU threads
+        selected for the segmentation run.
+        :rtype: int
+        """
+        return self._threads_spinbox.value()
+
+    def get_pin_cpus(self) -> bool:
+        """
+        Public Method to retrieve the value of the CPU pinning checkbox.
+        :rtype: bool
+        """
+        return self._pin_cpus_checkbox.isChecked()
+
+    def get_use_result_cache(self) -> bool:
+        """
+        Public Method to retrieve whether results may be restored from the result cache.
+        :rtype: bool
+        """
+        return self._result_cache_checkbox.isChecked()
+
+    def get_priority(self) -> int:
+        """
+        Public Method to retrieve the priority for the next queued task.
+        :rtype: int
+        """
+        return self._priority_spinbox.value()
+
+    def add_job(self, job: SegmentationJob) -> None:
+        """
+        Public Method to add a row for a newly queued job to the job table.
+        :param job: SegmentationJob
+        :rtype: None
+        """
+        row = self._job_table.rowCount()
+        self._job_table.insertRow(row)
+        self._job_rows[job.job_id] = row
+
+        progress_bar = QtWidgets.QProgressBar(minimum=0, maximum=100, value=0)
+        self._job_table.setCellWidget(row, 4, progress_bar)
+        self.update_job(job)
+
+    def update_job(self, job: SegmentationJob) -> None:
+        """
+        Public Method to refresh the status and progress of a job in the job table.
+        :param job: SegmentationJob
+        :rtype: None
+        """
+        row = self._job_rows.get(job.job_id)
+        if row is None:
+            return
+
+        study_item = QtWidgets.QTableWidgetItem(os.path.basename(os.path.normpath(job.dicom_dir)))
+        study_item.setToolTip(job.dicom_dir)
+        task_text = f"{job.task} (fast)" if job.fast else job.task
+        if job.roi_subset:
+            task_text += f" [{len(job.roi_subset)} structures]"
+        task_item = QtWidgets.QTableWidgetItem(task_text)
+        if job.roi_subset:
+            task_item.setToolTip(", ".join(job.roi_subset))
+        status_item = QtWidgets.QTableWidgetItem(job.status)
+        status_item.setToolTip(job.message)
+
+        self._job_table.setItem(row, 0, study_item)
+        self._job_table.setItem(row, 1, task_item)
+        self._job_table.setItem(row, 2, QtWidgets.QTableWidgetItem(str(job.priority)))
+        self._job_table.setItem(row, 3, status_item)
+        self._job_table.cellWidget(row, 4).setValue(job.progress)
+
+        self.set_stop_button_status(self._controller.has_active_job(self.dicom_dir))
+
     def set_progress_bar_value(self, value: int) -> None:
         """
         Public Method to set the progress bar value.
@@ -169,6 +586,15 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         """
         self._progress_bar.setValue(value)
 
+    def set_progress_bar_format(self, text: str) -> None:
+        """
+        Public Method to set the text shown on the progress bar,
+        %p is replaced with the percentage.
+        :param text: str
+        :rtype: None
+        """
+        self._progress_bar.setFormat(text)
+
     def set_progress_text(self, text: str) -> None:
         """
         Public Method to set the progress text in the progress text box.
@@ -177,23 +603,57 @@ class AutoSegmentationTab(QtWidgets.QWidget):
         :param text: str
         :rtype: None
         """
-        self._progress_text.append(text)
         cursor = self._progress_text.textCursor()
         cursor.movePosition(QTextCursor.MoveOperation.End)
-        self._progress_text.setTextCursor(cursor)
-        self._progress_text.ensureCursorVisible()
+        if cursor.block().length() > 1:
+            cursor.insertBlock()
+        cursor.insertText(text)
+        cursor.insertBlock()
+        self._console_line_returned = False
+        self._show_end_of_progress_text(cursor)
 
-    def set_start_button_status(self):
+    def append_console_output(self, text: str) -> None:
+        """
+        Public Method to add raw console output to the progress text box.
+        A carriage return moves back to the start of the line, so progress
+        bars redrawn with carriage returns are updated in place.
+        :param text: str
+        :rtype: None
+        """
+        cursor = self._progress_text.textCursor()
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        for piece in re.split(r"(\r\n|\r|\n)", text):
+            if piece in ("\n", "\r\n"):
+                cursor.insertBlock()
+                self._console_line_returned = False
+            elif piece == "\r":
+                self._console_line_returned = True
+            elif piece:
+                if self._console_line_returned:
+                    cursor.movePosition(QTextCursor.MoveOperation.StartOfBlock)
+                    cursor.movePosition(QTextCursor.MoveOperation.EndOfBlock, QTextCursor.MoveMode.KeepAnchor)
+                    cursor.removeSelectedText()
+                    self._console_line_returned = False
+                cursor.insertText(piece)
+        self._show_end_of_progress_text(cursor)
 
-        self._start_button_enabled = not self._start_button_enabled
+    def _show_end_of_progress_text(self, cursor: QTextCursor) -> None:
+        """
+        Protected method to move the progress text box to its last line.
+        :param cursor: QTextCursor at the end of the text
+        :rtype: None
+        """
+        self._progress_text.setTextCursor(cursor)
+        self._progress_text.ensureCursorVisible()
 
-        if self._start_button_enabled:
-            self._start_button.setEnabled(self._start_button_enabled)
-            self._start_button.setText("Start")
-        else:
-            #TODO: Set this to stop to end thread?
-            self._start_button.setEnabled(self._start_button_enabled)
-            self._start_button.setText("Wait")
+    def set_stop_button_status(self, job_active: bool) -> None:
+        """
+        Public Method to enable the stop button while
+        jobs of the study are queued or running.
+        :param job_active: bool, whether a job of the study is queued or running
+        :rtype: None
+        """
+        self._stop_button.setEnabled(job_active)
 
 
     def _check_task_is_fast_compatible(self):
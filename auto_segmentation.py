@@ -1,102 +1,734 @@
 import os
 import logging
+import contextlib
 import shutil
-import tempfile
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from multithread import SegmentationWorkerSignals
-
-from redirect_stdout import ConsoleOutputStream, redirect_output_to_gui, setup_logging
+from cancellation import CancellationToken, SegmentationCancelled
+from headless_signals import HeadlessWorkerSignals
+from inference_session import apply_resource_profile, install_predictor_cache
 from ignore_files_in_dir import ignore_func
-from totalsegmentator.python_api import totalsegmentator
-from nifti_converter import nifti_to_rtstruct_conversion
+from instrumentation import Recorder, profiled, span, trace_dir
+from progress_events import InferenceOutputParser, ProgressTracker, watch_thread_output
+from result_cache import detach_hardlinks
+from scratch_space import ScratchSpaceError, default_scratch_manager
+from segmentation_manifest import manifest_path_for, record_settings, run_settings
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# How a run's segmentations reach the converter and the segmentations directory:
+# "files": TotalSegmentator writes a NIfTI file per structure, the converter reads them back
+# "background": the converter takes TotalSegmentator's label map from memory, the NIfTI files
+#               are written alongside the conversion
+# "skip": the converter takes the label map from memory, no NIfTI files are written
+NIFTI_OUTPUT_MODES = ("files", "background", "skip")
+
+# Tasks TotalSegmentator can restrict to a subset of their structures (roi_subset)
+ROI_SUBSET_TASKS = ("total", "total_mr")
+
+# Tasks with a fastest mode, which can show a preview ahead of the full resolution run
+PREVIEW_TASKS = ("total", "total_mr")
+
+
+def task_structures(task) -> list[str]:
+    """
+    Returns the sorted names of the structures a TotalSegmentator task segments,
+    empty if TotalSegmentator is not installed or does not know the task.
+    """
+    try:
+        # Only holds the label tables, imported without torch
+        from totalsegmentator.map_to_binary import class_map
+    except ImportError:
+        return []
+    return sorted(class_map.get(task, {}).values())
+
 
 class AutoSegmentation:
     """Handles the automatic segmentation process.
 
     This class manages the workflow for running TotalSegmentator, including
     copying DICOM files, setting up the segmentation task, and converting the
-    output to DICOM RTSTRUCT format.
+    output to DICOM RTSTRUCT format. Without a controller it runs headless,
+    reporting through plain callbacks on self.signals.
     """
 
-    def __init__(self, controller):
+    def __init__(self, controller=None, session=None, resource_profile=None, signals=None, cancel_token=None,
+                 result_cache=None, progress_log=None, recorder=None, nifti_output="background", scratch=None):
+        if nifti_output not in NIFTI_OUTPUT_MODES:
+            raise ValueError(f"Unknown NIfTI output mode {nifti_output}, expected one of {NIFTI_OUTPUT_MODES}")
         self.controller = controller
-        self.temp_dir = tempfile.mkdtemp()
+        self.session = session
+        self.resource_profile = resource_profile
+        self.cancel_token = cancel_token if cancel_token is not None else CancellationToken()
+        self.result_cache = result_cache
+        self.progress_log = progress_log
+        self.recorder = recorder if recorder is not None else Recorder()
+        self._trace_prefix = None
+
+        # Scratch directory holding the staged copy of the study and the Nifti
+        # segmentations of the run until they are complete, allocated by the staging step
+        self.scratch = scratch
+        self._scratch_dir = None
+        self.temp_dir = None
+        self._staged_output_dir = None
+
+        # Tracker of the step in progress
+        self._tracker = None
+
+        # Cache key of the current study's result, set by the inference step
+        self._cache_key = None
+        self._series_uid = None
+        self._roi_subset = None
+        # TotalSegmentator settings of the segmentations, recorded in the manifest after the conversion
+        self._settings = None
+        # Nifti files in the segmentation directory before the inference step, see _discard_outputs
+        self._existing_outputs = None
+
+        # Label map of the inference step, waiting for the conversion step, and
+        # the background writing of its NIfTI files
+        self.nifti_output = nifti_output
+        self._label_volume = None
+        self._nifti_writer = None
+        self._preview_shown = False
+
+        # Signals already connected by the caller, e.g. for a queued job
+        if signals is not None:
+            self.signals = signals
+            return
+
+        # No Qt module is imported by a headless workflow
+        if controller is None:
+            self.signals = HeadlessWorkerSignals()
+            return
+
+        # Qt is only needed when reporting to the GUI controller
+        from multithread import SegmentationWorkerSignals
         self.signals = SegmentationWorkerSignals()
 
         # Connect worker signals to controller slots
         self.signals.progress_updated.connect(self.controller.update_progress_text)
+        self.signals.progress.connect(self.controller.on_progress_event)
         self.signals.finished.connect(self.controller.on_segmentation_finished)
         self.signals.error.connect(self.controller.on_segmentation_error)
+        self.signals.cancelled.connect(self.controller.on_segmentation_cancelled)
+        self.signals.structures_ready.connect(self.controller.on_structures_ready)
 
-    def _create_copied_temporary_directory(self, dicom_dir):
+    def _create_copied_temporary_directory(self, dicom_dir) -> bool:
         if not dicom_dir:
             self.signals.error.emit('No dicom directory found')
-            return
+            return False
 
         try:
-            shutil.copytree(dicom_dir, self.temp_dir, ignore=ignore_func, dirs_exist_ok=True)
-        except Exception as e:
+            files, size = self._measure_files_to_stage(dicom_dir)
+            self._allocate_scratch(size, dicom_dir)
+            self._start_tracker("staging", files, "files", dicom_dir)
+            with self._span("staging", files=files):
+                shutil.copytree(dicom_dir, self.temp_dir, ignore=ignore_func, dirs_exist_ok=True,
+                                copy_function=self._copy_unless_cancelled)
+            self._tracker.finish()
+        except SegmentationCancelled:
+            self._on_cancelled()
+            return False
+        except ScratchSpaceError as e:
+            logger.error(str(e))
+            self.signals.error.emit("Not enough scratch space to copy the DICOM files.")
+            return False
+        except Exception:
             logger.exception("Failed to copy DICOM files.")
             self.signals.error.emit("Failed to copy DICOM files.")
+            return False
+        return True
+
+    def _copy_unless_cancelled(self, src, dst):
+        self.cancel_token.raise_if_cancelled()
+        copied = shutil.copy2(src, dst)
+        self._tracker.advance()
+        return copied
+
+    @staticmethod
+    def _measure_files_to_stage(dicom_dir) -> tuple[int, int]:
+        """
+        Returns the number and total size in bytes of the files the staging copy will copy.
+        """
+        count = size = 0
+        for root, dirs, files in os.walk(dicom_dir):
+            ignored = set(ignore_func(root, dirs + files))
+            dirs[:] = [name for name in dirs if name not in ignored]
+            for name in files:
+                if name not in ignored:
+                    count += 1
+                    size += os.path.getsize(os.path.join(root, name))
+        return count, size
+
+    def _allocate_scratch(self, size, dicom_dir):
+        """
+        Allocates the scratch directory the study is staged into, replacing that of an earlier staging.
+        It is placed on a RAM disk or the scratch disk depending on the study's size by self.scratch, a
+        ScratchManager, by default the one configured by the environment. cleanup() releases it, which
+        both workflows do whether they succeed, fail or are cancelled.
+        The run's Nifti segmentations are written next to the staged series and
+        moved into the study once complete, see _move_staged_outputs.
+        """
+        self._release_scratch()
+        if self.scratch is None:
+            self.scratch = default_scratch_manager()
+        # The compressed masks are small next to the series, which the estimate is left to
+        self._scratch_dir = self.scratch.allocate(size, label=dicom_dir)
+        self.temp_dir = os.path.join(self._scratch_dir.path, "dicom")
+        self._staged_output_dir = os.path.join(self._scratch_dir.path, "segmentations")
+        os.makedirs(self._staged_output_dir)
+
+    def _release_scratch(self):
+        if self._scratch_dir is not None:
+            self._scratch_dir.release()
+            self._scratch_dir = None
+            self._staged_output_dir = None
+
+    @contextlib.contextmanager
+    def _span(self, name, **attributes):
+        """
+        Times the enclosed step as a span of self.recorder, together with
+        the spans of the code it calls on this thread.
+        """
+        with self.recorder.activate(), span(name, **attributes):
+            yield
+
+    def report_timing(self, dicom_dir):
+        """
+        Logs the timing summary of the study, from the spans its steps recorded
+        into self.recorder, and exports its trace if a trace directory is set
+        (ONKODICOM_TRACE_DIR).
+        """
+        if not self.recorder.spans:
+            return
+        self.recorder.name = dicom_dir
+        logger.info(self.recorder.report())
+
+        directory = trace_dir()
+        if directory is None:
+            return
+        try:
+            logger.info(f"Wrote trace {self.recorder.export(directory, self._profile_name(dicom_dir))}")
+        except OSError as e:
+            logger.warning(f"Failed to write trace: {e}")
+
+    def _profile_name(self, dicom_dir) -> str:
+        """
+        Returns the file name prefix shared by the trace and profile of a study.
+        """
+        if self._trace_prefix is None:
+            self._trace_prefix = f"{os.path.basename(os.path.normpath(dicom_dir))}-{time.strftime('%Y%m%d-%H%M%S')}"
+        return self._trace_prefix
+
+    def _emit_progress(self, event):
+        """
+        Reports a ProgressEvent of a step (files staged, inference patches read from
+        TotalSegmentator's output, structures converted) on signals.progress, and
+        to the optional progress_log callable.
+        """
+        self.signals.progress.emit(event)
+        if self.progress_log is not None:
+            try:
+                self.progress_log(event)
+            except OSError as e:
+                logger.warning(f"Failed to write progress log: {e}")
+
+    def _start_tracker(self, stage, total, unit, dicom_dir):
+        self._tracker = ProgressTracker(self._emit_progress, stage, total, unit, dicom_dir)
+        self._tracker.update(0)
+
+    def _on_cancelled(self):
+        """
+        Reports a workflow stopped by its CancellationToken, with signals.cancelled
+        instead of an error. The staging copy and the conversion check the token
+        between files and structures, a run in the InferenceSession is interrupted
+        by killing the session process, and inference without a session checks it
+        before each model part and patch, see PredictorCache.cancellable.
+        """
+        logger.info("Segmentation workflow cancelled.")
+        self.signals.progress_updated.emit("Segmentation cancelled.")
+        self.signals.cancelled.emit()
+
+    def cleanup(self):
+        """
+        Removes the temporary copy of the study, after the background writing
+        of its NIfTI files has stopped. Safe to call more than once.
+        """
+        self._wait_for_nifti_writer()
+        self._label_volume = None
+        self._settings = None
+        self._existing_outputs = None
+        self._release_scratch()
 
     def _connect_terminal_stream_to_gui(self):
-        output_stream = ConsoleOutputStream()
-        output_stream.new_text.connect(self.controller.update_progress_text)
-        redirect_output_to_gui(output_stream)
-        setup_logging(output_stream)
+        # The controller owns a single buffered stream, created on the GUI thread
+        self.controller.connect_terminal_stream()
 
-    def run_segmentation_workflow(self, dicom_dir, task, fast):
+    def _convert_to_rtstruct(self, output_dir, output_rt, discard_on_error=True) -> bool:
         """
-        Executes the segmentation workflow.
+        Converts the segmentations of the study to the DICOM rtss file, using
+        the copied DICOM series as the reference image set: the label map of the
+        inference step if it kept one, together with the Nifti segmentations of
+        earlier runs in output_dir, otherwise the Nifti segmentations alone.
+        The segmentations of this run are removed on failure unless discard_on_error
+        is False, they are kept when the conversion is cancelled so it can be run again later.
+        The temporary copy of the study is removed in every case.
+        """
+        # Imported on first use, SimpleITK and rt_utils are not needed to start the application
+        from nifti_converter import (label_volume_to_rtstruct_conversion, nifti_to_rtstruct_conversion,
+                                     record_nifti_fingerprints)
 
-        This method handles the entire segmentation process, from selecting the DICOM
-        directory to running the segmentation task and converting the output to DICOM RTSTRUCT.
+        try:
+            # Convert the segmentations to DICOM rtss file
+            self._start_tracker("conversion", 0, "structures", os.path.dirname(output_rt))
+
+            def progress(converted, total):
+                self._tracker.update(converted, total)
+
+            with self._span("conversion"):
+                if self._label_volume is not None:
+                    label_volume_to_rtstruct_conversion(self._label_volume, self.temp_dir, output_rt,
+                                                        nifti_path=output_dir, incremental=True,
+                                                        cancel_token=self.cancel_token, progress=progress)
+                else:
+                    nifti_to_rtstruct_conversion(output_dir, self.temp_dir, output_rt, incremental=True,
+                                                 cancel_token=self.cancel_token, progress=progress)
+            self._tracker.finish()
+
+            # Later conversions from the files compare them with the manifest
+            written = self._wait_for_nifti_writer()
+            if written:
+                record_nifti_fingerprints(output_rt, written)
+            # Batch runs tell a study segmented with other settings from an up to date one
+            if self._settings is not None:
+                record_settings(manifest_path_for(output_rt), self._settings)
+
+            # Complete the cached result with the RTSTRUCT converted from it
+            if self.result_cache is not None and self._cache_key is not None:
+                self.result_cache.store_rtstruct(self._cache_key, output_rt)
+
+            self.signals.progress_updated.emit("Conversion successful.")
+            self.signals.finished.emit()
+            return True
+
+        except SegmentationCancelled:
+            self._on_cancelled()
+            return False
+
+        except Exception as e:
+            self.signals.error.emit("Failed to convert files to RTSTRUCT format.")
+            logger.exception(e)
+            self._wait_for_nifti_writer()
+            if discard_on_error:
+                self._discard_outputs(output_dir)
+            return False
+
+        finally:
+            self.cleanup()
+
+    @staticmethod
+    def _output_paths(dicom_dir) -> tuple[str, str]:
         """
-        # Clear previous progress text
-        self.signals.progress_updated.emit("Starting segmentation workflow...")
+        Returns the Nifti segmentation directory and rtss file path of a study.
+        """
+        return os.path.join(dicom_dir, "segmentations"), os.path.join(dicom_dir, "rtss.dcm")
 
-        # Copy contents from selected dir to temp dir (excludes rt*.dcm files)
-        self._create_copied_temporary_directory(dicom_dir)
+    def stage(self, dicom_dir) -> bool:
+        """
+        Staging step of the workflow, copies the study into the temporary
+        directory used as TotalSegmentator input (excludes rt*.dcm files).
+        """
+        return self._create_copied_temporary_directory(dicom_dir)
+
+    def infer(self, dicom_dir, task, fast, roi_subset=None, preview=False) -> bool:
+        """
+        Inference step of the workflow, runs TotalSegmentator on the staged
+        study. Depending on self.nifti_output, the Nifti segmentations are written
+        into the study directory by TotalSegmentator, written from the label map
+        kept for the conversion step in the background, or not at all.
+        roi_subset restricts the run to those structures of the task (see
+        ROI_SUBSET_TASKS), so the inference, the Nifti writing and the conversion
+        only handle the structures requested. With preview, a fastest mode run is
+        shown first unless the result is restored from the cache.
+        """
+        self._roi_subset = sorted(roi_subset) if roi_subset else None
+        self._settings = run_settings(task, fast, roi_subset)
+        self._preview_shown = False
 
         # Connect the terminal stream output to the progress text gui element
-        self._connect_terminal_stream_to_gui()
+        if self.controller is not None:
+            self._connect_terminal_stream_to_gui()
+
+        output_dir, output_rt = self._output_paths(dicom_dir)
+        try:
+            # Create the output path for Nifti segmentation files
+            os.makedirs(output_dir, exist_ok=True)
+            existing_outputs = self._existing_outputs = self._snapshot_outputs(output_dir)
+
+            self._start_tracker("inference", 0, "patches", dicom_dir)
+            with self._span("cache_lookup"):
+                restored = self._restore_cached_result(task, fast, output_dir, output_rt)
+            if restored:
+                self._tracker.finish()
+                return True
+
+            # Segmentations restored from the cache are hardlinks, give the study
+            # its own copies before this run replaces them
+            detach_hardlinks(output_dir)
 
-        # Create the output path for Nifti segmentation files
-        output_dir = os.path.join(dicom_dir, "segmentations")
-        os.makedirs(output_dir, exist_ok=True)
-        output_rt = os.path.join(dicom_dir, "rtss.dcm")
+        except Exception as e:
+            # e.g. a read-only study directory
+            self.signals.error.emit("Failed to prepare the segmentation output directory.")
+            logger.exception(e)
+            return False
+        in_memory = self.nifti_output != "files"
+
+        segmentation_settings = dict(
+            input=self.temp_dir,
+            # Without an output directory TotalSegmentator only returns the label map
+            output=None if in_memory else self._staged_output_dir,
+            task=task,
+            output_type="nifti",  # output to dicom
+            device="cpu",  # Run on cpu
+            fastest=fast
+        )
+        if self._roi_subset is not None:
+            segmentation_settings["roi_subset"] = self._roi_subset
+        if in_memory:
+            segmentation_settings["skip_saving"] = True
+        if self.resource_profile is not None:
+            segmentation_settings.update(self.resource_profile.totalsegmentator_kwargs())
+
+        if preview and not fast and task in PREVIEW_TASKS:
+            if not self._show_preview(dicom_dir, segmentation_settings):
+                return False
+            self._start_tracker("inference", 0, "patches", dicom_dir)
 
         # Call total segmentator API
         try:
-            totalsegmentator(
-                input=self.temp_dir,
-                output=output_dir,
-                task=task,
-                output_type="nifti",  # output to dicom
-                device="cpu",  # Run on cpu
-                fastest=fast
-            )
+            self.cancel_token.raise_if_cancelled()
+            with self._span("inference", task=task, fast=fast):
+                label_volume = self._run_totalsegmentator(segmentation_settings, return_labels=in_memory)
+            self.cancel_token.raise_if_cancelled()
+            self._tracker.finish()
+
+            # Partially written segmentations stay in the scratch directory and go with it
+            if not in_memory:
+                written = self._move_staged_outputs(output_dir)
 
-            output_rt = os.path.join(dicom_dir, "rtss.dcm")
+        except SegmentationCancelled:
+            self._on_cancelled()
+            return False
 
         except Exception as e:
             self.signals.error.emit("Failed to run segmentation workflow.")
             logger.exception(e)
-            shutil.rmtree(output_dir)
+            return False
 
+        if not in_memory:
+            self._store_result(task, fast, dicom_dir, output_dir, written)
+            return True
+
+        self._label_volume = label_volume
+        self._emit_structures(dicom_dir)
+        if self.nifti_output == "background":
+            self._start_nifti_writer(task, fast, dicom_dir, output_dir)
+        else:
+            self._remove_replaced_outputs(output_dir, existing_outputs)
+        return True
+
+    def _show_preview(self, dicom_dir, segmentation_settings) -> bool:
+        """
+        Runs TotalSegmentator's fastest mode ahead of the full resolution run and
+        emits its label map on signals.structures_ready as a preview LabelOverlay,
+        which the viewer replaces structure by structure with the full resolution
+        one. Only run for tasks in PREVIEW_TASKS. A failed preview is only logged,
+        the full resolution run goes ahead. Returns False when cancelled.
+        """
+        settings = dict(segmentation_settings, output=None, skip_saving=True, fastest=True)
+        self._start_tracker("preview", 0, "patches", dicom_dir)
         try:
-            # Convert the Nifti output to DICOM rtss file
-            nifti_to_rtstruct_conversion(output_dir, self.temp_dir, output_rt)
+            self.cancel_token.raise_if_cancelled()
+            with self._span("preview", task=settings["task"]):
+                label_volume = self._run_totalsegmentator(settings, return_labels=True)
+                self.cancel_token.raise_if_cancelled()
+                overlay = label_volume.overlay(dicom_dir, self._series_geometry(), preview=True)
+            self._tracker.finish()
 
-            self.signals.progress_updated.emit("Conversion successful.")
-            self.signals.finished.emit()
-            shutil.rmtree(self.temp_dir)
+        except SegmentationCancelled:
+            self._on_cancelled()
+            return False
+
+        except Exception:
+            logger.exception("Preview segmentation failed, continuing with the full resolution run.")
+            return True
+
+        self._preview_shown = True
+        self.signals.structures_ready.emit(overlay)
+        self.signals.progress_updated.emit(f"Preview of {len(overlay.labels)} structures ready, "
+                                           f"refining at full resolution...")
+        return True
+
+    def _emit_structures(self, dicom_dir):
+        """
+        Emits the full resolution label map for the viewer, in place of the preview if one was shown,
+        before the Nifti files and the RTSTRUCT are written, so the viewer lists the structures without
+        reading them back from disk. The map is aligned to the CT grid once, for the viewer and the conversion.
+        """
+        try:
+            with self._span("overlay"):
+                overlay = self._label_volume.overlay(dicom_dir, self._series_geometry())
+        except Exception:
+            logger.exception("Failed to align the full resolution segmentation for display.")
+            return
+        self.signals.structures_ready.emit(overlay)
+
+    def _series_geometry(self):
+        """
+        Returns the geometry of the staged series, read from its headers.
+        """
+        from nifti_converter import load_series_geometry
+        return load_series_geometry(self.temp_dir)
+
+    def _run_totalsegmentator(self, segmentation_settings, return_labels=False):
+        """
+        Runs TotalSegmentator in the inference session if there is one, reusing the
+        models loaded by previous runs in the session's long-lived process, in this
+        process otherwise. self.resource_profile sets the thread counts and CPU
+        pinning of the inference. Returns the segmentation as a LabelVolume if
+        return_labels, None otherwise.
+        """
+        if self.session is not None:
+            # Cancelling kills the session process running the models
+            self.cancel_token.add_callback(self.session.cancel)
+            try:
+                return self.session.run(on_output=self._watch_inference_output(sys.stdout.write),
+                                        resource_profile=self.resource_profile, return_labels=return_labels,
+                                        **segmentation_settings)
+            finally:
+                self.cancel_token.remove_callback(self.session.cancel)
+
+        # Imported on first use, importing torch and nnU-Net takes several seconds
+        from totalsegmentator.python_api import totalsegmentator
+
+        # The cached predictors check the cancel token between model parts and patches
+        predictor_cache = install_predictor_cache()
+        cancellation = (predictor_cache.cancellable(self.cancel_token) if predictor_cache is not None
+                        else contextlib.nullcontext())
+
+        if self.resource_profile is not None:
+            apply_resource_profile(self.resource_profile)
+        # TotalSegmentator announces the model parts on stdout, nnU-Net draws its progress bars on stderr
+        # Only the text written on this thread, other studies' pipeline stages write meanwhile
+        with cancellation, watch_thread_output(self._watch_inference_output()):
+            segmentation = totalsegmentator(**segmentation_settings)
+        if not return_labels:
+            return None
 
+        from label_volume import LabelVolume
+        return LabelVolume.from_totalsegmentator(segmentation, segmentation_settings["task"],
+                                                 segmentation_settings.get("roi_subset"))
+
+    def _start_nifti_writer(self, task, fast, dicom_dir, output_dir):
+        """
+        Writes the Nifti files of the label map on a background thread while it
+        is converted, moves them into output_dir and adds them to the result cache.
+        """
+        label_volume = self._label_volume
+
+        def write():
+            with self._span("nifti_writing", structures=len(label_volume.labels)):
+                label_volume.write_nifti(self._staged_output_dir, self.cancel_token)
+                self.cancel_token.raise_if_cancelled()
+                written = self._move_staged_outputs(output_dir)
+            self._store_result(task, fast, dicom_dir, output_dir, written)
+            return {name[:-len(".nii.gz")]: os.path.join(output_dir, name) for name in written}
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nifti-writer")
+        self._nifti_writer = executor.submit(write)
+        executor.shutdown(wait=False)
+
+    def _wait_for_nifti_writer(self) -> dict:
+        """
+        Waits for the background writing of the Nifti files to finish.
+        Returns {structure name: path} of the files written, empty if there was
+        no writing or it failed.
+        """
+        writer, self._nifti_writer = self._nifti_writer, None
+        if writer is None:
+            return {}
+        try:
+            return writer.result()
+        except SegmentationCancelled:
+            return {}
         except Exception as e:
-            self.signals.error.emit("Failed to convert files to RTSTRUCT format.")
-            logger.exception(e)
-            shutil.rmtree(output_dir)
\ No newline at end of file
+            logger.warning(f"Failed to write the Nifti segmentations: {e}")
+            return {}
+
+    def _remove_replaced_outputs(self, output_dir, existing_outputs):
+        """
+        Removes the Nifti files of earlier runs for the structures of the label
+        map, which are not written when Nifti output is skipped, so a later
+        conversion from the files does not bring back their old segmentation.
+        Without Nifti files the result is not added to the result cache, which stores the files.
+        """
+        replaced = [f"{name}.nii.gz" for name in self._label_volume.names
+                    if f"{name}.nii.gz" in existing_outputs]
+        for name in replaced:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(output_dir, name))
+        if replaced:
+            logger.info(f"Removed {len(replaced)} Nifti segmentations replaced by this run")
+        logger.info("Nifti output skipped, the segmentation is not added to the result cache")
+
+    def _move_staged_outputs(self, output_dir) -> list[str]:
+        """
+        Moves the Nifti files of the run from the scratch directory into output_dir,
+        replacing those of earlier runs, and returns their file names. The files
+        are copied under temporary names first and renamed once all of them are
+        copied, so a failed move leaves the study's segmentations as they were.
+        """
+        names = sorted(name for name in os.listdir(self._staged_output_dir)
+                       if name.endswith(".nii.gz") and not name.startswith("."))
+        moved = []
+        temporary_paths = {}
+        try:
+            for name in names:
+                temporary_paths[name] = os.path.join(output_dir, f".{name[:-len('.nii.gz')]}.partial.nii.gz")
+                shutil.copyfile(os.path.join(self._staged_output_dir, name), temporary_paths[name])
+            for name in names:
+                os.replace(temporary_paths[name], os.path.join(output_dir, name))
+                moved.append(name)
+        except BaseException:
+            for name, temporary_path in temporary_paths.items():
+                if name not in moved:
+                    with contextlib.suppress(OSError):
+                        os.remove(temporary_path)
+            raise
+        return moved
+
+    def _watch_inference_output(self, write=None):
+        """
+        Returns a function reading the inference progress from TotalSegmentator's
+        output text and passing the text on to write, if given.
+        """
+        parser = InferenceOutputParser(self._tracker)
+
+        def watch(text):
+            parser.feed(text)
+            if write is not None:
+                write(text)
+        return watch
+
+    @staticmethod
+    def _snapshot_outputs(output_dir) -> dict:
+        """
+        Returns the size and modification time of each Nifti file in output_dir,
+        to tell the files written by a run from those of earlier runs.
+        """
+        snapshot = {}
+        for name in os.listdir(output_dir):
+            if name.endswith(".nii.gz"):
+                file_stat = os.stat(os.path.join(output_dir, name))
+                snapshot[name] = (file_stat.st_size, file_stat.st_mtime_ns)
+        return snapshot
+
+    def _discard_outputs(self, output_dir):
+        """
+        Removes the Nifti files this run wrote or replaced in output_dir. The files
+        of earlier runs are kept, the RTSTRUCT and its manifest still refer to them.
+        """
+        if self._existing_outputs is None or not os.path.isdir(output_dir):
+            return
+        discarded = [name for name, fingerprint in self._snapshot_outputs(output_dir).items()
+                     if self._existing_outputs.get(name) != fingerprint]
+        for name in discarded:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(output_dir, name))
+        if discarded:
+            logger.info(f"Discarded {len(discarded)} Nifti segmentations of this run")
+
+    def _restore_cached_result(self, task, fast, output_dir, output_rt) -> bool:
+        """
+        Looks up the staged series, task, fast flag and roi_subset in the result
+        cache and restores the stored segmentations into output_dir on a hit,
+        instead of running TotalSegmentator. Subset results are cached separately
+        from whole task results, fresh results are added by _store_result.
+        """
+        self._cache_key = None
+        if self.result_cache is None:
+            return False
+
+        try:
+            self._cache_key, self._series_uid = self.result_cache.key_for(self.temp_dir, task, fast,
+                                                                          self._roi_subset)
+        except Exception as e:
+            logger.warning(f"Result cache disabled for this study: {e}")
+            return False
+
+        if not self.result_cache.restore(self._cache_key, output_dir, output_rt):
+            return False
+
+        self.signals.progress_updated.emit("Restored segmentation from the result cache.")
+        return True
+
+    def _store_result(self, task, fast, dicom_dir, output_dir, written) -> None:
+        """
+        Adds the Nifti files written by the run, file names in output_dir, to the result cache.
+        """
+        if self.result_cache is None or self._cache_key is None or not written:
+            return
+
+        try:
+            self.result_cache.store(self._cache_key, self._series_uid, task, fast, output_dir, written, dicom_dir,
+                                    self._roi_subset)
+        except Exception as e:
+            logger.warning(f"Failed to add the segmentation to the result cache: {e}")
+
+    def convert(self, dicom_dir, discard_on_error=True) -> bool:
+        """
+        Conversion step of the workflow, converts the Nifti segmentations
+        of the study to the DICOM rtss file.
+        """
+        output_dir, output_rt = self._output_paths(dicom_dir)
+        return self._convert_to_rtstruct(output_dir, output_rt, discard_on_error)
+
+    def run_segmentation_workflow(self, dicom_dir, task, fast, roi_subset=None, preview=False) -> bool:
+        """
+        Executes the segmentation workflow.
+
+        This method handles the entire segmentation process, from selecting the DICOM
+        directory to running the segmentation task and converting the output to DICOM RTSTRUCT.
+        The steps run one after the other, see segmentation_pipeline for overlapping
+        them across several studies. roi_subset restricts the run to those
+        structures of the task, preview shows a fastest mode segmentation
+        before the full resolution one. Returns True when the rtss file was written.
+        """
+        # Clear previous progress text
+        self.signals.progress_updated.emit("Starting segmentation workflow...")
+
+        try:
+            with profiled(self._profile_name(dicom_dir)):
+                return (self.stage(dicom_dir) and self.infer(dicom_dir, task, fast, roi_subset, preview)
+                        and self.convert(dicom_dir))
+        finally:
+            self.cleanup()
+            self.report_timing(dicom_dir)
+
+    def run_conversion_workflow(self, dicom_dir) -> bool:
+        """
+        Converts the existing Nifti segmentations of a study to DICOM RTSTRUCT
+        without running TotalSegmentator again.
+        Returns True when the rtss file was written.
+        """
+        self.signals.progress_updated.emit("Starting conversion workflow...")
+
+        try:
+            with profiled(self._profile_name(dicom_dir)):
+                return self.stage(dicom_dir) and self.convert(dicom_dir, discard_on_error=False)
+        finally:
+            self.cleanup()
+            self.report_timing(dicom_dir)
@@ -3,9 +3,16 @@ import os
 from PySide6.QtCore import QThreadPool, Slot
 
 from auto_segmentation import AutoSegmentation
-from multithread import Worker
+from cancellation import CancellationToken
+from inference_session import InferenceSession
+from multithread import JobSignalRelay, SegmentationWorkerSignals, Worker
+from progress_events import JsonLinesProgressLog, format_duration, overall_percent
+from redirect_stdout import ConsoleOutputStream, redirect_output_to_gui, setup_logging
+from resource_profile import ResourceProfile
+from result_cache import ResultCache
+from scratch_space import default_scratch_manager
+from segmentation_job_queue import JobStatus, SegmentationJob, SegmentationJobQueue, study_key
 import threading
-from dicom_viewer_tab import DicomViewer
 
 class AutoSegmentationController:
     """
@@ -22,10 +29,51 @@ class AutoSegmentationController:
         """
         self._view = view
         self._model = None
+        # DicomViewer showing the segmented structures of its study, see set_viewer
+        self._viewer = None
+        # Jobs whose full resolution structures were streamed to the viewer
+        self._streamed_jobs: set[int] = set()
         self.threadpool = QThreadPool()
         self.dicom_dir = None
         self.nifti_dir = None
 
+        # Long-lived TotalSegmentator process keeping recently used models loaded,
+        # one per concurrently running job
+        self.inference_session = InferenceSession()
+        self._inference_sessions: dict[int, InferenceSession] = {0: self.inference_session}
+
+        # CPU threads and pinning given to each segmentation run, auto-tuned from the core count
+        self.resource_profile = ResourceProfile.auto()
+
+        # Earlier results restored instead of repeating the inference on an unchanged study
+        self.result_cache = ResultCache()
+
+        # Progress events of every run, kept to compare throughput between runs
+        self.progress_log = JsonLinesProgressLog()
+
+        # Buffered console output shown in the view, created here on the GUI thread
+        # and installed once by the first run
+        self.console_stream = ConsoleOutputStream()
+        self.console_stream.new_text.connect(self.update_console_output)
+        self._console_connected = False
+
+        # Queued and running segmentation jobs, with the slot, signal relay
+        # and cancellation token of each running job
+        self.job_queue = SegmentationJobQueue(max_concurrent=1)
+        self._job_slots: dict[int, int] = {}
+        self._job_relays: dict[int, JobSignalRelay] = {}
+        self._job_tokens: dict[int, CancellationToken] = {}
+
+    def warm_up(self) -> None:
+        """
+        Start the inference session process on a background thread, so torch
+        and TotalSegmentator are loaded before the first segmentation is queued,
+        and remove the scratch directories left behind by earlier runs
+        :rtype: None
+        """
+        threading.Thread(target=self.inference_session.start, name="inference-warm-up", daemon=True).start()
+        threading.Thread(target=default_scratch_manager, name="scratch-sweep", daemon=True).start()
+
     def set_view(self, view) -> None:
         """
         To change the view reference if a new view is
@@ -35,17 +83,89 @@ class AutoSegmentationController:
         """
         self._view = view
 
+    def set_viewer(self, viewer) -> None:
+        """
+        Set the viewer which shows the structures segmented for its study
+        :param viewer: DicomViewer
+        :rtype: None
+        """
+        self._viewer = viewer
+
+    def set_resource_profile(self, resource_profile: ResourceProfile) -> None:
+        """
+        Set the CPU resources used by the following segmentation runs
+        :param resource_profile: ResourceProfile
+        :rtype: None
+        """
+        self.resource_profile = resource_profile
+
+    def get_resource_profile(self) -> ResourceProfile:
+        """
+        Get the CPU resources used by segmentation runs
+        :rtype: ResourceProfile
+        """
+        return self.resource_profile
+
+    def set_max_concurrent_jobs(self, max_concurrent: int) -> None:
+        """
+        Set how many segmentation jobs may run at the same time
+        and start queued jobs if the limit was raised
+        :param max_concurrent: int
+        :rtype: None
+        """
+        self.job_queue.set_max_concurrent(max_concurrent)
+        self.threadpool.setMaxThreadCount(max(self.threadpool.maxThreadCount(), max_concurrent))
+        self._start_queued_jobs()
+
     # View related methods
     def start_button_clicked(self, dicom_dir) -> None:
         """
-        To be called when the button to start the selected segmentation task is clicked
+        To be called when the button to start the selected segmentation task is clicked.
+        Queues the selected task for the study, it starts as soon as a job slot is free
+        :rtype: None
+        """
+        # Apply the CPU settings chosen in the view
+        self.set_resource_profile(
+            ResourceProfile.auto(threads=self._view.get_thread_count(), pin=self._view.get_pin_cpus())
+        )
+
+        # Queue Auto Segmentation task
+        self.run_task(dicom_dir, self._view.get_segmentation_task(), self._view.get_fast_value(),
+                      self._view.get_priority(), self._view.get_roi_subset(), self._view.get_preview_value())
+
+    def stop_button_clicked(self, dicom_dir) -> None:
+        """
+        To be called when the button to stop the segmentation of the study is clicked.
+        Cancels every queued or running job of the study
         :rtype: None
         """
-        # Disable start button while segmentation processes
-        self._view.set_start_button_status()
+        for job in self.job_queue.active_jobs(dicom_dir):
+            self.cancel_job(job.job_id)
 
-        # Run Auto Segmentation task
-        self.run_task(dicom_dir, self._view.get_segmentation_task(), self._view.get_fast_value())
+    def has_active_job(self, dicom_dir) -> bool:
+        """
+        Whether a job of the study is queued or running
+        :param dicom_dir: str
+        :rtype: bool
+        """
+        return bool(self.job_queue.active_jobs(dicom_dir))
+
+    def cancel_job(self, job_id: int) -> None:
+        """
+        Cancel a job. A queued job is dropped straight away, a running job
+        stops at its next cancellation point and frees its slot once it has
+        cleaned up
+        :param job_id: int
+        :rtype: None
+        """
+        if self.job_queue.cancel(job_id):
+            self._view.update_job(self.job_queue.get(job_id))
+            return
+
+        token = self._job_tokens.get(job_id)
+        if token is not None and not token.is_cancelled:
+            self.update_progress_text("Cancelling segmentation...")
+            token.cancel()
 
     def update_progress_bar_value(self, value: int) -> None:
         """
@@ -56,6 +176,27 @@ class AutoSegmentationController:
         """
         self._view.set_progress_bar_value(value)
 
+    def connect_terminal_stream(self) -> None:
+        """
+        Redirect stdout and logging to the console output of the view.
+        Only the first call has an effect
+        :rtype: None
+        """
+        if self._console_connected:
+            return
+        self._console_connected = True
+        redirect_output_to_gui(self.console_stream)
+        setup_logging(self.console_stream)
+
+    @Slot(str)
+    def update_console_output(self, text: str) -> None:
+        """
+        Access the view of the feature and adds raw console output to the progress text
+        :param text: str
+        :rtype: None
+        """
+        self._view.append_console_output(text)
+
     @Slot()
     def update_progress_text(self, text: str) -> None:
         """
@@ -66,38 +207,233 @@ class AutoSegmentationController:
         self._view.set_progress_text(text)
 
     # Model related methods
-    def run_task(self, dicom_dir: str, task: str, fast: bool) -> None:
+    def run_task(self, dicom_dir: str, task: str, fast: bool, priority: int = 0,
+                 roi_subset: list[str] | None = None, preview: bool = False) -> SegmentationJob:
         """
-        Run the segmentation task from the model class.
-        Performing the Segmentation for the Dicom Images
+        Queue the segmentation task from the model class.
+        Performing the Segmentation for the Dicom Images.
+        An identical (study, task, fast, structures) request which is already queued or running
+        is not queued twice
+        :param dicom_dir: str
         :param task: str
         :param fast: bool
-        :rtype: None
+        :param priority: int, higher priorities start first
+        :param roi_subset: list of structures of the task to segment, None for all of them
+        :param preview: bool, show a fastest mode preview in the viewer before the full resolution run
+        :rtype: SegmentationJob
         """
         self.dicom_dir = dicom_dir
         self.nifti_dir = os.path.join(dicom_dir, "segmentations")
 
+        job, is_new = self.job_queue.submit(dicom_dir, task, fast, priority, roi_subset, preview)
+        if is_new:
+            self._view.add_job(job)
+        else:
+            self._view.update_job(job)
+            self.update_progress_text(f"Task {task} is already {job.status.lower()} for {dicom_dir}")
+
+        self._start_queued_jobs()
+        return job
+
+    def _start_queued_jobs(self) -> None:
+        """
+        Start queued jobs until the concurrency limit is reached
+        :rtype: None
+        """
+        while (job := self.job_queue.next_runnable()) is not None:
+            self._start_job(job)
+
+    def _start_job(self, job: SegmentationJob) -> None:
+        """
+        Run a job on the thread pool, in its own slot with its own inference session
+        :param job: SegmentationJob
+        :rtype: None
+        """
+        slot = min(set(range(len(self._job_slots) + 1)) - set(self._job_slots.values()))
+        self._job_slots[job.job_id] = slot
+        if slot not in self._inference_sessions:
+            self._inference_sessions[slot] = InferenceSession()
+
+        # Give each concurrently running job its own cores when pinning
+        resource_profile = self.resource_profile
+        if resource_profile.cpu_affinity is not None:
+            resource_profile = ResourceProfile.auto(
+                self.job_queue.max_concurrent, slot, pin=True, threads=resource_profile.torch_threads
+            )
+
+        # Signals are created on the GUI thread so the relay receives them there
+        signals = SegmentationWorkerSignals()
+        relay = JobSignalRelay(job.job_id, self)
+        relay.connect_signals(signals)
+        self._job_relays[job.job_id] = relay
+
+        cancel_token = CancellationToken()
+        self._job_tokens[job.job_id] = cancel_token
+
         # Instantiate AutoSegmentation passing the required settings from the UI
-        auto_segmentation = AutoSegmentation(self)
+        auto_segmentation = AutoSegmentation(
+            self, session=self._inference_sessions[slot], resource_profile=resource_profile, signals=signals,
+            cancel_token=cancel_token, result_cache=self.result_cache if self._view.get_use_result_cache() else None,
+            progress_log=self.progress_log
+        )
+        self.update_progress_text(f"Starting {job.task} for {job.dicom_dir} "
+                                  f"(CPU resources: {resource_profile.describe()})")
+        self._view.update_job(job)
 
         # Run the API task on separate thread
-        worker = Worker(auto_segmentation.run_segmentation_workflow,dicom_dir, task, fast)
+        worker = Worker(auto_segmentation.run_segmentation_workflow, job.dicom_dir, job.task, job.fast,
+                        list(job.roi_subset) if job.roi_subset else None, job.preview, signals=signals)
         self.threadpool.start(worker)
 
+    def _release_job(self, job_id: int, success: bool, message: str = "",
+                     cancelled: bool = False) -> SegmentationJob | None:
+        """
+        Record the outcome of a job, free its slot and start the next queued jobs.
+        Only the first outcome reported for a job is recorded
+        :param job_id: int
+        :param success: bool
+        :param message: str
+        :param cancelled: bool
+        :rtype: SegmentationJob, None if the job was already released
+        """
+        job = self.job_queue.finish(job_id, success, message, cancelled)
+        if job is None:
+            return None
+        self._job_slots.pop(job_id, None)
+        self._job_relays.pop(job_id, None)
+        self._job_tokens.pop(job_id, None)
+        self._view.update_job(job)
+        self._start_queued_jobs()
+        return job
+
+    def on_job_progress(self, job_id: int, text: str) -> None:
+        """
+        Show a job's output text in the progress text UI element
+        :param job_id: int
+        :param text: str
+        :rtype: None
+        """
+        self.update_progress_text(text)
+
+    def on_job_progress_event(self, job_id: int, event) -> None:
+        """
+        Record a job's progress in its queue entry and show it on the progress bar
+        :param job_id: int
+        :param event: ProgressEvent
+        :rtype: None
+        """
+        job = self.job_queue.get(job_id)
+        job.progress = overall_percent(event)
+        job.message = event.describe()
+        self._view.update_job(job)
+        self.on_progress_event(event)
+
+    def on_job_finished(self, job_id: int) -> None:
+        """
+        Release a finished job and list its structures in the viewer, unless they were streamed to it
+        :param job_id: int
+        :rtype: None
+        """
+        job = self._release_job(job_id, True)
+        if job is None:
+            return
+        if job_id not in self._streamed_jobs:
+            self.show_study_structures(job.dicom_dir)
+        self._streamed_jobs.discard(job_id)
+        self.on_segmentation_finished()
+
+    def on_job_error(self, job_id: int, message: str) -> None:
+        """
+        Release a failed job and show its error
+        :param job_id: int
+        :param message: str
+        :rtype: None
+        """
+        self._streamed_jobs.discard(job_id)
+        if self._release_job(job_id, False, message) is None:
+            return
+        self.on_segmentation_error(message)
+
+    def on_job_cancelled(self, job_id: int) -> None:
+        """
+        Release a cancelled job and show that it was cancelled
+        :param job_id: int
+        :rtype: None
+        """
+        self._streamed_jobs.discard(job_id)
+        if self._release_job(job_id, False, "Cancelled", cancelled=True) is None:
+            return
+        self.on_segmentation_cancelled()
+
+    def on_job_structures(self, job_id: int, overlay) -> None:
+        """
+        Show the structures a job segmented in the viewer, remembering that
+        the full resolution ones were streamed to it
+        :param job_id: int
+        :param overlay: LabelOverlay
+        :rtype: None
+        """
+        if not overlay.preview:
+            self._streamed_jobs.add(job_id)
+        self.on_structures_ready(overlay)
+
+    def show_study_structures(self, dicom_dir: str) -> None:
+        """
+        List the structures of a study's RTSTRUCT in the viewer if it displays the study,
+        for results which were not streamed, e.g. restored from the cache
+        :param dicom_dir: str
+        :rtype: None
+        """
+        if self._viewer_shows(dicom_dir):
+            self._viewer.load_rtstruct_async()
+
+    def _viewer_shows(self, dicom_dir: str) -> bool:
+        return (self._viewer is not None and self._viewer.dicom_dir is not None
+                and study_key(dicom_dir) == study_key(self._viewer.dicom_dir))
+
+    @Slot(object)
+    def on_structures_ready(self, overlay) -> None:
+        """
+        Show segmented structures in the viewer if it displays their study
+        :param overlay: LabelOverlay
+        :rtype: None
+        """
+        if self._viewer_shows(overlay.dicom_dir):
+            self._viewer.show_label_overlay(overlay)
+
+    @Slot(object)
+    def on_progress_event(self, event) -> None:
+        """
+        Show the progress of the running jobs on the progress bar, the mean of
+        their overall progress, with the stage and remaining time of the latest event
+        :param event: ProgressEvent
+        :rtype: None
+        """
+        running = [job for job in self.job_queue.jobs() if job.status == JobStatus.RUNNING]
+        if running:
+            value = round(sum(job.progress for job in running) / len(running))
+        else:
+            value = overall_percent(event)
+
+        eta = f", {format_duration(event.eta)} left" if event.eta is not None else ""
+        self._view.set_progress_bar_format(f"%p%  {event.stage}{eta}")
+        self.update_progress_bar_value(value)
 
     @Slot()
     def on_segmentation_finished(self) -> None:
         # Update the text edit UI
+        self._view.set_progress_bar_format("%p%")
         self.update_progress_bar_value(100)
         self.update_progress_text("Segmentation Finished")
 
-        # Disable start button while segmentation processes
-        self._view.set_start_button_status()
-
 
     @Slot()
     def on_segmentation_error(self, error) -> None:
         print("Segmentation Error from controller.")
+        self.update_progress_text(f"Segmentation Error: {error}")
 
-        # Disable start button while segmentation processes
-        self._view.set_start_button_status()
+    @Slot()
+    def on_segmentation_cancelled(self) -> None:
+        self._view.set_progress_bar_format("%p%")
+        self.update_progress_bar_value(0)
+        self.update_progress_text("Segmentation Cancelled")
@@ -0,0 +1,390 @@
+"""Headless batch entry point for segmenting and converting many studies.
+
+Runs AutoSegmentation.run_segmentation_workflow (or only the NIfTI to
+RTSTRUCT conversion) over a list or glob of study directories using a
+bounded pool of worker processes. Each study writes its own log file and
+studies whose rtss.dcm is newer than their inputs and was segmented
+with the same settings are skipped.
+With --pipeline the studies instead run through segmentation_pipeline in a
+single process, overlapping the staging and conversion of neighbouring
+studies with the inference of the current one.
+Results are restored from the segmentation result cache when the same task
+was already run on an identical series (see result_cache, --no-cache).
+The time spent in each stage is logged per study; --trace-dir also writes
+it as a Chrome trace, see instrumentation.
+PySide6 is never imported.
+
+Example:
+    python batch_segmentation.py "/data/studies/*" --task total --fast --workers 2
+"""
+import argparse
+import contextlib
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ignore_files_in_dir import ignore_func
+from instrumentation import PROFILE_ENV, TRACE_DIR_ENV
+from segmentation_manifest import load_settings, manifest_path_for, run_settings
+
+logger = logging.getLogger(__name__)
+
+SEGMENTATION_DIR_NAME = "segmentations"
+RTSTRUCT_FILE_NAME = "rtss.dcm"
+
+
+def expand_study_dirs(patterns: list[str]) -> list[str]:
+    """
+    Expand study directory arguments which may be plain paths or glob patterns.
+
+    :param patterns: list of paths or glob patterns
+    :return: sorted list of unique existing directories
+    """
+    study_dirs = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                study_dirs.add(os.path.abspath(match))
+            else:
+                logger.warning(f"Skipping {match}: not a directory")
+    return sorted(study_dirs)
+
+
+def _newest_mtime(directory: str, files: list[str]) -> float:
+    """
+    Get the newest modification time of the files in directory.
+
+    :param directory:
+    :param files: file names within directory
+    :return: float, 0.0 if there are no files
+    """
+    return max((os.path.getmtime(os.path.join(directory, name)) for name in files), default=0.0)
+
+
+def is_study_up_to_date(study_dir: str, convert_only: bool = False, task: str = "total", fast: bool = False,
+                        roi_subset: list[str] | None = None) -> bool:
+    """
+    Check whether the study's rtss.dcm is newer than all of its inputs.
+    The inputs are the DICOM files that the workflow copies, and when only
+    converting, the NIfTI segmentations as well. Unless only converting, the
+    segmentations must also have been made with the same task, fast mode and
+    roi_subset, as recorded in the RTSTRUCT's manifest.
+
+    :param study_dir:
+    :param convert_only:
+    :param task: TotalSegmentator task
+    :param fast: TotalSegmentator's fastest mode
+    :param roi_subset: structures the run is restricted to, None for all of them
+    :return: bool
+    """
+    rtstruct_path = os.path.join(study_dir, RTSTRUCT_FILE_NAME)
+    if not os.path.isfile(rtstruct_path):
+        return False
+
+    if not convert_only:
+        recorded = load_settings(manifest_path_for(rtstruct_path))
+        if recorded != run_settings(task, fast, roi_subset):
+            return False
+
+    contents = os.listdir(study_dir)
+    ignored = set(ignore_func(study_dir, contents))
+    dicom_files = [
+        name for name in contents
+        if name not in ignored and os.path.isfile(os.path.join(study_dir, name))
+    ]
+    newest_input = _newest_mtime(study_dir, dicom_files)
+
+    if convert_only:
+        segmentation_dir = os.path.join(study_dir, SEGMENTATION_DIR_NAME)
+        if os.path.isdir(segmentation_dir):
+            newest_input = max(newest_input, _newest_mtime(segmentation_dir, os.listdir(segmentation_dir)))
+
+    return os.path.getmtime(rtstruct_path) >= newest_input
+
+
+def _study_log_path(log_dir: str, study_dir: str) -> str:
+    """
+    Get the path of a study's log file, named after the study directory and
+    a short hash of its full path, so studies with the same directory name in
+    different places, e.g. a/CT and b/CT, do not share a log.
+
+    :param log_dir: directory receiving the per-study logs
+    :param study_dir:
+    :return: str
+    """
+    study_dir = os.path.abspath(study_dir)
+    path_hash = hashlib.sha1(study_dir.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(log_dir, f"{os.path.basename(study_dir)}-{path_hash}.log")
+
+
+@contextlib.contextmanager
+def _study_log(log_path: str):
+    """
+    Send logging records and stdout/stderr of the current process to a
+    per-study log file for the duration of the context.
+
+    :param log_path:
+    """
+    root_logger = logging.getLogger()
+    previous_handlers = root_logger.handlers[:]
+    previous_level = root_logger.level
+
+    with open(log_path, "a", buffering=1) as log_file:
+        handler = logging.StreamHandler(log_file)
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+        root_logger.handlers = [handler]
+        root_logger.setLevel(logging.INFO)
+        try:
+            with contextlib.redirect_stdout(log_file), contextlib.redirect_stderr(log_file):
+                yield
+        finally:
+            root_logger.handlers = previous_handlers
+            root_logger.setLevel(previous_level)
+
+
+# Resource profile of this worker process, set by _init_worker
+_worker_resource_profile = None
+
+
+def _init_worker(slot_counter, concurrent_runs: int, threads: int | None, pin: bool) -> None:
+    """
+    Initialise a worker process so its TotalSegmentator runs reuse loaded models
+    and stay within the worker's share of the CPU cores.
+
+    :param slot_counter: shared counter handing each worker a distinct slot
+    :param concurrent_runs: number of worker processes
+    :param threads: threads per worker, None to split the cores evenly
+    :param pin: pin each worker to its own cores
+    :rtype: None
+    """
+    global _worker_resource_profile
+    from inference_session import install_predictor_cache
+    from resource_profile import ResourceProfile
+
+    with slot_counter.get_lock():
+        slot = slot_counter.value
+        slot_counter.value += 1
+
+    install_predictor_cache()
+    _worker_resource_profile = ResourceProfile.auto(concurrent_runs, slot, pin, threads)
+
+
+def _result_cache(use_cache: bool, cache_dir: str | None):
+    if not use_cache:
+        return None
+    from result_cache import ResultCache
+    return ResultCache(cache_dir)
+
+
+def process_study(study_dir: str, task: str, fast: bool, log_dir: str, convert_only: bool = False,
+                  use_cache: bool = True, cache_dir: str | None = None,
+                  progress_log_path: str | None = None, nifti_output: str = "background") -> tuple[str, bool, str]:
+    """
+    Run the segmentation (or conversion only) workflow for a single study.
+    Executed inside a worker process.
+
+    :param study_dir:
+    :param task: TotalSegmentator task
+    :param fast: use TotalSegmentator's fastest mode
+    :param log_dir: directory receiving the per-study log
+    :param convert_only: only convert existing NIfTI segmentations
+    :param use_cache: restore and store results in the segmentation result cache
+    :param cache_dir: result cache directory, None for the default
+    :param progress_log_path: JSON-lines file receiving the progress events, None to not record them
+    :param nifti_output: how the NIfTI segmentations are written, see auto_segmentation.NIFTI_OUTPUT_MODES
+    :return: (study_dir, success, message)
+    """
+    # Imported here so the parent process never loads torch
+    from auto_segmentation import AutoSegmentation
+    from progress_events import JsonLinesProgressLog
+
+    log_path = _study_log_path(log_dir, study_dir)
+    errors = []
+
+    with _study_log(log_path):
+        auto_segmentation = AutoSegmentation(
+            resource_profile=_worker_resource_profile, result_cache=_result_cache(use_cache, cache_dir),
+            progress_log=JsonLinesProgressLog(progress_log_path) if progress_log_path else None,
+            nifti_output=nifti_output
+        )
+        auto_segmentation.signals.progress_updated.connect(print)
+        auto_segmentation.signals.error.connect(errors.append)
+
+        if convert_only:
+            success = auto_segmentation.run_conversion_workflow(study_dir)
+        else:
+            success = auto_segmentation.run_segmentation_workflow(study_dir, task, fast)
+
+    message = f"log: {log_path}" if success else f"{'; '.join(errors) or 'failed'} (log: {log_path})"
+    return study_dir, success, message
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Segment DICOM CT studies with TotalSegmentator and convert the results to RTSTRUCT, "
+                    "without the GUI."
+    )
+    parser.add_argument("studies", nargs="+",
+                        help="Study directories or glob patterns (quote globs to stop the shell expanding them)")
+    parser.add_argument("--task", default="total", help="TotalSegmentator task (default: total)")
+    parser.add_argument("--fast", action="store_true", help="Use the lower resolution fastest mode")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of studies processed concurrently (default: 1)")
+    parser.add_argument("--log-dir", default="logs", help="Directory for the per-study log files (default: logs)")
+    parser.add_argument("--convert-only", action="store_true",
+                        help="Only convert the existing NIfTI segmentations of each study to RTSTRUCT")
+    parser.add_argument("--force", action="store_true", help="Process studies even if their outputs are up to date")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="CPU threads per study (default: available cores split evenly between workers)")
+    parser.add_argument("--pin-cpus", action="store_true",
+                        help="Pin each worker to its own CPU cores so concurrent studies do not thrash each other")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Overlap staging and conversion with inference in one process instead of using "
+                             "worker processes; logs go to pipeline.log in the log directory")
+    parser.add_argument("--queue-size", type=int, default=1,
+                        help="Studies allowed to wait between pipeline stages (default: 1)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always run the inference instead of restoring results from the result cache")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Result cache directory (default: $ONKODICOM_RESULT_CACHE_DIR or "
+                             "~/OnkoDICOM/cache/segmentations)")
+    parser.add_argument("--progress-log", default=None,
+                        help="JSON-lines file receiving the progress events of every study, with units "
+                             "completed, throughput and ETA per stage (default: progress.jsonl in the log directory)")
+    parser.add_argument("--nifti-output", choices=("files", "background", "skip"), default="background",
+                        help="How the NIfTI segmentations are written: by TotalSegmentator and read back by the "
+                             "converter (files), alongside the conversion of the label map kept in memory "
+                             "(background), or not at all (skip) (default: background)")
+    parser.add_argument("--trace-dir", default=None,
+                        help="Directory receiving the timing spans of every study as JSON and Chrome trace "
+                             f"(default: ${TRACE_DIR_ENV})")
+    parser.add_argument("--profile", choices=("cprofile", "pyinstrument"), default=None,
+                        help=f"Profile every study and write the profile into the trace directory "
+                             f"(default: ${PROFILE_ENV})")
+    return parser
+
+
+def run_pipeline(study_dirs: list[str], task: str, fast: bool, log_dir: str, queue_size: int,
+                 resource_profile=None, result_cache=None, progress_log_path: str | None = None,
+                 nifti_output: str = "background") -> list[str]:
+    """
+    Segment the studies with the staged pipeline in this process.
+
+    :param study_dirs:
+    :param task: TotalSegmentator task
+    :param fast: use TotalSegmentator's fastest mode
+    :param log_dir: directory receiving pipeline.log
+    :param queue_size: studies allowed to wait between stages
+    :param resource_profile: ResourceProfile of the inference stage
+    :param result_cache: ResultCache shared by the studies, None to disable it
+    :param progress_log_path: JSON-lines file receiving the progress events, None to not record them
+    :param nifti_output: how the NIfTI segmentations are written, see auto_segmentation.NIFTI_OUTPUT_MODES
+    :return: list of studies which failed
+    """
+    from auto_segmentation import AutoSegmentation
+    from inference_session import install_predictor_cache
+    from progress_events import JsonLinesProgressLog
+    from segmentation_pipeline import SegmentationPipeline
+
+    log_path = os.path.join(log_dir, "pipeline.log")
+    progress_log = JsonLinesProgressLog(progress_log_path) if progress_log_path else None
+    with _study_log(log_path):
+        # Keep the nnU-Net models loaded from one study to the next
+        install_predictor_cache()
+        results = SegmentationPipeline(
+            queue_size=queue_size,
+            segmentation_factory=lambda: AutoSegmentation(resource_profile=resource_profile,
+                                                          result_cache=result_cache, progress_log=progress_log,
+                                                          nifti_output=nifti_output)
+        ).run(
+            [(study, task, fast) for study in study_dirs]
+        )
+
+    failed = []
+    for result in results:
+        if result.success:
+            logger.info(f"Finished {result.dicom_dir} (log: {log_path})")
+        else:
+            logger.error(f"Failed {result.dicom_dir} in {result.failed_stage}: "
+                         f"{'; '.join(result.errors) or 'failed'} (log: {log_path})")
+            failed.append(result.dicom_dir)
+    return failed
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    if args.pipeline and args.convert_only:
+        parser.error("--pipeline runs the segmentation, it cannot be combined with --convert-only")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    study_dirs = expand_study_dirs(args.studies)
+    if not args.force:
+        up_to_date = [study for study in study_dirs
+                      if is_study_up_to_date(study, args.convert_only, args.task, args.fast)]
+        for study in up_to_date:
+            logger.info(f"Skipping up to date study: {study}")
+        study_dirs = [study for study in study_dirs if study not in up_to_date]
+
+    if not study_dirs:
+        logger.info("No studies to process.")
+        return 0
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    log_dir = os.path.abspath(args.log_dir)
+    progress_log_path = os.path.abspath(args.progress_log or os.path.join(log_dir, "progress.jsonl"))
+    # The worker processes inherit the environment
+    if args.trace_dir:
+        os.environ[TRACE_DIR_ENV] = os.path.abspath(args.trace_dir)
+    if args.profile:
+        os.environ[PROFILE_ENV] = args.profile
+
+    if args.pipeline:
+        logger.info(f"Processing {len(study_dirs)} studies with the staged pipeline")
+        from resource_profile import ResourceProfile
+        resource_profile = ResourceProfile.auto(pin=args.pin_cpus, threads=args.threads)
+        failed = run_pipeline(study_dirs, args.task, args.fast, log_dir, args.queue_size, resource_profile,
+                              _result_cache(not args.no_cache, args.cache_dir), progress_log_path,
+                              args.nifti_output)
+        logger.info(f"Done: {len(study_dirs) - len(failed)} succeeded, {len(failed)} failed")
+        return 1 if failed else 0
+
+    failed = []
+
+    logger.info(f"Processing {len(study_dirs)} studies with {args.workers} workers")
+    # Each worker keeps its nnU-Net models loaded between the studies it processes
+    # and gets its own share of the CPU cores
+    workers = max(1, args.workers)
+    slot_counter = multiprocessing.Value("i", 0)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(slot_counter, workers, args.threads, args.pin_cpus)) as executor:
+        futures = {
+            executor.submit(process_study, study, args.task, args.fast, log_dir, args.convert_only,
+                            not args.no_cache, args.cache_dir, progress_log_path, args.nifti_output): study
+            for study in study_dirs
+        }
+        for future in as_completed(futures):
+            try:
+                study, success, message = future.result()
+            except Exception as e:
+                logger.exception(f"Worker process failed on {futures[future]}: {e}")
+                failed.append(futures[future])
+                continue
+
+            if success:
+                logger.info(f"Finished {study} ({message})")
+            else:
+                logger.error(f"Failed {study}: {message}")
+                failed.append(study)
+
+    logger.info(f"Done: {len(study_dirs) - len(failed)} succeeded, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Import times of the application's modules.
+
+Imports each module in a fresh interpreter with `python -X importtime` and
+reports its cumulative import time, together with the heaviest packages it
+pulls in, the best of several runs. Use it to check that main stays light:
+torch, TotalSegmentator, SimpleITK, rt_utils, scikit-image and SciPy should
+only be imported once they are needed.
+
+Usage:
+    python benchmarks/import_times.py
+    python benchmarks/import_times.py main auto_segment_tab --runs 5 --output import_times.json
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+DEFAULT_MODULES = ("main", "auto_segment_tab", "auto_segmentation", "dicom_viewer_tab", "nifti_converter")
+
+# "import time: self [us] | cumulative | imported package", nested imports are indented
+_IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def measure(module: str) -> dict:
+    """
+    Imports a module in a new interpreter.
+
+    :param module:
+    :return: {"total_ms": cumulative import time of the module,
+              "packages": {top level package: cumulative ms}}
+    """
+    environment = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                               cwd=REPO_DIR, env=environment, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr[-2000:]}")
+
+    total = None
+    packages = {}
+    for line in completed.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        name = match.group(4)
+        if name == module:
+            total = cumulative_ms
+        # Top level packages only, their time includes their submodules and dependencies
+        if "." not in name and name != module:
+            packages[name] = cumulative_ms
+    return {"total_ms": total, "packages": packages}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=list(DEFAULT_MODULES),
+                        help=f"Modules to import (default: {' '.join(DEFAULT_MODULES)})")
+    parser.add_argument("--runs", type=int, default=3, help="Imports of each module, the fastest counts (default: 3)")
+    parser.add_argument("--top", type=int, default=8, help="Heaviest packages listed per module (default: 8)")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for module in args.modules:
+        runs = [measure(module) for _ in range(max(1, args.runs))]
+        best = min(runs, key=lambda run: run["total_ms"] or 0)
+        results[module] = best
+
+        print(f"{module}: {best['total_ms']:.0f} ms")
+        heaviest = sorted(best["packages"].items(), key=lambda item: item[1], reverse=True)[:args.top]
+        for package, cumulative_ms in heaviest:
+            print(f"    {package:<28}{cumulative_ms:>8.0f} ms")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
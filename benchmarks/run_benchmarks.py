@@ -0,0 +1,411 @@
+"""Benchmarks of the viewer rendering and the RTSTRUCT conversion.
+
+Times, on synthetic studies (see synthetic_data), each at several CT sizes
+and numbers of structures:
+    update_display       scrolling the axial view of DicomViewer, with empty render caches
+    update_display_warm  the same scroll again, served from the render caches
+    load_segmentations   loading the NIfTI masks into DicomViewer
+    conversion           nifti_to_rtstruct_conversion of all masks
+    load_rtstruct        load_rtstruct_masks of the converted RTSTRUCT
+    open_rtstruct        opening the converted RTSTRUCT with RTStructMaskProvider, without rasterising
+
+Every case runs in a fresh process, so its peak RSS is its own. Qt uses
+the offscreen platform and everything runs on the CPU, no display, GPU or
+patient data is needed. The results are written as JSON together with the
+git commit and library versions, compare two result files to see the
+change between commits.
+
+Usage:
+    python benchmarks/run_benchmarks.py run --preset quick
+    python benchmarks/run_benchmarks.py run --sizes 512x512x300 --rois 10,50 --only conversion
+    python benchmarks/run_benchmarks.py compare benchmarks/results/<before>.json benchmarks/results/<after>.json
+"""
+import argparse
+import contextlib
+import importlib.metadata
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from instrumentation import peak_rss
+from synthetic_data import generate_ct, generate_masks, study_dir
+
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = ("update_display", "update_display_warm", "load_segmentations", "conversion", "load_rtstruct",
+              "open_rtstruct")
+
+# (columns, rows, slices) and numbers of structures of each preset
+PRESETS = {
+    "quick": ([(256, 256, 50)], [5]),
+    "standard": ([(512, 512, 100)], [10, 50]),
+    "full": ([(512, 512, 100), (512, 512, 300), (512, 512, 600)], [10, 50, 120]),
+}
+
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "onkodicom-benchmark-data")
+DEFAULT_RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+# Axial slices drawn by one scroll of the viewer
+SCROLL_FRAMES = 40
+# Size of the viewer window, the scaled pixmaps depend on it
+VIEWER_SIZE = (1000, 900)
+
+
+def parse_size(text: str) -> tuple[int, int, int]:
+    columns, rows, slices = (int(part) for part in text.lower().split("x"))
+    return columns, rows, slices
+
+
+def format_size(size: tuple[int, int, int]) -> str:
+    return "x".join(str(part) for part in size)
+
+
+class _ScriptedFileDialog:
+    """Stands in for QFileDialog in the viewer, answering with the benchmark's masks."""
+    files = []
+
+    @staticmethod
+    def getOpenFileNames(*args, **kwargs):
+        return list(_ScriptedFileDialog.files), ""
+
+
+def _viewer(ct_dir: str, mask_dir: str | None):
+    """
+    Returns a shown DicomViewer of the CT, with the masks of mask_dir loaded if given.
+    """
+    from PySide6.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+
+    import dicom_viewer_tab
+    dicom_viewer_tab.QFileDialog = _ScriptedFileDialog
+    _ScriptedFileDialog.files = sorted(os.path.join(mask_dir, name) for name in os.listdir(mask_dir)) \
+        if mask_dir else []
+
+    viewer = dicom_viewer_tab.DicomViewer(ct_dir)
+    viewer.resize(*VIEWER_SIZE)
+    viewer.show()
+    app.processEvents()
+    return viewer
+
+
+def _load_segmentations(viewer) -> None:
+    """
+    Loads the masks into the viewer, returning once every structure is listed.
+    """
+    from PySide6.QtWidgets import QApplication
+    viewer.load_segmentations()
+    while viewer.is_loading_structures():
+        QApplication.processEvents()
+        time.sleep(0.001)
+
+
+def _scroll(viewer) -> None:
+    """
+    Moves the axial slider over SCROLL_FRAMES slices spread over the volume, one frame per slice.
+    """
+    slices = viewer.ct_array.shape[0]
+    step = max(1, slices // SCROLL_FRAMES)
+    for index in range(0, slices, step)[:SCROLL_FRAMES]:
+        viewer.axial_slider.setValue(index)
+    # Leave the slider where the next scroll does not start, so its first frame is drawn as well
+    viewer.axial_slider.setValue(slices - 1)
+
+
+def _setup(benchmark: str, ct_dir: str, mask_dir: str, rtss_path: str, work_dir: str):
+    """
+    Prepares a benchmark and returns the function performing it once.
+    """
+    if benchmark in ("update_display", "update_display_warm"):
+        viewer = _viewer(ct_dir, mask_dir)
+        _load_segmentations(viewer)
+        if benchmark == "update_display_warm":
+            _scroll(viewer)
+
+        def run_once():
+            if benchmark == "update_display":
+                viewer.clear_render_caches()
+            viewer.frame_stats.reset()
+            _scroll(viewer)
+        run_once.viewer = viewer
+        return run_once
+
+    if benchmark == "load_segmentations":
+        viewer = _viewer(ct_dir, mask_dir)
+        return lambda: _load_segmentations(viewer)
+
+    if benchmark == "conversion":
+        from nifti_converter import nifti_to_rtstruct_conversion
+
+        def run_once():
+            output_dir = os.path.join(work_dir, "conversion")
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir)
+            nifti_to_rtstruct_conversion(mask_dir, ct_dir, os.path.join(output_dir, "rtss.dcm"))
+        return run_once
+
+    if benchmark == "load_rtstruct":
+        from rtstruct_loader import load_rtstruct_masks
+        return lambda: load_rtstruct_masks(rtss_path, ct_dir)
+
+    if benchmark == "open_rtstruct":
+        from rtstruct_loader import RTStructMaskProvider
+        return lambda: RTStructMaskProvider(rtss_path, ct_dir)
+
+    raise ValueError(f"Unknown benchmark {benchmark}")
+
+
+def _run_case(benchmark: str, size: tuple[int, int, int], roi_count: int, data_dir: str, repeats: int,
+              seed: int, trace_memory: bool) -> dict:
+    """
+    Runs one benchmark case, in its own process.
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    # Keep the progress output of the benchmarked code out of the results table
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("pydicom").setLevel(logging.ERROR)
+    sys.stdout = open(os.devnull, "w")
+    warnings.simplefilter("ignore", RuntimeWarning)
+
+    ct_dir = generate_ct(data_dir, size, seed)
+    mask_dir = generate_masks(data_dir, size, roi_count, seed)
+    rtss_path = os.path.join(study_dir(data_dir, size), f"rtss-{roi_count}", "rtss.dcm")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        run_once = _setup(benchmark, ct_dir, mask_dir, rtss_path, work_dir)
+        setup_peak = peak_rss()
+
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run_once()
+            times.append(time.perf_counter() - start)
+        peak = peak_rss()
+
+        result = {
+            "benchmark": benchmark,
+            "size": format_size(size),
+            "rois": roi_count,
+            "repeats": repeats,
+            "times_s": times,
+            "min_s": min(times),
+            "median_s": statistics.median(times),
+            "mean_s": statistics.fmean(times),
+            "peak_rss_mb": peak / 1024 ** 2 if peak is not None else None,
+            "rss_growth_mb": (peak - setup_peak) / 1024 ** 2 if peak is not None else None,
+        }
+
+        viewer = getattr(run_once, "viewer", None)
+        if viewer is not None:
+            stats = viewer.render_stats()
+            result["frame_mean_ms"] = stats["mean_ms"]
+            result["phases_mean_ms"] = {name: phase["mean_ms"] for name, phase in stats["phases"].items()}
+            result["cache_hit_rates"] = {name: cache["hit_rate"] for name, cache in stats["caches"].items()}
+
+        # Tracing allocations slows the code down, so it gets a run of its own
+        if trace_memory:
+            tracemalloc.start()
+            run_once()
+            result["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+    return result
+
+
+def _prepare_rtss(data_dir: str, size: tuple[int, int, int], roi_count: int, seed: int) -> None:
+    """
+    Converts the masks of a case once, as input of the load_rtstruct benchmark.
+    """
+    rtss_path = os.path.join(study_dir(data_dir, size), f"rtss-{roi_count}", "rtss.dcm")
+    if os.path.isfile(rtss_path):
+        return
+    from nifti_converter import nifti_to_rtstruct_conversion
+    ct_dir = generate_ct(data_dir, size, seed)
+    mask_dir = generate_masks(data_dir, size, roi_count, seed)
+    os.makedirs(os.path.dirname(rtss_path), exist_ok=True)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        nifti_to_rtstruct_conversion(mask_dir, ct_dir, rtss_path)
+
+
+def _estimated_memory(benchmark: str, size: tuple[int, int, int], roi_count: int) -> int:
+    """
+    Returns a rough estimate of the memory a case needs in bytes. The viewer
+    and load_rtstruct_masks hold every mask at once, the conversion one.
+    """
+    voxels = size[0] * size[1] * size[2]
+    ct = voxels * 2
+    if benchmark == "conversion":
+        return ct + voxels * 8
+    if benchmark == "open_rtstruct":
+        return 0
+    return ct + voxels * roi_count
+
+
+def _physical_memory() -> int | None:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _git(*args) -> str | None:
+    try:
+        return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metadata(seed: int) -> dict:
+    versions = {}
+    for distribution in ("numpy", "SimpleITK", "PySide6", "pydicom", "rt-utils", "scikit-image", "scipy"):
+        try:
+            versions[distribution] = importlib.metadata.version(distribution)
+        except importlib.metadata.PackageNotFoundError:
+            versions[distribution] = None
+    if versions["PySide6"] is None:
+        # Also installed as the PySide6-Essentials wheel
+        import PySide6
+        versions["PySide6"] = PySide6.__version__
+    status = _git("status", "--porcelain", "--untracked-files=no")
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(status) if status is not None else None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": seed,
+        "versions": versions,
+    }
+
+
+def run(args) -> int:
+    sizes, roi_counts = PRESETS[args.preset]
+    if args.sizes:
+        sizes = [parse_size(size) for size in args.sizes.split(",")]
+    if args.rois:
+        roi_counts = [int(count) for count in args.rois.split(",")]
+    benchmarks = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        logger.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+        return 2
+
+    memory_limit = args.max_memory * 1024 ** 3 if args.max_memory else (_physical_memory() or 0) * 0.75
+    # Child processes are spawned, so they start without the parent's Qt or ITK state
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    context = multiprocessing.get_context("spawn")
+
+    output = {"metadata": _metadata(args.seed), "results": []}
+    print(f"{'benchmark':<22}{'size':>14}{'rois':>6}{'median s':>11}{'min s':>9}{'peak MB':>10}")
+    for size in sizes:
+        for roi_count in roi_counts:
+            generate_masks(args.data_dir, size, roi_count, args.seed)
+            for benchmark in benchmarks:
+                estimate = _estimated_memory(benchmark, size, roi_count)
+                if memory_limit and estimate > memory_limit:
+                    print(f"{benchmark:<22}{format_size(size):>14}{roi_count:>6}  skipped, needs about "
+                          f"{estimate / 1024 ** 3:.1f} GB")
+                    output["results"].append({"benchmark": benchmark, "size": format_size(size),
+                                              "rois": roi_count, "skipped": "memory"})
+                    continue
+                if benchmark in ("load_rtstruct", "open_rtstruct"):
+                    _prepare_rtss(args.data_dir, size, roi_count, args.seed)
+
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(_run_case, benchmark, size, roi_count, args.data_dir,
+                                             args.repeats, args.seed, not args.no_tracemalloc).result()
+                output["results"].append(result)
+                print(f"{benchmark:<22}{result['size']:>14}{roi_count:>6}{result['median_s']:>11.3f}"
+                      f"{result['min_s']:>9.3f}{result['peak_rss_mb'] or 0:>10.0f}")
+
+    output_path = args.output
+    if output_path is None:
+        commit = (output["metadata"]["commit"] or "unknown")[:10]
+        output_path = os.path.join(DEFAULT_RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as file:
+        json.dump(output, file, indent=2)
+    print(f"Results written to {output_path}")
+    return 0
+
+
+def compare(args) -> int:
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    def by_case(results):
+        return {(result["benchmark"], result["size"], result["rois"]): result
+                for result in results["results"] if "skipped" not in result}
+
+    before_results, after_results = by_case(before), by_case(after)
+    print(f"before: {before['metadata'].get('commit')}  after: {after['metadata'].get('commit')}")
+    print(f"{'benchmark':<22}{'size':>14}{'rois':>6}{'before s':>11}{'after s':>10}{'change':>9}"
+          f"{'peak MB':>16}")
+    for case in sorted(before_results.keys() & after_results.keys()):
+        old, new = before_results[case], after_results[case]
+        change = new["median_s"] / old["median_s"] - 1 if old["median_s"] else 0.0
+        peaks = f"{old['peak_rss_mb'] or 0:.0f} -> {new['peak_rss_mb'] or 0:.0f}"
+        print(f"{case[0]:<22}{case[1]:>14}{case[2]:>6}{old['median_s']:>11.3f}{new['median_s']:>10.3f}"
+              f"{change:>+9.1%}{peaks:>16}")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks and write the results as JSON")
+    run_parser.add_argument("--preset", choices=sorted(PRESETS), default="standard",
+                            help="Sizes and numbers of structures to run (default: standard)")
+    run_parser.add_argument("--sizes", default=None,
+                            help="Comma separated CT sizes as COLUMNSxROWSxSLICES, replaces the preset's")
+    run_parser.add_argument("--rois", default=None,
+                            help="Comma separated numbers of structures, replaces the preset's")
+    run_parser.add_argument("--only", default=None,
+                            help=f"Comma separated benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    run_parser.add_argument("--repeats", type=int, default=3, help="Timed runs of each case (default: 3)")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data (default: 0)")
+    run_parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR,
+                            help=f"Directory keeping the generated studies (default: {DEFAULT_DATA_DIR})")
+    run_parser.add_argument("--output", default=None,
+                            help="Result file (default: benchmarks/results/<time>-<commit>.json)")
+    run_parser.add_argument("--max-memory", type=float, default=None,
+                            help="Skip cases estimated to need more GB than this (default: 75%% of the RAM)")
+    run_parser.add_argument("--no-tracemalloc", action="store_true",
+                            help="Skip the extra run measuring the peak of traced Python allocations")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser("compare", help="Compare the medians of two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.set_defaults(handler=compare)
+    return parser
+
+
+def main(argv=None) -> int:
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    logging.getLogger("pydicom").setLevel(logging.ERROR)
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""Synthetic studies for the benchmarks.
+
+Generates a CT series of a given size (an elliptical body phantom with
+noise, written as DICOM) and any number of NIfTI structure masks on its
+grid (ellipsoids inside the body), without real patient data. The data
+depends only on the size, the number of structures and the seed, so runs on
+different commits see identical inputs. Generated studies are kept in the
+data directory and reused.
+
+Layout of a study in the data directory:
+    <columns>x<rows>x<slices>/ct/            CT series, one file per slice
+    <columns>x<rows>x<slices>/rois-<n>/      roi_001.nii.gz ... roi_<n>.nii.gz
+"""
+import datetime
+import os
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+PIXEL_SPACING = 0.9765625  # 500 mm field of view over 512 pixels
+SLICE_THICKNESS = 2.5
+RESCALE_INTERCEPT = -1024
+
+# Fixed prefix, so the UIDs of a synthetic study are the same on every machine
+_UID_PREFIX = "1.2.826.0.1.3680043.10.1457."
+
+
+def _uid(*parts) -> str:
+    return generate_uid(prefix=_UID_PREFIX, entropy_srcs=[str(part) for part in parts])
+
+
+def study_dir(data_dir: str, size: tuple[int, int, int]) -> str:
+    columns, rows, slices = size
+    return os.path.join(data_dir, f"{columns}x{rows}x{slices}")
+
+
+def _phantom_slice(rows: int, columns: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Returns the stored pixel values of one slice: an elliptical body of
+    soft tissue around a spine-like bone, in air, with noise.
+    """
+    y, x = np.ogrid[:rows, :columns]
+    cy, cx = rows / 2, columns / 2
+    body = ((y - cy) / (rows * 0.35)) ** 2 + ((x - cx) / (columns * 0.45)) ** 2 <= 1
+    bone = ((y - cy * 1.35) / (rows * 0.05)) ** 2 + ((x - cx) / (columns * 0.05)) ** 2 <= 1
+
+    hounsfield = np.full((rows, columns), -1000.0)
+    hounsfield[body] = 40
+    hounsfield[bone] = 700
+    hounsfield += rng.normal(0, 20, (rows, columns))
+    return np.clip(hounsfield - RESCALE_INTERCEPT, 0, 4095).astype(np.uint16)
+
+
+def generate_ct(data_dir: str, size: tuple[int, int, int], seed: int = 0) -> str:
+    """
+    Writes the synthetic CT series of the given size, unless it already exists.
+
+    :param data_dir:
+    :param size: (columns, rows, slices)
+    :param seed:
+    :return: directory of the series
+    """
+    columns, rows, slices = size
+    ct_dir = os.path.join(study_dir(data_dir, size), "ct")
+    if os.path.isdir(ct_dir) and len(os.listdir(ct_dir)) == slices:
+        return ct_dir
+    os.makedirs(ct_dir, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    study_uid = _uid("study", size, seed)
+    series_uid = _uid("series", size, seed)
+    frame_uid = _uid("frame", size, seed)
+    today = datetime.date(2024, 1, 1).strftime("%Y%m%d")
+
+    for index in range(slices):
+        sop_uid = _uid("image", size, seed, index)
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = sop_uid
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = sop_uid
+        ds.Modality = "CT"
+        ds.PatientName = "Synthetic^Phantom"
+        ds.PatientID = "SYNTHETIC"
+        ds.PatientBirthDate = ""
+        ds.PatientSex = "O"
+        ds.StudyDate = ds.SeriesDate = ds.ContentDate = today
+        ds.StudyTime = ds.SeriesTime = ds.ContentTime = "120000"
+        ds.AccessionNumber = ""
+        ds.ReferringPhysicianName = ""
+        ds.StudyID = "1"
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = index + 1
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_uid
+        ds.PositionReferenceIndicator = ""
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [-columns * PIXEL_SPACING / 2, -rows * PIXEL_SPACING / 2,
+                                   index * SLICE_THICKNESS]
+        ds.SliceLocation = index * SLICE_THICKNESS
+        ds.SliceThickness = SLICE_THICKNESS
+        ds.PixelSpacing = [PIXEL_SPACING, PIXEL_SPACING]
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.RescaleIntercept = RESCALE_INTERCEPT
+        ds.RescaleSlope = 1
+        ds.PixelData = _phantom_slice(rows, columns, rng).tobytes()
+        ds.save_as(os.path.join(ct_dir, f"ct.{index}.dcm"), enforce_file_format=True)
+
+    return ct_dir
+
+
+def generate_masks(data_dir: str, size: tuple[int, int, int], roi_count: int, seed: int = 0) -> str:
+    """
+    Writes roi_count ellipsoid masks on the grid of the synthetic CT of the
+    given size as NIfTI files, unless they already exist.
+
+    :param data_dir:
+    :param size: (columns, rows, slices)
+    :param roi_count:
+    :param seed:
+    :return: directory of the masks
+    """
+    columns, rows, slices = size
+    mask_dir = os.path.join(study_dir(data_dir, size), f"rois-{roi_count}")
+    if os.path.isdir(mask_dir) and len(os.listdir(mask_dir)) == roi_count:
+        return mask_dir
+    os.makedirs(mask_dir, exist_ok=True)
+
+    ct_dir = generate_ct(data_dir, size, seed)
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(ct_dir))
+    reader.MetaDataDictionaryArrayUpdateOff()
+    reference = reader.Execute()
+
+    rng = np.random.default_rng(seed + roi_count)
+    for number in range(1, roi_count + 1):
+        # Radii in voxels, between a small node and an organ
+        radii = rng.uniform(0.02, 0.12, 3) * np.array([slices * 1.5, rows * 0.7, columns * 0.7])
+        radii = np.maximum(radii, 2)
+        # Centres inside the body phantom, the ellipsoid may be cut by the volume's ends
+        angle, distance = rng.uniform(0, 2 * np.pi), np.sqrt(rng.uniform(0, 1)) * 0.6
+        centre = np.array([rng.uniform(0, slices),
+                           rows / 2 + np.sin(angle) * distance * rows * 0.35,
+                           columns / 2 + np.cos(angle) * distance * columns * 0.45])
+
+        mask = np.zeros((slices, rows, columns), dtype=np.uint8)
+        low = np.maximum(np.floor(centre - radii), 0).astype(int)
+        high = np.minimum(np.ceil(centre + radii) + 1, mask.shape).astype(int)
+        z, y, x = np.ogrid[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+        inside = ((z - centre[0]) / radii[0]) ** 2 + ((y - centre[1]) / radii[1]) ** 2 \
+            + ((x - centre[2]) / radii[2]) ** 2 <= 1
+        mask[low[0]:high[0], low[1]:high[1], low[2]:high[2]] = inside
+
+        image = sitk.GetImageFromArray(mask)
+        image.CopyInformation(reference)
+        sitk.WriteImage(image, os.path.join(mask_dir, f"roi_{number:03d}.nii.gz"))
+
+    return mask_dir
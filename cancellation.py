@@ -0,0 +1,66 @@
+import threading
+
+
+class SegmentationCancelled(Exception):
+    """Raised inside the segmentation workflow once its job has been cancelled."""
+
+
+class CancellationToken:
+    """Cooperative cancellation flag shared by a job and whoever may cancel it.
+
+    The workflow polls raise_if_cancelled() between units of work, e.g.
+    between copied files or converted structures. Work which cannot poll,
+    such as TotalSegmentator running in an inference session process,
+    registers a callback that interrupts it when cancel() is called.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """
+        Request cancellation and run the registered callbacks. Calling it
+        again has no further effect.
+
+        :rtype: None
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks)
+
+        for callback in callbacks:
+            callback()
+
+    def raise_if_cancelled(self) -> None:
+        """
+        :raises SegmentationCancelled: if cancellation was requested
+        """
+        if self._event.is_set():
+            raise SegmentationCancelled()
+
+    def add_callback(self, callback) -> None:
+        """
+        Register a function called on cancellation, straight away if the
+        token is already cancelled.
+
+        :param callback: function taking no arguments
+        :rtype: None
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
@@ -1,11 +1,17 @@
 import os
+from collections import OrderedDict
+
 import numpy as np
 import SimpleITK as sitk
 from PySide6.QtGui import QImage, QPixmap, QPolygonF, QColor, QPainter, QPen, QBrush
 from skimage import measure
 from scipy.ndimage import gaussian_filter1d
 from StyleSheetReader import StyleSheetReader
-from rtstruct_loader import load_rtstruct_masks
+from rtstruct_loader import RTStructMaskProvider
+from series_decoder import read_series
+from series_index import series_files
+from instrumentation import FrameStats
+from multithread import Task
 import logging
 
 from PySide6.QtWidgets import (
@@ -14,22 +20,87 @@ from PySide6.QtWidgets import (
     QLabel
 )
 
-from PySide6.QtCore import Qt, QSize, QPointF
+from PySide6.QtCore import Qt, QSize, QPointF, QThreadPool, QTimer, Signal
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 import random
 
+# Normalised CT slices kept for redrawing, across the three views
+SLICE_CACHE_SIZE = 96
+# Smoothed contours kept for redrawing, one entry per structure, view and slice
+CONTOUR_CACHE_SIZE = 1024
+
 # Helper function to generate contour colors
 def generate_random_rgba(alpha=120):
     return tuple(random.randint(0, 255) for _ in range(3)) + (alpha,)
 
+
+class _LRUCache:
+    """Least recently used cache which counts its hits and misses."""
+
+    def __init__(self, max_items: int) -> None:
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        """
+        :return: the cached value, None on a miss
+        """
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def discard(self, predicate) -> None:
+        """
+        Removes the items whose key matches predicate.
+        """
+        for key in [key for key in self._items if predicate(key)]:
+            del self._items[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "items": len(self._items),
+                "hit_rate": self.hits / lookups if lookups else None}
+
+
+class _LabelMask:
+    """One structure of a label map on the CT grid, compared with its label slice by slice."""
+
+    def __init__(self, label_map: np.ndarray, label: int) -> None:
+        self.label_map = label_map
+        self.label = label
+
+
 class DicomViewer(QWidget):
-    def __init__(self, dicom_dir: str) -> None:
+    # Emitted once the DICOM image set is shown, or with the error if it could not be read
+    dicom_loaded = Signal()
+    dicom_load_failed = Signal(str)
+
+    def __init__(self, dicom_dir: str, load_async: bool = False) -> None:
         """Initialize the DICOM viewer.
 
         Sets up the UI, loads the DICOM image set, and prepares for segmentation overlays.
+        With load_async the image set is read on a pool thread and the views are
+        drawn once it arrives, so the viewer can be shown straight away.
         """
         super().__init__()
         self.setWindowTitle("DICOM Segmentation Viewer")
@@ -84,9 +155,39 @@ class DicomViewer(QWidget):
             (255, 0, 255, 120),  # Magenta
             (0, 255, 255, 120),  # Cyan
         ]
+        # Masks of the segmentations, None for structures the mask provider rasterises when shown,
+        # _LabelMask for structures of a label map shown by show_label_overlay
         self.seg_arrays = []
         self.seg_names = []
         self.spacing = []
+        self.mask_provider: RTStructMaskProvider | None = None
+
+        # Rendering statistics, see render_stats()
+        self.frame_stats = FrameStats()
+        self._slice_cache = _LRUCache(SLICE_CACHE_SIZE)
+        self._contour_cache = _LRUCache(CONTOUR_CACHE_SIZE)
+
+        # Structures waiting to be listed, one per event loop turn, see _queue_structures
+        self._pending_structures = []
+        self._overlay_timer = QTimer(self)
+        self._overlay_timer.setInterval(0)
+        self._overlay_timer.timeout.connect(self._show_next_structure)
+        # Coalesces the redraws of structures listed in quick succession
+        self._redraw_timer = QTimer(self)
+        self._redraw_timer.setSingleShot(True)
+        self._redraw_timer.setInterval(100)
+        self._redraw_timer.timeout.connect(self.update_display)
+        # Files being read on the pool, and the count of clears, which drops their results
+        self._structure_tasks = []
+        self._load_generation = 0
+
+        # Overlay showing the rendering statistics on the axial view
+        self.render_hud = QLabel(self.canvas_axial)
+        self.render_hud.setStyleSheet(
+            "background-color: rgba(0, 0, 0, 170); color: white; font-family: monospace; padding: 4px;")
+        self.render_hud.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.render_hud.move(4, 4)
+        self.render_hud.hide()
 
         # Layouts
         main_layout = QVBoxLayout()
@@ -127,11 +228,33 @@ class DicomViewer(QWidget):
         self.btn_load_seg.setStyleSheet(self.style_sheet())
         self.btn_load_seg.clicked.connect(self.load_segmentations)
         btn_layout.addWidget(self.btn_load_seg)
+        self.render_stats_checkbox = QCheckBox("Show Render Stats")
+        self.render_stats_checkbox.setStyleSheet(self.style_sheet())
+        self.render_stats_checkbox.toggled.connect(self.set_render_hud_visible)
+        btn_layout.addWidget(self.render_stats_checkbox)
         main_layout.addLayout(btn_layout)
         self.setLayout(main_layout)
 
         # Load dicom image set
-        self.load_dicom()
+        self._load_task = None
+        if load_async:
+            self.load_dicom_async()
+        else:
+            self.load_dicom()
+
+    @staticmethod
+    def read_dicom_series(folder: str) -> tuple:
+        """
+        Reads the image set of a dicom directory. Safe to call from any thread.
+        :param folder: dicom directory
+        :return: (spacing, LPS orientated pixel array in (z, y, x) order)
+        """
+        # Compressed series are decoded on several processes
+        image = read_series(series_files(folder))
+
+        spacing = image.GetSpacing()
+        image = sitk.DICOMOrient(image, 'LPS')
+        return spacing, sitk.GetArrayFromImage(image)  # (z, y, x) format
 
     def load_dicom(self):
         """
@@ -143,28 +266,53 @@ class DicomViewer(QWidget):
             logger.error("No DICOM directory specified")
             return
 
-        reader = sitk.ImageSeriesReader()
-        dicom_names = reader.GetGDCMSeriesFileNames(folder)
-        reader.SetFileNames(dicom_names)
-        image = reader.Execute()
+        self._show_dicom(self.read_dicom_series(folder))
 
-        self.spacing = image.GetSpacing()
-        image = sitk.DICOMOrient(image, 'LPS')
-        self.ct_array = sitk.GetArrayFromImage(image)  # (z, y, x) format
+    def load_dicom_async(self) -> None:
+        """
+        Loads the image set from the selected dicom directory on a pool thread,
+        showing a loading message until it has been read.
+        :return: None
+        """
+        folder = self.dicom_dir
+        if not folder:
+            logger.error("No DICOM directory specified")
+            return
+
+        self.canvas_axial.setText("Loading DICOM series...")
+        self.btn_load_seg.setEnabled(False)
+
+        # Created on the GUI thread, so the result is delivered here
+        self._load_task = Task(self.read_dicom_series, folder)
+        self._load_task.signals.result.connect(self._show_dicom)
+        self._load_task.signals.error.connect(self._on_dicom_load_failed)
+        QThreadPool.globalInstance().start(self._load_task)
+
+    def _show_dicom(self, series: tuple) -> None:
+        self._load_task = None
+        self.spacing, self.ct_array = series
+        self._slice_cache.clear()
+        self.btn_load_seg.setEnabled(True)
 
         self.update_display()
         # self.load_rtstruct()
 
         # Generate colors array
         self.seg_colors = [generate_random_rgba() for _ in range(len(self.ct_array))]
+        self.dicom_loaded.emit()
+
+    def _on_dicom_load_failed(self, message: str) -> None:
+        self._load_task = None
+        self.canvas_axial.setText(f"Failed to load DICOM series:\n{message}")
+        self.dicom_load_failed.emit(message)
 
     def load_segmentations(self) -> None:
         """
         Load NIfTI segmentation files.
 
-        Opens a file dialog to select multiple NIfTI segmentation files,
-        reads them using SimpleITK, and stores them for display.
-        It also creates checkboxes for each segmentation file to control visibility.
+        Opens a file dialog to select multiple NIfTI segmentation files. The files
+        are read using SimpleITK on pool threads, and each segmentation is listed
+        with a checkbox controlling its visibility as soon as it has been read.
 
         """
 
@@ -175,23 +323,29 @@ class DicomViewer(QWidget):
         # Clear the previously loaded segmentations
         self._clear_previous_loaded_segments()
 
-        # Iterate over the segmentation files load, add check box, and display
+        # Read each file on the pool, it is listed as soon as it arrives
         for file_path in files:
-            seg_image = sitk.ReadImage(file_path)
-            seg_image = sitk.DICOMOrient(seg_image, 'LPS')
-            seg_array = sitk.GetArrayFromImage(seg_image).astype(bool)
-            self.seg_arrays.append(seg_array)
-            self.seg_names.append(os.path.basename(file_path))
-            # self.seg_colors.append(base_colors(i))
+            self._start_structure_task(self.read_segmentation_file, file_path, self._load_generation,
+                                       result=self._queue_segmentation_file)
 
-            checkbox = QCheckBox(os.path.basename(file_path))
-            checkbox.setChecked(True)
-            checkbox.stateChanged.connect(self.update_display)
-            self.overlay_checkboxes.append(checkbox)
-            self.overlay_visibility.append(True)
-            self.checkbox_container.addWidget(checkbox)
+    @staticmethod
+    def read_segmentation_file(file_path: str, generation: int) -> tuple:
+        """
+        Reads a NIfTI segmentation as a mask in the viewer's orientation. Safe to call from any thread.
+        :param file_path:
+        :param generation: passed back, to drop files read for segmentations since cleared
+        :return: (generation, name, (z, y, x) bool mask)
+        """
+        seg_image = sitk.ReadImage(file_path)
+        seg_image = sitk.DICOMOrient(seg_image, 'LPS')
+        # Converted straight from the image's buffer, without an intermediate copy
+        seg_array = sitk.GetArrayViewFromImage(seg_image).astype(bool)
+        return generation, os.path.basename(file_path), seg_array
 
-        self.update_display()
+    def _queue_segmentation_file(self, loaded: tuple) -> None:
+        generation, name, seg_array = loaded
+        if generation == self._load_generation:
+            self._queue_structures([(name, seg_array, name, True)], visible=True)
 
     def load_rtstruct(self):
         # rtstruct_path, _ = QFileDialog.getOpenFileName(self, "Select RTSTRUCT File", filter="*.dcm")
@@ -204,34 +358,160 @@ class DicomViewer(QWidget):
 
         rtstruct_path = os.path.join(self.dicom_dir, "rtss.dcm")
 
-        mask_dict = load_rtstruct_masks(rtstruct_path, self.dicom_dir)
+        # Only the structure names and contour index are read here, a structure's
+        # mask is rasterised when its checkbox is first ticked
+        mask_provider = RTStructMaskProvider(rtstruct_path, self.dicom_dir)
 
         # Clear the previously loaded segmentations
         self._clear_previous_loaded_segments()
+        self.mask_provider = mask_provider
 
         # base_colors = plt.colormaps['tab20']
 
-        for name, mask in mask_dict.items():
-            self.seg_arrays.append(mask.astype(bool))
+        for name in mask_provider.names:
+            self.seg_arrays.append(None)
             self.seg_names.append(name)
             # self.seg_colors.append(base_colors(i))
 
             checkbox = QCheckBox(name)
-            checkbox.setChecked(True)
+            checkbox.setChecked(False)
             checkbox.stateChanged.connect(self.update_display)
             self.overlay_checkboxes.append(checkbox)
-            self.overlay_visibility.append(True)
+            self.overlay_visibility.append(False)
             self.checkbox_container.addWidget(checkbox)
 
         self.update_display()
 
-    #TODO: Refactor the following function into smaller helper functions
+    def load_rtstruct_async(self) -> None:
+        """
+        Lists the structures of the study's rtss.dcm which are not shown yet,
+        reading the file on a pool thread. Structures already listed, e.g. from
+        a label overlay of the same run, are kept.
+        """
+        rtstruct_path = os.path.join(self.dicom_dir, "rtss.dcm")
+        if not os.path.isfile(rtstruct_path):
+            return
+        self._start_structure_task(self.open_rtstruct, rtstruct_path, self.dicom_dir, self._load_generation,
+                                   result=self._queue_rtstruct_structures)
+
+    @staticmethod
+    def open_rtstruct(rtstruct_path: str, dicom_dir: str, generation: int) -> tuple:
+        """
+        Reads the structure names and contour index of an RTSTRUCT. Safe to call from any thread.
+        :return: (generation, RTStructMaskProvider)
+        """
+        return generation, RTStructMaskProvider(rtstruct_path, dicom_dir)
+
+    def _queue_rtstruct_structures(self, loaded: tuple) -> None:
+        generation, mask_provider = loaded
+        if generation != self._load_generation:
+            return
+        # Structures listed earlier from the same file are drawn by the newer provider
+        self.mask_provider = mask_provider
+        self._queue_structures([(name, None, name, False) for name in mask_provider.names], visible=False)
+
+    def _start_structure_task(self, fn, *args, result) -> None:
+        """
+        Runs fn on the pool, passing its return value to result on this thread.
+        """
+        # Created on the GUI thread so the result is delivered here, kept until it arrives
+        task = Task(fn, *args)
+        task.signals.result.connect(result)
+        task.signals.result.connect(self._structure_task_done)
+        task.signals.error.connect(self._structure_task_failed)
+        self._structure_tasks.append(task)
+        QThreadPool.globalInstance().start(task)
+
+    def _structure_task_done(self, *_) -> None:
+        self._structure_tasks = [task for task in self._structure_tasks if task.signals is not self.sender()]
+
+    def _structure_task_failed(self, message: str) -> None:
+        logger.error(f"Failed to load segmentation: {message}")
+        self._structure_task_done()
+
+    def show_label_overlay(self, overlay) -> None:
+        """Show the structures of a label map segmented for this study.
+
+        Structures already listed are replaced in place, keeping their checkbox
+        state, others are added unchecked. One structure is shown per turn of
+        the event loop, so a full resolution segmentation replaces its preview
+        structure by structure while the viewer stays responsive.
+
+        :param overlay: label_volume.LabelOverlay on the LPS orientated CT grid
+        """
+        if self.ct_array is not None and overlay.label_map.shape != self.ct_array.shape:
+            logger.warning(f"Segmentation grid {overlay.label_map.shape} does not match the image set "
+                           f"{self.ct_array.shape}, not shown")
+            return
+
+        self._queue_structures([
+            (name, _LabelMask(overlay.label_map, label), f"{name} (preview)" if overlay.preview else name, True)
+            for label, name in sorted(overlay.labels.items(), key=lambda item: item[1])
+        ], visible=False)
+
+    def _queue_structures(self, structures: list[tuple], visible: bool) -> None:
+        """
+        Queues structures to be listed one per turn of the event loop.
+        :param structures: (name, mask source, checkbox text, whether it replaces a listed structure)
+        :param visible: whether new structures are shown straight away
+        """
+        # A newer source of a structure supersedes the one still waiting
+        names = {structure[0] for structure in structures}
+        self._pending_structures = [item for item in self._pending_structures if item[0][0] not in names]
+        self._pending_structures.extend((structure, visible) for structure in structures)
+        self._overlay_timer.start()
+
+    def _show_next_structure(self) -> None:
+        """
+        Lists the next structure waiting from _queue_structures, redrawing the views if it is visible.
+        """
+        if not self._pending_structures:
+            self._overlay_timer.stop()
+            return
+
+        (name, source, text, replace), visible = self._pending_structures.pop(0)
+        if name in self.seg_names:
+            if not replace:
+                return
+            seg_index = self.seg_names.index(name)
+            self.seg_arrays[seg_index] = source
+            self._contour_cache.discard(lambda key: key[0] == seg_index)
+            checkbox = self.overlay_checkboxes[seg_index]
+            checkbox.setText(text)
+            if checkbox.isChecked():
+                self._schedule_redraw()
+            return
+
+        self.seg_arrays.append(source)
+        self.seg_names.append(name)
+        checkbox = QCheckBox(text)
+        checkbox.setChecked(visible)
+        checkbox.stateChanged.connect(self.update_display)
+        self.overlay_checkboxes.append(checkbox)
+        self.overlay_visibility.append(visible)
+        self.checkbox_container.addWidget(checkbox)
+        if visible:
+            self._schedule_redraw()
+
+    def is_loading_structures(self) -> bool:
+        """
+        Whether structures are still being read or waiting to be listed.
+        """
+        return bool(self._structure_tasks or self._pending_structures)
+
+    def _schedule_redraw(self) -> None:
+        """
+        Redraws the views shortly, once for the structures listed meanwhile.
+        """
+        if not self._redraw_timer.isActive():
+            self._redraw_timer.start()
+
     def update_display(self):
         """Update the display with the current slice and segmentation overlays.
 
         Updates the axial, coronal, and sagittal views with the current slice
         selected by the sliders. It overlays segmentations based on their visibility
-        settings.
+        settings. Each call is timed as a frame of self.frame_stats, see render_stats().
         """
 
         if self.ct_array is None:
@@ -248,172 +528,185 @@ class DicomViewer(QWidget):
         self.coronal_slider.setMaximum(coronal_max_idx)
         self.sagittal_slider.setMaximum(sagittal_max_idx)
 
-        # Get axial base slice and aspect ratio
-        axial_base_slice = self.ct_array[self.axial_slider.value(), :, :]
-        # aspect refers to spacing between rows / spacing between columns
-        axial_pix_aspect = self.spacing[1] / self.spacing[0]
-
-        # Clip negative values in array, normalise, and create pixel array (0 - 255)
-        axial_norm = np.clip(axial_base_slice, 0, np.percentile(axial_base_slice, 99))
-        axial_norm = ((axial_norm - axial_norm.min()) / (axial_norm.ptp()) * 255).astype(np.uint8)
-
-        # Get axial data for pixmap conversion
-        axial_height, axial_width = axial_norm.shape
-        bytes_per_line = axial_width
-
-        # Convert image to QPixmap
-        axial_q_image = QImage(axial_norm.data, axial_width, axial_height, bytes_per_line, QImage.Format.Format_Grayscale8)
-        axial_pixmap = QPixmap.fromImage(axial_q_image)
-
-        # Get Coronal base slice and aspect ratio
-        coronal_base_slice = np.rot90(self.ct_array[:, self.coronal_slider.value(), :], 2)
-        coronal_pix_aspect = self.spacing[2] / self.spacing[0]
-
-        # Clip negative values in array, normalise, and create pixel array (0 - 255)
-        coronal_norm = np.clip(coronal_base_slice, 0, np.percentile(coronal_base_slice, 99))
-        coronal_norm = ((coronal_norm - coronal_norm.min()) / (coronal_norm.ptp()) * 255).astype(np.uint8)
-
-        # Get QImage Data
-        coronal_height, coronal_width = coronal_norm.shape
-        bytes_per_line = coronal_width
-
-        # Convert image to QPixmap
-        coronal_q_image = QImage(coronal_norm.data, coronal_width, coronal_height, bytes_per_line,
-                               QImage.Format.Format_Grayscale8)
-        coronal_pixmap = QPixmap.fromImage(coronal_q_image)
-
-        # Get Sagittal base slice and aspect ratio
-        sagittal_base_slice = np.rot90(self.ct_array[:, :, self.sagittal_slider.value()], 2)
-        sagittal_pix_aspect = self.spacing[2] / self.spacing[1]
-
-        sagittal_norm = np.clip(sagittal_base_slice, 0, np.percentile(sagittal_base_slice, 99))
-        sagittal_norm = ((sagittal_norm - sagittal_norm.min()) / (sagittal_norm.ptp()) * 255).astype(np.uint8)
-
-        # Get axial data for pixmap conversion
-        sagittal_height, sagittal_width = sagittal_norm.shape
-        bytes_per_line = sagittal_width
-
-        # Convert image to QPixmap
-        sagittal_q_image = QImage(sagittal_norm.data, sagittal_width, sagittal_height, bytes_per_line,
-                               QImage.Format.Format_Grayscale8)
-        sagittal_pixmap = QPixmap.fromImage(sagittal_q_image)
-
-        for i, seg_array in enumerate(self.seg_arrays):
-            visible = self.overlay_checkboxes[i].isChecked()
-            if not visible:
-                continue
-
-            # rgba_colors = self.seg_colors[i]  # (R, G, B, A)
-
-            mask_slice_axial = seg_array[self.axial_slider.value(), :, :].astype(float)
-            mask_slice_coronal = np.rot90(seg_array[:, self.coronal_slider.value(), :].astype(float), 2)
-            mask_slice_sagittal = np.rot90(seg_array[:, :, self.sagittal_slider.value()].astype(float), 2)
-
-            # Find contours at mask boundary 0.5
-            axial_contours = measure.find_contours(mask_slice_axial, 0.5)
-            coronal_contours = measure.find_contours(mask_slice_coronal, 0.5)
-            sagittal_contours = measure.find_contours(mask_slice_sagittal, 0.5)
-
-            # Start painting on top of axial pixmap
-            painter = QPainter(axial_pixmap)
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-
-            # Smooth and then draw/display axial contour
-            for contour in axial_contours:
-                # Smooth contour coordinates
-                x = contour[:, 1]
-                y = contour[:, 0]
-
-                # Gaussian smoothing
-                x_smooth = gaussian_filter1d(x, sigma=0.8)
-                y_smooth = gaussian_filter1d(y, sigma=1.3)
-
-                # Draw filled polygon with transparency
-                axial_poly = QPolygonF()
-                for px, py in zip(x_smooth, y_smooth):
-                    axial_poly.append(QPointF(px, py))
-
-                # Draw filled polygon with transparency
-                color = QColor(255, 0, 0, 120)
-                painter.setPen(QPen(color, 1.0))
-                painter.setBrush(QBrush(color))
-                painter.drawPolygon(axial_poly)
-
-            painter.end()
+        visible = [i for i, checkbox in enumerate(self.overlay_checkboxes) if checkbox.isChecked()]
+        with self.frame_stats.frame(shape=self.ct_array.shape, structures=len(visible)):
+            for view, canvas, slider in (("axial", self.canvas_axial, self.axial_slider),
+                                         ("coronal", self.canvas_coronal, self.coronal_slider),
+                                         ("sagittal", self.canvas_sagittal, self.sagittal_slider)):
+                index = slider.value()
+                pixmap = self._slice_pixmap(view, index)
+                if visible:
+                    self._draw_contours(pixmap, view, index, visible)
+
+                # Display final painted pixmap
+                with self.frame_stats.phase("scaling"):
+                    canvas.setPixmap(pixmap.scaled(
+                        canvas.width(), canvas.height(),
+                        aspectMode=Qt.AspectRatioMode.IgnoreAspectRatio, mode=Qt.SmoothTransformation
+                    ))
+
+        self._update_render_hud()
+
+    @staticmethod
+    def _view_slice(array: np.ndarray, view: str, index: int) -> np.ndarray:
+        """
+        Returns the slice of a (z, y, x) volume shown by a view, coronal and
+        sagittal slices rotated so the head is at the top.
+        """
+        if view == "axial":
+            return array[index, :, :]
+        if view == "coronal":
+            return np.rot90(array[:, index, :], 2)
+        return np.rot90(array[:, :, index], 2)
 
-            # Start painting on top of coronal pixmap
-            painter = QPainter(coronal_pixmap)
+    def _slice_pixmap(self, view: str, index: int) -> QPixmap:
+        """
+        Returns a new pixmap of the normalised CT slice shown by a view.
+        """
+        normalised = self._slice_cache.get((view, index))
+        if normalised is None:
+            with self.frame_stats.phase("normalise"):
+                base_slice = self._view_slice(self.ct_array, view, index)
+                # Clip negative values in array, normalise, and create pixel array (0 - 255)
+                normalised = np.clip(base_slice, 0, np.percentile(base_slice, 99))
+                normalised = ((normalised - normalised.min()) / np.ptp(normalised) * 255).astype(np.uint8)
+            self._slice_cache.put((view, index), normalised)
+
+        with self.frame_stats.phase("pixmap"):
+            height, width = normalised.shape
+            q_image = QImage(normalised.data, width, height, width, QImage.Format.Format_Grayscale8)
+            return QPixmap.fromImage(q_image)
+
+    def _smoothed_contours(self, seg_index: int, view: str, index: int) -> list:
+        """
+        Returns the smoothed (x, y) outlines of a segmentation on the slice shown by a view.
+        """
+        contours = self._contour_cache.get((seg_index, view, index))
+        if contours is not None:
+            return contours
+
+        if view == "axial" and self.seg_arrays[seg_index] is None:
+            # Structures loaded from an RTSTRUCT are drawn from their stored
+            # contours, without rasterising the structure's mask
+            with self.frame_stats.phase("contours"):
+                contours = [(points[:, 0], points[:, 1])
+                            for points in self.mask_provider.axial_contours(self.seg_names[seg_index], index)]
+            self._contour_cache.put((seg_index, view, index), contours)
+            return contours
+
+        # Find contours at mask boundary 0.5
+        with self.frame_stats.phase("contours"):
+            source = self.seg_arrays[seg_index]
+            if isinstance(source, _LabelMask):
+                # Only the shown slice of a label map's structure is compared with its label
+                mask_slice = (self._view_slice(source.label_map, view, index) == source.label).astype(float)
+            else:
+                mask_slice = self._view_slice(self._seg_array(seg_index), view, index).astype(float)
+            found = measure.find_contours(mask_slice, 0.5)
+
+        # Gaussian smoothing of the contour coordinates
+        with self.frame_stats.phase("smoothing"):
+            contours = [(gaussian_filter1d(contour[:, 1], sigma=0.8), gaussian_filter1d(contour[:, 0], sigma=1.3))
+                        for contour in found]
+        self._contour_cache.put((seg_index, view, index), contours)
+        return contours
+
+    def _seg_array(self, seg_index: int) -> np.ndarray:
+        """
+        Returns the mask of a segmentation, asking the mask provider for structures loaded from an RTSTRUCT.
+        """
+        seg_array = self.seg_arrays[seg_index]
+        if seg_array is None:
+            with self.frame_stats.phase("rasterise"):
+                seg_array = self.mask_provider.mask(self.seg_names[seg_index])
+        elif isinstance(seg_array, _LabelMask):
+            seg_array = seg_array.label_map == seg_array.label
+        return seg_array
+
+    def _draw_contours(self, pixmap: QPixmap, view: str, index: int, seg_indices: list[int]) -> None:
+        """
+        Paints the contours of the given segmentations as filled, transparent polygons onto the pixmap.
+        """
+        with self.frame_stats.phase("painting"):
+            painter = QPainter(pixmap)
             painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            color = QColor(255, 0, 0, 120)
+            painter.setPen(QPen(color, 1.0))
+            painter.setBrush(QBrush(color))
 
-            for contour in coronal_contours:
-                # Smooth contour coordinates
-                x = contour[:, 1]
-                y = contour[:, 0]
-
-                # Gaussian smoothing
-                x_smooth = gaussian_filter1d(x, sigma=0.8)
-                y_smooth = gaussian_filter1d(y, sigma=1.3)
-
-                # Draw filled polygon with transparency
-                coronal_poly = QPolygonF()
-                for px, py in zip(x_smooth, y_smooth):
-                    coronal_poly.append(QPointF(px, py))
+        for seg_index in seg_indices:
+            for x_smooth, y_smooth in self._smoothed_contours(seg_index, view, index):
+                with self.frame_stats.phase("polygons"):
+                    polygon = QPolygonF()
+                    for px, py in zip(x_smooth, y_smooth):
+                        polygon.append(QPointF(px, py))
 
-                # Draw filled polygon with transparency
-                color = QColor(255, 0, 0, 120)
-                painter.setPen(QPen(color, 1.0))
-                painter.setBrush(QBrush(color))
-                painter.drawPolygon(coronal_poly)
+                with self.frame_stats.phase("painting"):
+                    painter.drawPolygon(polygon)
 
+        with self.frame_stats.phase("painting"):
             painter.end()
 
-            # Start painting on top of coronal pixmap
-            painter = QPainter(sagittal_pixmap)
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-
-            for contour in sagittal_contours:
-                # Smooth contour coordinates
-                x = contour[:, 1]
-                y = contour[:, 0]
-
-                # Gaussian smoothing
-                x_smooth = gaussian_filter1d(x, sigma=0.8)
-                y_smooth = gaussian_filter1d(y, sigma=1.3)
-
-                # Draw filled polygon with transparency
-                sagittal_poly = QPolygonF()
-                for px, py in zip(x_smooth, y_smooth):
-                    sagittal_poly.append(QPointF(px, py))
-
-                # Draw filled polygon with transparency
-                color = QColor(255, 0, 0, 120)
-                painter.setPen(QPen(color, 1.0))
-                painter.setBrush(QBrush(color))
-                painter.drawPolygon(sagittal_poly)
+    def render_stats(self) -> dict:
+        """
+        Rendering statistics of update_display: the frame times and their
+        per-phase breakdown over the recent frames (see FrameStats.snapshot),
+        and the hit rates of the slice and contour caches.
+        """
+        stats = self.frame_stats.snapshot()
+        stats["caches"] = {"slices": self._slice_cache.stats(), "contours": self._contour_cache.stats()}
+        if self.mask_provider is not None:
+            stats["caches"]["masks"] = self.mask_provider.cache_stats()
+        return stats
 
-            painter.end()
+    def clear_render_caches(self) -> None:
+        """
+        Empties the slice and contour caches, so the next frames are drawn from scratch.
+        """
+        self._slice_cache.clear()
+        self._contour_cache.clear()
 
-        # Display final painted pixmap
-        self.canvas_axial.setPixmap(axial_pixmap.scaled(
-            self.canvas_axial.width(), self.canvas_axial.height(),
-            aspectMode=Qt.AspectRatioMode.IgnoreAspectRatio, mode=Qt.SmoothTransformation
-        ))
+    def set_render_hud_visible(self, visible: bool) -> None:
+        """
+        Shows or hides the rendering statistics overlay on the axial view.
+        """
+        self.render_hud.setVisible(visible)
+        if self.render_stats_checkbox.isChecked() != visible:
+            self.render_stats_checkbox.setChecked(visible)
+        self._update_render_hud()
 
-        self.canvas_coronal.setPixmap(coronal_pixmap.scaled(
-            self.canvas_coronal.width(), self.canvas_coronal.height(),
-            aspectMode=Qt.AspectRatioMode.IgnoreAspectRatio, mode=Qt.SmoothTransformation
-        ))
+    def _update_render_hud(self) -> None:
+        if self.render_hud.isHidden():
+            return
+        stats = self.render_stats()
+        if not stats["frames"]:
+            self.render_hud.setText("No frames drawn")
+            self.render_hud.adjustSize()
+            return
 
-        self.canvas_sagittal.setPixmap(sagittal_pixmap.scaled(
-            self.canvas_sagittal.width(), self.canvas_sagittal.height(),
-            aspectMode=Qt.AspectRatioMode.IgnoreAspectRatio, mode=Qt.SmoothTransformation
-        ))
+        lines = [f"frame {stats['last_ms']:6.1f} ms  mean {stats['mean_ms']:.1f}  max {stats['max_ms']:.1f}"]
+        context = stats["context"]
+        if context:
+            lines.append(f"{'x'.join(str(size) for size in context['shape'])} voxels, "
+                         f"{context['structures']} structures")
+        for name, phase in stats["phases"].items():
+            lines.append(f"  {name:<10}{phase['last_ms']:6.1f} ms  mean {phase['mean_ms']:.1f}")
+        for name, cache in stats["caches"].items():
+            rate = f"{cache['hit_rate']:.0%}" if cache["hit_rate"] is not None else "-"
+            lines.append(f"{name} cache {rate} hits, {cache['items']} items")
+        self.render_hud.setText("\n".join(lines))
+        self.render_hud.adjustSize()
 
     def _clear_previous_loaded_segments(self):
         # Clear all previous data
         self.seg_arrays.clear()
         self.seg_names.clear()
+        self.mask_provider = None
         self.seg_colors.clear()
+        self._contour_cache.clear()
+        self._pending_structures.clear()
+        self._overlay_timer.stop()
+        self._load_generation += 1
 
         # Remove previous segment ref from array
         for checkbox in self.overlay_checkboxes:
@@ -0,0 +1,36 @@
+class CallbackSignal:
+    """A minimal stand-in for a Qt Signal.
+
+    Supports the connect/emit subset of the Signal interface used by the
+    segmentation workflow, calling the connected callbacks synchronously
+    on the emitting thread. Used where the workflow runs without Qt.
+    """
+
+    def __init__(self):
+        self._slots = []
+
+    def connect(self, slot):
+        self._slots.append(slot)
+
+    def disconnect(self, slot):
+        self._slots.remove(slot)
+
+    def emit(self, *args):
+        for slot in list(self._slots):
+            slot(*args)
+
+
+class HeadlessWorkerSignals:
+    """The signals of multithread.SegmentationWorkerSignals without PySide6.
+
+    Lets AutoSegmentation report progress text and events, completion, errors, cancellation and
+    segmented structures from command line tools that must not import Qt.
+    """
+
+    def __init__(self):
+        self.progress_updated = CallbackSignal()
+        self.progress = CallbackSignal()
+        self.finished = CallbackSignal()
+        self.error = CallbackSignal()
+        self.cancelled = CallbackSignal()
+        self.structures_ready = CallbackSignal()
@@ -3,7 +3,7 @@ import shutil
 import os
 import fnmatch
 
-exclude_patterns = ["rt*.dcm"]
+exclude_patterns = ["rt*.dcm", "*.manifest.json", "segmentations/"]
 
 def ignore_func(directory, contents):
     """Filters files and directories to be ignored during copy operations.
@@ -0,0 +1,419 @@
+import atexit
+import contextlib
+import inspect
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+
+from cancellation import SegmentationCancelled
+
+logger = logging.getLogger(__name__)
+
+# Enough to keep every part model of the "total" task warm
+DEFAULT_MAX_CACHED_MODELS = 6
+# Method of nnUNetPredictor predicting one patch, where cancellation is checked
+_PATCH_METHOD = "_internal_maybe_mirror_and_predict"
+
+
+class InferenceSessionError(RuntimeError):
+    """Raised when TotalSegmentator fails inside an inference session."""
+
+
+class PredictorCache:
+    """LRU cache of initialised nnU-Net predictors.
+
+    TotalSegmentator builds a new nnUNetPredictor and loads its weights from
+    disk for every model of every run. Once installed, the cache stands in
+    for the nnUNetPredictor class used by totalsegmentator.nnunet and hands
+    back an already initialised predictor when the same model folder, folds,
+    checkpoint and predictor settings are requested again.
+
+    Runs within cancellable(token) stop at the next model part or patch once
+    the token is cancelled, so inference in this process can be cancelled.
+
+    :param predictor_cls: the real nnUNetPredictor class
+    :param max_entries: number of predictors kept in memory
+    """
+
+    def __init__(self, predictor_cls, max_entries: int = DEFAULT_MAX_CACHED_MODELS) -> None:
+        self.predictor_cls = predictor_cls
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        # Thread count of the current run's resource profile, None to keep nnU-Net's choice
+        self.torch_threads: int | None = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # CancellationToken of the run on each thread, nnU-Net predicts on the calling thread
+        self._local = threading.local()
+
+        # totalsegmentator inspects the constructor signature to pick keyword arguments
+        self.__signature__ = inspect.signature(predictor_cls)
+
+    def __call__(self, *args, **kwargs):
+        return _CachedPredictor(self, args, kwargs)
+
+    @contextlib.contextmanager
+    def cancellable(self, cancel_token):
+        """
+        Check cancel_token before every model part and patch predicted on this thread within the context.
+
+        :param cancel_token: CancellationToken
+        """
+        previous = getattr(self._local, "cancel_token", None)
+        self._local.cancel_token = cancel_token
+        try:
+            yield
+        finally:
+            self._local.cancel_token = previous
+
+    def raise_if_cancelled(self) -> None:
+        """
+        :raises SegmentationCancelled: if the token of this thread's run was cancelled
+        """
+        cancel_token = getattr(self._local, "cancel_token", None)
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+
+    def _add_cancellation_point(self, predictor) -> None:
+        """
+        Make the predictor check the running thread's token before each patch.
+        """
+        predict_patch = getattr(predictor, _PATCH_METHOD, None)
+        if predict_patch is None:
+            # Other nnU-Net versions are only cancelled between model parts
+            return
+
+        def checked_predict_patch(*args, **kwargs):
+            self.raise_if_cancelled()
+            return predict_patch(*args, **kwargs)
+        setattr(predictor, _PATCH_METHOD, checked_predict_patch)
+
+    def get(self, key, build):
+        """
+        Get the predictor stored under key, building and caching it on a miss
+        and evicting the least recently used predictor when full.
+
+        :param key: hashable description of the predictor
+        :param build: function creating the initialised predictor
+        :return: nnUNetPredictor
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        predictor = build()
+        self._add_cancellation_point(predictor)
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = predictor
+            while len(self._entries) > self.max_entries:
+                evicted_key, _ = self._entries.popitem(last=False)
+                logger.info(f"Evicted nnU-Net model from session cache: {evicted_key[0]}")
+        return predictor
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class _CachedPredictor:
+    """Proxy returned in place of a new nnUNetPredictor.
+
+    Defers building the predictor until the model folder is known, then
+    delegates every other attribute to the cached, initialised predictor.
+    """
+
+    def __init__(self, cache: PredictorCache, args: tuple, kwargs: dict) -> None:
+        self._cache = cache
+        self._args = args
+        self._kwargs = kwargs
+        self._predictor = None
+
+    def initialize_from_trained_model_folder(self, model_training_output_dir, use_folds,
+                                             checkpoint_name="checkpoint_final.pth"):
+        self._cache.raise_if_cancelled()
+        # nnU-Net sets torch to use every core just before building the predictor,
+        # restore the thread count of the run's resource profile
+        if self._cache.torch_threads is not None:
+            import torch
+            torch.set_num_threads(self._cache.torch_threads)
+
+        key = (
+            str(model_training_output_dir),
+            tuple(use_folds) if use_folds is not None else None,
+            checkpoint_name,
+            repr(self._args),
+            repr(sorted(self._kwargs.items())),
+        )
+
+        def build():
+            logger.info(f"Loading nnU-Net model: {model_training_output_dir}")
+            predictor = self._cache.predictor_cls(*self._args, **self._kwargs)
+            predictor.initialize_from_trained_model_folder(model_training_output_dir, use_folds, checkpoint_name)
+            return predictor
+
+        self._predictor = self._cache.get(key, build)
+
+    def __getattr__(self, name):
+        predictor = self.__dict__.get("_predictor")
+        if predictor is None:
+            raise AttributeError(name)
+        return getattr(predictor, name)
+
+
+_installed_cache: PredictorCache | None = None
+
+
+def install_predictor_cache(max_cached_models: int = DEFAULT_MAX_CACHED_MODELS) -> PredictorCache | None:
+    """
+    Make TotalSegmentator in this process reuse loaded nnU-Net models across runs.
+    Safe to call more than once; returns None if the installed TotalSegmentator
+    version does not expose the predictor class, in which case every run loads
+    its models as before.
+
+    :param max_cached_models: number of predictors kept in memory
+    :return: PredictorCache or None
+    """
+    global _installed_cache
+    if _installed_cache is not None:
+        return _installed_cache
+
+    # nnU-Net reads its paths from the environment on import, set them first
+    from totalsegmentator.config import setup_nnunet
+    setup_nnunet()
+    import totalsegmentator.nnunet as nnunet_module
+
+    predictor_cls = getattr(nnunet_module, "nnUNetPredictor", None)
+    if predictor_cls is None:
+        logger.warning("TotalSegmentator does not expose nnUNetPredictor, models will be reloaded on every run")
+        return None
+
+    _installed_cache = PredictorCache(predictor_cls, max_cached_models)
+    nnunet_module.nnUNetPredictor = _installed_cache
+    return _installed_cache
+
+
+def apply_resource_profile(resource_profile, whole_process: bool = False) -> None:
+    """
+    Apply a ResourceProfile to TotalSegmentator runs in this process, keeping
+    its torch thread count in force over nnU-Net's own setting.
+
+    :param resource_profile: ResourceProfile
+    :param whole_process: pin every thread rather than the calling one, only in the session's process
+    :rtype: None
+    """
+    resource_profile.apply_to_current_process(whole_process)
+    if _installed_cache is not None:
+        _installed_cache.torch_threads = resource_profile.torch_threads
+    logger.info(f"Resource profile: {resource_profile.describe()}")
+
+
+class _ConnectionWriter:
+    """File-like object forwarding the worker process's output to the session owner."""
+
+    def __init__(self, connection) -> None:
+        self._connection = connection
+
+    def write(self, text):
+        if text:
+            self._connection.send(("output", text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _session_worker(connection, max_cached_models: int) -> None:
+    """
+    Body of the inference session process. Runs TotalSegmentator requests
+    one at a time, keeping the loaded models warm between them.
+
+    :param connection: pipe to the session owner
+    :param max_cached_models:
+    :rtype: None
+    """
+    # Own process group, so cancelling a run also stops nnU-Net's preprocessing workers
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+    sys.stdout = sys.stderr = _ConnectionWriter(connection)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stderr,
+                        force=True)
+
+    from totalsegmentator.python_api import totalsegmentator
+    install_predictor_cache(max_cached_models)
+
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+
+        _, kwargs, resource_profile, return_labels = request
+        try:
+            if resource_profile is not None:
+                # The session's process runs nothing but inference, pin all of it
+                apply_resource_profile(resource_profile, whole_process=True)
+            segmentation = totalsegmentator(**kwargs)
+            if return_labels:
+                from label_volume import LabelVolume
+                segmentation = LabelVolume.from_totalsegmentator(segmentation, kwargs["task"],
+                                                                 kwargs.get("roi_subset"))
+            connection.send(("result", segmentation if return_labels else None))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+
+
+class InferenceSession:
+    """Long-lived TotalSegmentator process shared by consecutive runs.
+
+    The first run starts a worker process which imports torch and
+    TotalSegmentator once and keeps the nnU-Net predictors of recently used
+    tasks in memory (see PredictorCache), so back-to-back runs skip loading
+    the model weights from disk. Output printed in the worker is forwarded
+    to this process's stdout, or to the on_output callback of a run.
+    Runs are executed one at a time. cancel() stops the current run by
+    killing the process, the next run starts a fresh one.
+
+    :param max_cached_models: number of predictors the worker keeps warm
+    """
+
+    def __init__(self, max_cached_models: int = DEFAULT_MAX_CACHED_MODELS) -> None:
+        self.max_cached_models = max_cached_models
+        self._process = None
+        self._connection = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._cancel_requested = False
+        atexit.register(self.close)
+
+    @property
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def _start(self) -> None:
+        # spawn keeps the worker free of the GUI's threads and Qt state.
+        # Not a daemon: nnU-Net starts its own preprocessing and export workers,
+        # which daemonic processes may not do. close() runs at exit instead.
+        context = multiprocessing.get_context("spawn")
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(
+            target=_session_worker, args=(child_connection, self.max_cached_models),
+            name="inference-session"
+        )
+        self._process.start()
+        child_connection.close()
+        logger.info(f"Started inference session process {self._process.pid}")
+
+    def start(self) -> None:
+        """
+        Start the session process ahead of the first run, so it imports torch
+        and TotalSegmentator while the application is idle. Does nothing if
+        the process is already running. May be called from any thread.
+
+        :rtype: None
+        """
+        with self._lock:
+            if not self.is_alive:
+                self._start()
+
+    def run(self, on_output=None, resource_profile=None, return_labels=False, **totalsegmentator_kwargs):
+        """
+        Run TotalSegmentator in the session process and wait for it to finish.
+
+        :param on_output: called with each chunk of text printed by the worker,
+                          defaults to writing it to sys.stdout
+        :param resource_profile: ResourceProfile applied to the session process for this run
+        :param return_labels: send back the segmentation returned by totalsegmentator()
+                              as a LabelVolume, e.g. when run with skip_saving
+        :param totalsegmentator_kwargs: keyword arguments of totalsegmentator()
+        :return: the LabelVolume if return_labels, else None
+        :raises SegmentationCancelled: if cancel() was called during the run
+        """
+        with self._lock:
+            if not self.is_alive:
+                self._start()
+
+            self._cancel_requested = False
+            self._running = True
+            try:
+                self._connection.send(("run", totalsegmentator_kwargs, resource_profile, return_labels))
+                while True:
+                    try:
+                        kind, payload = self._connection.recv()
+                    except (EOFError, OSError):
+                        self._discard_process()
+                        if self._cancel_requested:
+                            raise SegmentationCancelled()
+                        raise InferenceSessionError("Inference session process exited unexpectedly")
+
+                    if kind == "output":
+                        if on_output is not None:
+                            on_output(payload)
+                        else:
+                            sys.stdout.write(payload)
+                    elif kind == "result":
+                        return payload
+                    else:
+                        raise InferenceSessionError(payload)
+            finally:
+                self._running = False
+
+    def cancel(self) -> None:
+        """
+        Stop the run in progress by killing the session process and its
+        workers, releasing the cached models. Does nothing between runs.
+        May be called from any thread.
+
+        :rtype: None
+        """
+        process = self._process
+        if not self._running or process is None or not process.is_alive():
+            return
+
+        self._cancel_requested = True
+        logger.info(f"Cancelling inference session process {process.pid}")
+        if hasattr(os, "killpg"):
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+                return
+            except OSError:
+                pass
+        process.kill()
+
+    def _discard_process(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+        if self._process is not None:
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._process = None
+        self._connection = None
+
+    def close(self) -> None:
+        """
+        Stop the session process, releasing the cached models.
+
+        :rtype: None
+        """
+        if self.is_alive:
+            try:
+                self._connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self._discard_process()
@@ -0,0 +1,405 @@
+"""Named timing spans for the segmentation workflow.
+
+Code marks a stage with `with span("name"):`. When a Recorder is active
+on the current thread, the span's wall time, CPU time and the process's
+peak RSS are recorded; otherwise span() does nothing. A recorder's spans
+can be summarised per name, or written as JSON or in the Chrome trace
+event format (open in chrome://tracing or https://ui.perfetto.dev).
+
+FrameStats times the frames of an interactive view, such as the
+DicomViewer, and the phases of each frame over a window of recent frames.
+
+Environment variables:
+    ONKODICOM_TRACE_DIR: the workflow writes the trace of every study into this directory
+    ONKODICOM_PROFILE: "cprofile" or "pyinstrument", profiles every workflow run and
+                       writes the profile into ONKODICOM_TRACE_DIR (or the temp directory)
+"""
+import contextlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass, field
+
+logger = logging.getLogger(__name__)
+
+TRACE_DIR_ENV = "ONKODICOM_TRACE_DIR"
+PROFILE_ENV = "ONKODICOM_PROFILE"
+
+_local = threading.local()
+
+# Held by the run being profiled, only one profiler can be active in the process at a time
+_profiling = threading.Lock()
+
+
+def peak_rss() -> int | None:
+    """
+    :return: the highest resident set size of this process so far in bytes, None if unknown
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class SpanRecord:
+    """A finished span.
+
+    :param name:
+    :param start: seconds from the recorder's creation to the span's start
+    :param wall: wall time in seconds
+    :param cpu: CPU time of the whole process in seconds, includes other threads
+    :param peak_rss: peak resident set size of the process at the end of the span, in bytes
+    :param peak_rss_growth: how much the span raised the peak resident set size, in bytes
+    :param thread: name of the thread the span ran on
+    :param depth: number of enclosing spans on that thread
+    :param attributes: extra detail, e.g. the structure or study
+    """
+    name: str
+    start: float
+    wall: float
+    cpu: float
+    peak_rss: int | None
+    peak_rss_growth: int | None
+    thread: str
+    depth: int
+    attributes: dict = field(default_factory=dict)
+
+
+class Recorder:
+    """Collects the spans of one workflow run, from any number of threads.
+
+    :param name: name of the run, e.g. the study directory
+    """
+
+    def __init__(self, name: str = "") -> None:
+        self.name = name
+        self.spans: list[SpanRecord] = []
+        # time.perf_counter() value the starts of the spans are measured from
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def activate(self):
+        """
+        Record the spans of the current thread into this recorder for the
+        duration of the context.
+        """
+        stack = _recorder_stack()
+        stack.append(self)
+        try:
+            yield self
+        finally:
+            stack.pop()
+
+    def add(self, record: SpanRecord) -> None:
+        with self._lock:
+            self.spans.append(record)
+
+    def summary(self) -> list[dict]:
+        """
+        Aggregate the spans by name, in the order the names first started.
+
+        :return: list of {name, count, wall, cpu, peak_rss}
+        """
+        totals = defaultdict(lambda: {"count": 0, "wall": 0.0, "cpu": 0.0, "peak_rss": None})
+        order = []
+        with self._lock:
+            spans = sorted(self.spans, key=lambda record: record.start)
+        for record in spans:
+            if record.name not in totals:
+                order.append(record.name)
+            total = totals[record.name]
+            total["count"] += 1
+            total["wall"] += record.wall
+            total["cpu"] += record.cpu
+            if record.peak_rss is not None:
+                total["peak_rss"] = max(total["peak_rss"] or 0, record.peak_rss)
+        return [{"name": name, **totals[name]} for name in order]
+
+    def report(self) -> str:
+        """
+        :return: the summary as a text table
+        """
+        lines = [f"Timing of {self.name}:" if self.name else "Timing:",
+                 f"{'span':<24}{'count':>7}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}"]
+        for total in self.summary():
+            peak = f"{total['peak_rss'] / 1024 ** 2:.0f}" if total["peak_rss"] is not None else "-"
+            lines.append(f"{total['name']:<24}{total['count']:>7}{total['wall']:>10.2f}{total['cpu']:>10.2f}{peak:>10}")
+        return "\n".join(lines)
+
+    def to_json(self) -> dict:
+        with self._lock:
+            spans = [asdict(record) for record in self.spans]
+        return {"name": self.name, "spans": spans, "summary": self.summary()}
+
+    def to_chrome_trace(self) -> dict:
+        """
+        :return: the spans as complete events of the Chrome trace event format
+        """
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+
+        thread_ids = {}
+        events = []
+        for record in spans:
+            tid = thread_ids.setdefault(record.thread, len(thread_ids) + 1)
+            events.append({
+                "name": record.name,
+                "ph": "X",
+                "ts": record.start * 1e6,
+                "dur": record.wall * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {"cpu_ms": round(record.cpu * 1000, 3), "peak_rss": record.peak_rss,
+                         "peak_rss_growth": record.peak_rss_growth, **record.attributes},
+            })
+        for thread, tid in thread_ids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"name": self.name}}
+
+    def write_json(self, path: str) -> None:
+        with open(path, "w") as file:
+            json.dump(self.to_json(), file, indent=2)
+
+    def write_chrome_trace(self, path: str) -> None:
+        with open(path, "w") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+    def export(self, directory: str, prefix: str) -> str:
+        """
+        Write <prefix>.spans.json and <prefix>.trace.json into directory.
+
+        :param directory: created if needed
+        :param prefix:
+        :return: path of the Chrome trace
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.write_json(os.path.join(directory, f"{prefix}.spans.json"))
+        trace_path = os.path.join(directory, f"{prefix}.trace.json")
+        self.write_chrome_trace(trace_path)
+        return trace_path
+
+
+def _recorder_stack() -> list:
+    stack = getattr(_local, "recorders", None)
+    if stack is None:
+        stack = _local.recorders = []
+    return stack
+
+
+def current_recorder() -> Recorder | None:
+    """
+    :return: the recorder active on the current thread, or None
+    """
+    stack = getattr(_local, "recorders", None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Record the enclosed code as a span of the recorder active on this thread.
+    Does nothing when no recorder is active.
+
+    :param name: stage name, shared by repeated spans of the same stage
+    :param attributes: JSON serialisable detail stored with the span
+    """
+    recorder = current_recorder()
+    if recorder is None:
+        yield
+        return
+
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    peak_before = peak_rss()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        peak_after = peak_rss()
+        _local.depth = depth
+        growth = peak_after - peak_before if peak_after is not None and peak_before is not None else None
+        recorder.add(SpanRecord(name, start - recorder.origin, wall, cpu, peak_after, growth,
+                                threading.current_thread().name, depth, attributes))
+
+
+class FrameStats:
+    """Frame and per-phase times of a view over its most recent frames.
+
+    A frame is timed with `with stats.frame():`, and the phases within it
+    with `with stats.phase("name"):`; a phase entered several times in one
+    frame, e.g. once per structure, adds up. Meant for the GUI thread only.
+
+    :param window: number of recent frames the means and maximum are taken over
+    """
+
+    def __init__(self, window: int = 60) -> None:
+        self.frame_count = 0
+        self._frames = deque(maxlen=window)
+        self._current = None
+
+    @contextlib.contextmanager
+    def frame(self, **context):
+        """
+        Time the enclosed code as one frame.
+
+        :param context: detail shown with the frame, e.g. the slice size or number of structures
+        """
+        if self._current is not None:
+            # Nested frames, e.g. a redraw triggered while drawing, are part of the outer frame
+            yield
+            return
+
+        self._current = {"phases": {}, "context": context}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            frame = self._current
+            self._current = None
+            frame["total"] = time.perf_counter() - start
+            self._frames.append(frame)
+            self.frame_count += 1
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Time the enclosed code as part of the named phase of the current frame.
+        Does nothing outside a frame.
+        """
+        frame = self._current
+        if frame is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            frame["phases"][name] = frame["phases"].get(name, 0.0) + time.perf_counter() - start
+
+    def reset(self) -> None:
+        self.frame_count = 0
+        self._frames.clear()
+
+    def snapshot(self) -> dict:
+        """
+        :return: {frames, last_ms, mean_ms, max_ms, fps, phases: {name: {last_ms, mean_ms}}, context},
+                 times over the recent frames, context of the last frame
+        """
+        if not self._frames:
+            return {"frames": 0, "last_ms": None, "mean_ms": None, "max_ms": None, "fps": None,
+                    "phases": {}, "context": {}}
+
+        frames = list(self._frames)
+        last = frames[-1]
+        mean = sum(frame["total"] for frame in frames) / len(frames)
+        phases = {}
+        for frame in frames:
+            for name in frame["phases"]:
+                phases.setdefault(name, None)
+        for name in phases:
+            phases[name] = {
+                "last_ms": last["phases"].get(name, 0.0) * 1000,
+                "mean_ms": sum(frame["phases"].get(name, 0.0) for frame in frames) / len(frames) * 1000,
+            }
+        return {
+            "frames": self.frame_count,
+            "last_ms": last["total"] * 1000,
+            "mean_ms": mean * 1000,
+            "max_ms": max(frame["total"] for frame in frames) * 1000,
+            "fps": 1.0 / mean if mean > 0 else None,
+            "phases": phases,
+            "context": dict(last["context"]),
+        }
+
+
+def trace_dir() -> str | None:
+    return os.environ.get(TRACE_DIR_ENV) or None
+
+
+@contextlib.contextmanager
+def profiled(name: str):
+    """
+    Profile the enclosed code with the profiler named by ONKODICOM_PROFILE,
+    writing <name>.prof (cProfile) or <name>.html (pyinstrument). Does
+    nothing when the variable is not set. Only the current thread is profiled,
+    and only one run at a time: runs starting while another is profiled are not.
+
+    :param name: file name prefix of the profile
+    """
+    profiler_name = os.environ.get(PROFILE_ENV, "").strip().lower()
+    if not profiler_name:
+        yield
+        return
+
+    # A second cProfile profiler fails to enable on Python 3.12, as its hooks are process-wide
+    if not _profiling.acquire(blocking=False):
+        logger.info(f"Another run is being profiled, not profiling {name}")
+        yield
+        return
+    try:
+        with _profile(profiler_name, name):
+            yield
+    finally:
+        _profiling.release()
+
+
+@contextlib.contextmanager
+def _profile(profiler_name: str, name: str):
+    directory = trace_dir() or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+
+    if profiler_name == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning(f"{PROFILE_ENV}=pyinstrument but pyinstrument is not installed, profiling disabled")
+            yield
+            return
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            path = os.path.join(directory, f"{name}.html")
+            with open(path, "w") as file:
+                file.write(profiler.output_html())
+            logger.info(f"Wrote profile {path}")
+        return
+
+    if profiler_name != "cprofile":
+        logger.warning(f"Unknown {PROFILE_ENV} value {profiler_name!r}, use cprofile or pyinstrument")
+        yield
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # e.g. the application itself runs under cProfile
+        logger.info(f"Another profiler is active, not profiling {name}")
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = os.path.join(directory, f"{name}.prof")
+        profiler.dump_stats(path)
+        logger.info(f"Wrote profile {path}")
@@ -0,0 +1,255 @@
+"""In-memory label map of a segmentation run.
+
+TotalSegmentator can return its segmentation as a single label map, one
+integer label per structure, instead of writing a gzip compressed NIfTI file
+per structure. LabelVolume holds that map with the names of its labels, so
+the RTSTRUCT converter takes it directly (see
+nifti_converter.label_volume_to_rtstruct_conversion) without writing the
+files and reading them straight back. Writing the per-structure NIfTI files,
+for the viewer, the result cache and later conversions, is optional
+(write_nifti).
+
+The map is kept as nibabel returns it, a numpy array in (x, y, z) order with
+a RAS affine, so the inference session process can send it without
+SimpleITK. aligned_to() resamples it onto the CT grid once, for both the
+converter and the viewer's overlay (LabelOverlay).
+"""
+import contextlib
+import hashlib
+import logging
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+# Converts between RAS (NIfTI) and LPS (DICOM, SimpleITK) patient coordinates
+_RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0])
+
+
+def label_boxes(array: np.ndarray, labels) -> dict[int, tuple | None]:
+    """
+    Bounding box of each label of a label map, found in one pass over the map.
+
+    :param array: integer label map
+    :param labels: labels to find
+    :return: {label: tuple of slices, or None if the label does not occur}
+    """
+    from scipy.ndimage import find_objects
+
+    labels = list(labels)
+    boxes = find_objects(array, max_label=max(labels, default=0))
+    return {label: boxes[label - 1] if 0 < label <= len(boxes) else None for label in labels}
+
+
+@dataclass
+class LabelVolume:
+    """A label map with the structure name of each label, see the module docstring.
+
+    :param array: integer label map in (x, y, z) order
+    :param affine: 4x4 voxel to RAS affine of the map
+    :param labels: {label: structure name}
+    """
+    array: np.ndarray
+    affine: np.ndarray
+    labels: dict[int, str]
+    _boxes: dict | None = field(default=None, init=False, repr=False, compare=False)
+    _aligned: tuple | None = field(default=None, init=False, repr=False, compare=False)
+
+    @classmethod
+    def from_totalsegmentator(cls, image, task: str, roi_subset: list[str] | None = None) -> "LabelVolume":
+        """
+        Wrap the nibabel image returned by totalsegmentator(). The label names
+        come from the image's label map extension when it has one, otherwise
+        from TotalSegmentator's class map of the task.
+
+        :param image: nibabel.Nifti1Image
+        :param task: TotalSegmentator task
+        :param roi_subset: only keep these structures, as TotalSegmentator only segments them
+        :rtype: LabelVolume
+        """
+        from totalsegmentator.map_to_binary import class_map
+
+        labels = dict(class_map[task])
+        if image.header.extensions:
+            try:
+                from totalsegmentator.nifti_ext_header import load_multilabel_nifti
+                _, labels = load_multilabel_nifti(image)
+            except Exception as e:
+                logger.warning(f"Using the class map of {task}, the label map of the segmentation is unreadable: {e}")
+        if roi_subset is not None:
+            subset = set(roi_subset)
+            labels = {label: name for label, name in labels.items() if name in subset}
+
+        array = np.asarray(image.dataobj)
+        dtype = np.uint8 if max(labels, default=0) < 256 else np.uint16
+        return cls(array.astype(dtype, copy=False), np.asarray(image.affine, dtype=float), labels)
+
+    @property
+    def names(self) -> list[str]:
+        """
+        Structure names, sorted as the NIfTI files of the structures would be
+        """
+        return sorted(self.labels.values())
+
+    def label_of(self, name: str) -> int:
+        for label, label_name in self.labels.items():
+            if label_name == name:
+                return label
+        raise KeyError(f"No structure {name} in the label volume")
+
+    def boxes(self) -> dict[int, tuple | None]:
+        """
+        Bounding box of each label in the (x, y, z) map, see label_boxes.
+        """
+        if self._boxes is None:
+            self._boxes = label_boxes(self.array, self.labels)
+        return self._boxes
+
+    def fingerprint(self, name: str) -> dict:
+        """
+        Fingerprint of a structure's voxels for the conversion manifest, hashing
+        the structure's mask within its bounding box. Compared only with the
+        voxel hashes of earlier runs, see segmentation_manifest.diff_structures.
+
+        :param name:
+        :return: {"voxels": str}
+        """
+        label = self.label_of(name)
+        box = self.boxes()[label]
+        digest = hashlib.sha256(repr(self.array.shape).encode())
+        if box is not None:
+            digest.update(repr([(part.start, part.stop) for part in box]).encode())
+            digest.update(np.packbits(self.array[box] == label).tobytes())
+        return {"voxels": digest.hexdigest()}
+
+    def to_sitk(self):
+        """
+        The label map as a SimpleITK image, with the geometry SimpleITK reads
+        from a NIfTI file of the map.
+
+        :rtype: SimpleITK.Image
+        """
+        import SimpleITK as sitk
+
+        image = sitk.GetImageFromArray(np.ascontiguousarray(self.array.T))  # (z, y, x) format
+        self._apply_geometry(image)
+        return image
+
+    def aligned_to(self, geometry) -> np.ndarray:
+        """
+        The label map orientated to the dicom standard (LPS) and resampled onto
+        the grid of the CT series. Computed once and kept for the same geometry.
+
+        :param geometry: nifti_converter.SeriesGeometry of the LPS orientated CT series
+        :return: np.ndarray, label map in (z, y, x) order
+        """
+        if self._aligned is not None and self._aligned[0] == geometry:
+            return self._aligned[1]
+
+        import SimpleITK as sitk
+
+        with span("orient"):
+            label_img = sitk.DICOMOrient(self.to_sitk(), 'LPS')
+
+            # Ensure orientations match
+            geometry.apply_to(label_img)
+
+        with span("resample"):
+            resample = sitk.ResampleImageFilter()
+            resample.SetSize(geometry.size)
+            resample.SetOutputOrigin(geometry.origin)
+            resample.SetOutputSpacing(geometry.spacing)
+            resample.SetOutputDirection(geometry.direction)
+            resample.SetInterpolator(sitk.sitkNearestNeighbor)
+            resample.SetTransform(sitk.Transform())
+            aligned_label_img = resample.Execute(label_img)
+        del label_img
+
+        label_map = sitk.GetArrayFromImage(aligned_label_img)
+        self._aligned = geometry, label_map
+        return label_map
+
+    def overlay(self, dicom_dir: str, geometry, preview: bool = False) -> "LabelOverlay":
+        """
+        The structures of the map aligned to the CT grid, for the viewer.
+
+        :param dicom_dir: study the map was segmented from
+        :param geometry: nifti_converter.SeriesGeometry of the LPS orientated CT series
+        :param preview: whether the map is a low resolution preview
+        :rtype: LabelOverlay
+        """
+        return LabelOverlay(dicom_dir, self.aligned_to(geometry), dict(self.labels), preview)
+
+    def _apply_geometry(self, image) -> None:
+        """
+        Set the spacing, direction and origin of the affine on an image of the map's size.
+        """
+        linear = _RAS_TO_LPS @ self.affine[:3, :3]
+        spacing = np.linalg.norm(linear, axis=0)
+        image.SetSpacing(spacing.tolist())
+        image.SetDirection((linear / spacing).ravel().tolist())
+        image.SetOrigin((_RAS_TO_LPS @ self.affine[:3, 3]).tolist())
+
+    def write_nifti(self, output_dir: str, cancel_token=None) -> dict[str, str]:
+        """
+        Write a binary <structure>.nii.gz mask of every structure into output_dir,
+        as TotalSegmentator does. The files are written under temporary names
+        and renamed once all of them are complete, so when cancelled or on an
+        error only the temporary files are removed and the files of earlier
+        runs are left as they were.
+
+        :param output_dir:
+        :param cancel_token: CancellationToken checked before each structure
+        :return: {structure name: path}
+        :raises SegmentationCancelled: if cancel_token was cancelled
+        """
+        import SimpleITK as sitk
+
+        written = {}
+        temporary_paths = {}
+        try:
+            for name in self.names:
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                label = self.label_of(name)
+                box = self.boxes()[label]
+
+                mask = np.zeros(self.array.shape, dtype=np.uint8)
+                if box is not None:
+                    mask[box] = self.array[box] == label
+                image = sitk.GetImageFromArray(np.ascontiguousarray(mask.T))
+                self._apply_geometry(image)
+
+                temporary_paths[name] = os.path.join(output_dir, f".{name}.partial.nii.gz")
+                sitk.WriteImage(image, temporary_paths[name], useCompression=True)
+
+            for name, temporary_path in temporary_paths.items():
+                path = os.path.join(output_dir, f"{name}.nii.gz")
+                os.replace(temporary_path, path)
+                written[name] = path
+        except BaseException:
+            for name, temporary_path in temporary_paths.items():
+                if name not in written:
+                    with contextlib.suppress(OSError):
+                        os.remove(temporary_path)
+            raise
+        return written
+
+
+@dataclass
+class LabelOverlay:
+    """Structures of a label map on the LPS orientated CT grid of a study, as the viewer shows it.
+
+    :param dicom_dir: study the map was segmented from
+    :param label_map: integer label map in (z, y, x) order
+    :param labels: {label: structure name}
+    :param preview: the map is a low resolution preview, replaced by a full resolution run
+    """
+    dicom_dir: str
+    label_map: np.ndarray
+    labels: dict[int, str]
+    preview: bool = False
@@ -1,4 +1,12 @@
+import time
 
+# Reference point of the startup times logged by log_startup(). Taken before
+# the other imports on purpose, so the time spent importing PySide6 and the
+# tabs is part of the logged startup times (imports below it are not at the
+# top of the file, E402, deliberately).
+STARTED = time.perf_counter()
+
+import importlib
 import logging
 import platform
 import sys
@@ -10,7 +18,18 @@ from PySide6.QtWidgets import QGridLayout, QWidget, QVBoxLayout, QStackedWidget,
 
 from StyleSheetReader import StyleSheetReader
 from auto_segment_tab import AutoSegmentationTab
-from dicom_viewer_tab import DicomViewer
+from multithread import Task
+
+logger = logging.getLogger(__name__)
+
+
+def log_startup(stage: str) -> None:
+    """
+    Log the time from the start of the process to a stage of the startup
+    :param stage:
+    :rtype: None
+    """
+    logger.info(f"Startup: {stage} after {time.perf_counter() - STARTED:.2f}s")
 
 
 class UIMainWindow(QMainWindow):
@@ -27,7 +46,10 @@ class UIMainWindow(QMainWindow):
         self.setWindowTitle("AutoSegmentation Demo")
         self.setStyleSheet(self.stylesheet())
         self.dicom_dir: str = QFileDialog.getExistingDirectory(self, "Select DICOM CT Series")
+        log_startup("DICOM directory selected")
 
+        self._deferred_loading_started = False
+        self._viewer_task = None
         self.setup_central_widget()
 
     def setup_central_widget(self):
@@ -57,10 +79,13 @@ class UIMainWindow(QMainWindow):
         self.right_panel.setMinimumHeight(600)
 
         # Add Auto-Segmentation to the left panel
-        self.left_panel.addTab(AutoSegmentationTab(self.dicom_dir), "Auto-Segment")
+        self.auto_segmentation_tab = AutoSegmentationTab(self.dicom_dir)
+        self.left_panel.addTab(self.auto_segmentation_tab, "Auto-Segment")
 
-        # Add DicomViewer to the right panel
-        self.right_panel.addTab(DicomViewer(self.dicom_dir), "Dicom Viewer")
+        # DicomViewer replaces the placeholder once the window is shown, see load_viewer()
+        self.viewer_placeholder = QLabel("Loading viewer...")
+        self.viewer_placeholder.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
+        self.right_panel.addTab(self.viewer_placeholder, "Dicom Viewer")
 
         splitter.addWidget(self.left_panel)
         splitter.addWidget(self.right_panel)
@@ -73,6 +98,57 @@ class UIMainWindow(QMainWindow):
 
         self.central_widget_layout.addWidget(self.footer)
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        # Start the slow work once the window has been drawn
+        if not self._deferred_loading_started:
+            self._deferred_loading_started = True
+            QtCore.QTimer.singleShot(0, self.start_deferred_loading)
+
+    def start_deferred_loading(self):
+        """Load what the window does not need to appear.
+
+        Starts the segmentation models' process in the background and
+        creates the viewer.
+        """
+        log_startup("window shown")
+        self.auto_segmentation_tab.warm_up()
+        self.load_viewer()
+
+    def load_viewer(self):
+        """Create the DicomViewer in place of its placeholder.
+
+        The viewer's imaging libraries are imported on a pool thread and the
+        viewer reads the DICOM series in the background, so the window stays
+        responsive meanwhile.
+        """
+        self._viewer_task = Task(importlib.import_module, "dicom_viewer_tab")
+        self._viewer_task.signals.result.connect(self._create_viewer)
+        self._viewer_task.signals.error.connect(self._on_viewer_failed)
+        QtCore.QThreadPool.globalInstance().start(self._viewer_task)
+
+    def _create_viewer(self, module):
+        self._viewer_task = None
+        log_startup("viewer imported")
+
+        viewer = module.DicomViewer(self.dicom_dir, load_async=True)
+        viewer.dicom_loaded.connect(self._on_viewer_loaded)
+        # Segmented structures of the study are shown as they become available
+        self.auto_segmentation_tab.set_viewer(viewer)
+        index = self.right_panel.indexOf(self.viewer_placeholder)
+        self.right_panel.removeTab(index)
+        self.right_panel.insertTab(index, viewer, "Dicom Viewer")
+        self.right_panel.setCurrentIndex(index)
+        self.viewer_placeholder.deleteLater()
+        self.viewer_placeholder = None
+
+    def _on_viewer_loaded(self):
+        log_startup("DICOM series shown")
+
+    def _on_viewer_failed(self, message):
+        self._viewer_task = None
+        self.viewer_placeholder.setText(f"Failed to load the viewer:\n{message}")
+
     # Borrowed from OnkoDicom
     def create_footer(self):
         """Create the footer widget.
@@ -91,6 +167,8 @@ class UIMainWindow(QMainWindow):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    log_startup("modules imported")
     app = QtWidgets.QApplication(sys.argv)
     window = UIMainWindow()
     window.show()
@@ -1,3 +1,5 @@
+import logging
+
 from PySide6.QtCore import (
     QRunnable,
     Slot,
@@ -5,10 +7,63 @@ from PySide6.QtCore import (
     Signal
 )
 
+logger = logging.getLogger(__name__)
+
 class SegmentationWorkerSignals(QObject):
     progress_updated = Signal(str)
+    progress = Signal(object)
     finished = Signal()
     error = Signal(str)
+    cancelled = Signal()
+    # label_volume.LabelOverlay of segmented structures, for the viewer
+    structures_ready = Signal(object)
+
+class JobSignalRelay(QObject):
+    """Relays the worker signals of one queued job to its handler.
+
+    Created on the GUI thread, so the slots run there even though the
+    worker emits from a pool thread, and tags each event with the job id.
+
+    :param job_id: id of the job the signals belong to
+    :param handler: object with on_job_progress, on_job_progress_event, on_job_finished,
+                    on_job_error, on_job_cancelled and on_job_structures methods
+    """
+    def __init__(self, job_id, handler):
+        super().__init__()
+        self.job_id = job_id
+        self.handler = handler
+
+    def connect_signals(self, signals: SegmentationWorkerSignals):
+        signals.progress_updated.connect(self.on_progress)
+        signals.progress.connect(self.on_progress_event)
+        signals.finished.connect(self.on_finished)
+        signals.error.connect(self.on_error)
+        signals.cancelled.connect(self.on_cancelled)
+        signals.structures_ready.connect(self.on_structures)
+
+    @Slot(str)
+    def on_progress(self, text):
+        self.handler.on_job_progress(self.job_id, text)
+
+    @Slot(object)
+    def on_progress_event(self, event):
+        self.handler.on_job_progress_event(self.job_id, event)
+
+    @Slot()
+    def on_finished(self):
+        self.handler.on_job_finished(self.job_id)
+
+    @Slot(str)
+    def on_error(self, message):
+        self.handler.on_job_error(self.job_id, message)
+
+    @Slot()
+    def on_cancelled(self):
+        self.handler.on_job_cancelled(self.job_id)
+
+    @Slot(object)
+    def on_structures(self, overlay):
+        self.handler.on_job_structures(self.job_id, overlay)
 
 class Worker(QRunnable):
     """Worker thread.
@@ -19,16 +74,57 @@ class Worker(QRunnable):
                      Supplied args and kwargs will be passed through to the runner.
     :type callback: function
     :param args: Arguments to pass to the callback function
+    :param signals: SegmentationWorkerSignals whose error signal reports an exception
+                    escaping the callback, so its job is not left running
     :param kwargs: Keywords to pass to the callback function
     """
-    def __init__(self, fn, *args, **kwargs):
+    def __init__(self, fn, *args, signals=None, **kwargs):
         super().__init__()
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        self.signals = signals
 
 
     @Slot()
     def run(self):
         """Initialise the runner function with passed args, kwargs."""
-        self.fn(*self.args, **self.kwargs)
\ No newline at end of file
+        try:
+            self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            logger.exception(e)
+            if self.signals is not None:
+                self.signals.error.emit(str(e) or type(e).__name__)
+
+
+class TaskSignals(QObject):
+    result = Signal(object)
+    error = Signal(str)
+
+class Task(QRunnable):
+    """Worker thread returning a result.
+
+    Like Worker, but emits the callback's return value through signals.result,
+    or the exception's message through signals.error. Create the task on the
+    GUI thread, so the slots connected to its signals run there.
+
+    :param fn: The function callback to run on this worker thread.
+    :param args: Arguments to pass to the callback function
+    :param kwargs: Keywords to pass to the callback function
+    """
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = TaskSignals()
+
+    @Slot()
+    def run(self):
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            logger.exception(e)
+            self.signals.error.emit(str(e))
+            return
+        self.signals.result.emit(result)
@@ -1,41 +1,80 @@
+import contextlib
 import logging
 import os
 import glob
+from dataclasses import dataclass
 from pathlib import Path
 
 import SimpleITK as sitk
 import numpy as np
-from rt_utils import RTStructBuilder
+from pydicom import dcmread
+from rt_utils import RTStruct, RTStructBuilder
+from rt_utils import ds_helper, image_helper
+
+from cancellation import SegmentationCancelled
+from instrumentation import span
+from label_volume import LabelVolume, label_boxes
+from segmentation_manifest import (diff_structures, file_fingerprint, load_manifest, manifest_path_for, same_content,
+                                   save_manifest)
+from series_decoder import orient_lps, series_geometry
+from series_index import series_files
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-# Function loads a dicom series at dir as SimpleITK image
-def _load_dicom_series_as_sitk(dicom_folder: str) -> sitk.Image:
+# Geometry of the CT grid, kept without the pixel data
+@dataclass(frozen=True)
+class SeriesGeometry:
     """
-    loads a dicom series at the specified directory
-    path as SimpleITK image
-
-    :param dicom_folder:
-    :return: SimpleITK.Image
+    Size, origin, spacing and direction of an LPS orientated image.
+    Held in place of the CT image so the converter does not keep the
+    CT pixel data alive while it works through the segmentations.
     """
-    reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(dicom_folder)
-    reader.SetFileNames(dicom_names)
-    return reader.Execute()
+    size: tuple
+    origin: tuple
+    spacing: tuple
+    direction: tuple
+
+    @classmethod
+    def from_image(cls, image: sitk.Image) -> "SeriesGeometry":
+        """
+        Capture the geometry of a SimpleITK image
+
+        :param image:
+        :return: SeriesGeometry
+        """
+        return cls(image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+
+    def apply_to(self, image: sitk.Image) -> None:
+        """
+        Stamp this geometry onto an image of the same size,
+        mirroring SimpleITK's CopyInformation.
+
+        :param image:
+        :return: None
+        """
+        if image.GetSize() != self.size:
+            raise RuntimeError(f"Image size {image.GetSize()} does not match the DICOM series size {self.size}")
+        image.SetOrigin(self.origin)
+        image.SetSpacing(self.spacing)
+        image.SetDirection(self.direction)
+
 
 # Resample segment to match dicom series
-def _resample_seg_to_ct(ct_image: sitk.Image, seg_image: sitk.Image) -> sitk.Image:
+def _resample_seg_to_ct(geometry: SeriesGeometry, seg_image: sitk.Image) -> sitk.Image:
     """
     Resample the segmentation image to match the CT image's grid.
 
-    :param ct_image:
+    :param geometry:
     :param seg_image:
     :return: SimpleITK.Image
     """
     resample = sitk.ResampleImageFilter()
-    resample.SetReferenceImage(ct_image)
+    resample.SetSize(geometry.size)
+    resample.SetOutputOrigin(geometry.origin)
+    resample.SetOutputSpacing(geometry.spacing)
+    resample.SetOutputDirection(geometry.direction)
     resample.SetInterpolator(sitk.sitkNearestNeighbor)
     resample.SetTransform(sitk.Transform())
     return resample.Execute(seg_image)
@@ -46,6 +85,10 @@ def _validate_inputs(nifti_path: str, dicom_path: str, output_path: str) -> None
     if not nifti_dir.is_dir():
         raise ValueError(f"Invalid NIfTI directory: {nifti_path}")
 
+    _validate_output(dicom_path, output_path)
+
+def _validate_output(dicom_path: str, output_path: str) -> None:
+    """Validates the DICOM series and output paths."""
     dicom_dir = Path(dicom_path)
     if not dicom_dir.is_dir():
         raise ValueError(f"Invalid DICOM directory: {dicom_path}")
@@ -54,15 +97,339 @@ def _validate_inputs(nifti_path: str, dicom_path: str, output_path: str) -> None
     if not output_file.parent.is_dir():
         raise ValueError(f"Invalid output directory: {output_file.parent}")
 
-def nifti_to_rtstruct_conversion(nifti_path: str, dicom_path: str, output_path: str) -> bool:
+def load_series_geometry(dicom_path: str) -> SeriesGeometry:
+    """
+    Read the LPS geometry of the DICOM series from its headers,
+    without decoding its pixel data.
+
+    :param dicom_path:
+    :return: SeriesGeometry
+    """
+    # Geometry of the series orientated to dicom standard (Left, Posterior, Superior)
+    return SeriesGeometry(*orient_lps(*series_geometry(series_files(dicom_path))))
+
+
+def _structure_name(nifti_file: str) -> str:
+    """
+    Get the structure name of a NIfTI segmentation from its file name,
+    e.g. /path/lung_upper_lobe_left.nii.gz -> lung_upper_lobe_left
+
+    :param nifti_file:
+    :return: str
+    """
+    nifti_file_name = os.path.basename(nifti_file)
+    return os.path.splitext(os.path.splitext(nifti_file_name)[0])[0]
+
+
+def _load_series_headers(dicom_path: str) -> list:
+    """
+    Read the headers of the CT slices in the order rt_utils expects,
+    without their pixel data. rt_utils only needs the headers to build
+    and contour an RTStruct, but would otherwise load every slice whole.
+
+    :param dicom_path:
+    :return: list of pydicom datasets sorted by slice position
+    """
+    series_data = [dcmread(path, stop_before_pixels=True) for path in series_files(dicom_path)]
+    series_data.sort(key=image_helper.get_slice_position)
+    return series_data
+
+
+def _create_rtstruct(dicom_path: str) -> RTStruct:
+    """
+    Create an empty RTStruct for the series, see RTStructBuilder.create_new.
+
+    :param dicom_path:
+    :return: rt_utils RTStruct
+    """
+    series_data = _load_series_headers(dicom_path)
+    return RTStruct(series_data, ds_helper.create_rtstruct_dataset(series_data))
+
+
+def _open_existing_rtstruct(dicom_path: str, rtstruct_path: str):
+    """
+    Open a previously generated RTStruct for an incremental update,
+    see RTStructBuilder.create_from.
+
+    :param dicom_path:
+    :param rtstruct_path:
+    :return: rt_utils RTStruct or None if the file cannot be reused for this series
+    """
+    try:
+        series_data = _load_series_headers(dicom_path)
+        ds = dcmread(rtstruct_path)
+        RTStructBuilder.validate_rtstruct(ds)
+        RTStructBuilder.validate_rtstruct_series_references(ds, series_data)
+        return RTStruct(series_data, ds)
+    except Exception as e:
+        logging.warning(f"Existing RTStruct {rtstruct_path} cannot be updated, regenerating it: {e}")
+        return None
+
+
+def _remove_rois(rtstruct, names: set[str]) -> None:
+    """
+    Remove ROIs from the RTStruct dataset and renumber the remaining ones.
+    rt_utils numbers a new ROI as len(StructureSetROISequence) + 1, so the
+    remaining ROIs must stay numbered 1..n for later additions not to clash.
+
+    :param rtstruct: rt_utils RTStruct to remove the ROIs from
+    :param names: names of the ROIs to remove
+    :return: None
+    """
+    ds = rtstruct.ds
+    removed_numbers = {int(roi.ROINumber) for roi in ds.StructureSetROISequence if roi.ROIName in names}
+    if not removed_numbers:
+        return
+
+    ds.StructureSetROISequence = [
+        roi for roi in ds.StructureSetROISequence if int(roi.ROINumber) not in removed_numbers
+    ]
+    ds.ROIContourSequence = [
+        contour for contour in ds.ROIContourSequence if int(contour.ReferencedROINumber) not in removed_numbers
+    ]
+    ds.RTROIObservationsSequence = [
+        observation for observation in ds.RTROIObservationsSequence
+        if int(observation.ReferencedROINumber) not in removed_numbers
+    ]
+
+    # Map the old ROI numbers onto a contiguous 1..n range
+    new_numbers = {
+        int(roi.ROINumber): number for number, roi in enumerate(ds.StructureSetROISequence, start=1)
+    }
+    for roi in ds.StructureSetROISequence:
+        roi.ROINumber = new_numbers[int(roi.ROINumber)]
+    for contour in ds.ROIContourSequence:
+        contour.ReferencedROINumber = new_numbers[int(contour.ReferencedROINumber)]
+    for observation in ds.RTROIObservationsSequence:
+        observation.ReferencedROINumber = new_numbers[int(observation.ReferencedROINumber)]
+        observation.ObservationNumber = observation.ReferencedROINumber
+
+
+def _add_nifti_roi(rtstruct, geometry: SeriesGeometry, nifti_file: str) -> None:
+    """
+    Load a single NIfTI segmentation, contour it into the RTStruct and
+    drop the mask. Only one ROI's voxels are alive at any time, the
+    contours are appended to the ROIContourSequence and
+    StructureSetROISequence as soon as they are generated.
+
+    :param rtstruct: rt_utils RTStruct to append the ROI to
+    :param geometry: geometry of the LPS orientated DICOM series
+    :param nifti_file: path to the NIfTI segmentation
+    :return: None
+    """
+    # Get structure name
+    structure_name = _structure_name(nifti_file)
+
+    # Log progress
+    logging.info(f"Converting {os.path.basename(nifti_file)} to DICOM RTStruct")
+
+    # Load segmentation nifti image and orientate it to the dicom standard
+    with span("read"):
+        nifti_img = sitk.ReadImage(nifti_file)
+    with span("orient"):
+        nifti_img = sitk.DICOMOrient(nifti_img, 'LPS')
+
+        # Ensure orientations match
+        geometry.apply_to(nifti_img)
+
+    # Resample segmentation to match CT, releasing the source image straight away
+    with span("resample"):
+        aligned_seg_image = _resample_seg_to_ct(geometry, nifti_img)
+    del nifti_img
+
+    with span("add_roi"):
+        # Build the bool mask for rt_util input from a view of the image buffer,
+        # so the voxels are not copied twice
+        nifti_array = sitk.GetArrayViewFromImage(aligned_seg_image) != 0
+        del aligned_seg_image
+
+        # Transpose the array before passing to rt_util as expects (y, x, z) configuration
+        rtstruct.add_roi(mask=np.transpose(nifti_array, (1, 2, 0)), name=structure_name)
+        del nifti_array
+
+
+def _add_label_roi(rtstruct, label_map: np.ndarray, box: tuple | None, label: int, name: str) -> None:
+    """
+    Contour one label of an aligned label map into the RTStruct. The mask is
+    only compared within the label's bounding box.
+
+    :param rtstruct: rt_utils RTStruct to append the ROI to
+    :param label_map: label map on the CT grid, (z, y, x)
+    :param box: bounding box of the label in label_map, None if it is empty
+    :param label:
+    :param name: structure name
+    :return: None
+    """
+    logging.info(f"Converting {name} to DICOM RTStruct")
+
+    with span("add_roi"):
+        mask = np.zeros(label_map.shape, dtype=bool)
+        if box is not None:
+            mask[box] = label_map[box] == label
+
+        # Transpose the array before passing to rt_util as expects (y, x, z) configuration
+        rtstruct.add_roi(mask=np.transpose(mask, (1, 2, 0)), name=name)
+        del mask
+
+
+def _nifti_files(nifti_path: str) -> dict[str, str]:
+    """
+    The NIfTI segmentations in a directory.
+
+    :param nifti_path:
+    :return: dict of {structure_name: path}, sorted by path
+    """
+    nifti_files_list: list[str] = sorted(glob.glob(os.path.join(nifti_path, "*.nii.gz")))
+    return {_structure_name(img): img for img in nifti_files_list}
+
+
+@contextlib.contextmanager
+def _logged_conversion_errors():
+    """
+    Logs the errors of a conversion by type before passing them on.
+    """
+    try:
+        yield
+    except SegmentationCancelled:
+        logging.info("NIfTI to RTStruct conversion cancelled")
+        raise
+    except FileNotFoundError as e:
+        logging.error(f"FileNotFoundError: {e}")
+        raise
+    except ValueError as e:
+        logging.error(f"ValueError: {e}")
+        raise
+    except RuntimeError as e:
+        logging.error(f"RuntimeError: {e}")
+        raise
+    except Exception as e:
+        logging.error(f"An unexpected error occurred: {type(e).__name__}: {e}")
+        raise
+
+
+def _fingerprint(name: str, source, previous: dict | None) -> dict:
+    """
+    Fingerprint a structure for the manifest. The hashes of the previous
+    fingerprint are kept while the structure is unchanged, so a structure
+    converted from a label map and later from its NIfTI file (or the other
+    way round) is compared by the same kind of hash.
+
+    :param name:
+    :param source: NIfTI file path or the LabelVolume holding the structure
+    :param previous: fingerprint recorded for the structure on the last run
+    :return: dict
+    """
+    if isinstance(source, LabelVolume):
+        fingerprint = source.fingerprint(name)
+    else:
+        fingerprint = file_fingerprint(source, previous)
+    if previous and same_content(previous, fingerprint):
+        fingerprint = {**previous, **fingerprint}
+    return fingerprint
+
+
+def _convert_structures(sources: dict, dicom_path: str, output_path: str, incremental: bool,
+                        cancel_token, progress) -> bool:
+    """
+    Write the structures to the RTStruct at output_path, see nifti_to_rtstruct_conversion.
+
+    :param sources: dict of {structure_name: NIfTI file path or the LabelVolume holding the structure}
+    :return: True if the conversion was successful
+    """
+    # Fingerprint the segmentations against the previous run's manifest
+    manifest_path = manifest_path_for(output_path)
+    previous = load_manifest(manifest_path) if incremental and os.path.isfile(output_path) else None
+    with span("fingerprint"):
+        structures = {
+            name: _fingerprint(name, source, (previous or {}).get(name))
+            for name, source in sources.items()
+        }
+
+    with span("open_rtstruct"):
+        rtstruct = _open_existing_rtstruct(dicom_path, output_path) if previous is not None else None
+
+    if rtstruct is None:
+        # Build the new rtstruct
+        with span("create_rtstruct"):
+            rtstruct = _create_rtstruct(dicom_path)
+        structures_to_add = list(sources)
+    else:
+        added, changed, removed = diff_structures(previous, structures)
+        if not (added or changed or removed):
+            logging.info(f"RTStruct is up to date: {output_path}")
+            save_manifest(manifest_path, structures)
+            return True
+
+        logging.info(f"Updating RTStruct: {len(added)} new, {len(changed)} changed, {len(removed)} removed")
+        _remove_rois(rtstruct, set(changed) | set(removed))
+        structures_to_add = added + changed
+
+    # Keep only the geometry of the CT, not its pixel data
+    with span("load_geometry"):
+        geometry = load_series_geometry(dicom_path) if structures_to_add else None
+
+    # Label volumes are aligned to the CT grid on their first structure, then shared by the others
+    aligned = {}
+
+    for index, name in enumerate(structures_to_add, start=1):
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+
+        source = sources[name]
+        try:
+            with span("roi", structure=name):
+                if isinstance(source, LabelVolume):
+                    if id(source) not in aligned:
+                        # Kept by the label volume, already aligned if its overlay was shown in the viewer
+                        label_map = source.aligned_to(geometry)
+                        aligned[id(source)] = label_map, label_boxes(label_map, source.labels)
+                    label_map, boxes = aligned[id(source)]
+                    label = source.label_of(name)
+                    _add_label_roi(rtstruct, label_map, boxes[label], label, name)
+                else:
+                    _add_nifti_roi(rtstruct, geometry, source)
+        except RuntimeError as e:
+            logging.error(f"Error reading or processing segmentation {name}: {e}")
+            raise # Re-raise the exception after logging
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while processing segmentation {name}: {e}")
+            raise
+
+        if progress is not None:
+            progress(index, len(structures_to_add))
+
+    with span("save"):
+        rtstruct.save(output_path)
+        save_manifest(manifest_path, structures)
+    return True
+
+
+def nifti_to_rtstruct_conversion(nifti_path: str, dicom_path: str, output_path: str,
+                                 incremental: bool = False, cancel_token=None, progress=None) -> bool:
 
     """Converts NIfTI image files to an RT Struct file based on the corresponding
     DICOM series.
 
+    The conversion streams the structures: each NIfTI file is loaded,
+    contoured, appended to the RTStruct dataset and its mask freed before
+    the next one is read. Peak memory is roughly one ROI plus the CT
+    geometry, regardless of how many structures are converted.
+
+    A sidecar manifest (<output_path>.manifest.json) records the size,
+    mtime and hash of every converted NIfTI file. In incremental mode an
+    existing RTStruct is opened and only new or changed structures are
+    contoured, while structures whose NIfTI file is gone are removed.
+
     Args:
         nifti_path: Path to the directory containing NIfTI files.
         dicom_path: Path to the directory containing the DICOM series.
         output_path: Path to save the generated RTStruct file.
+        incremental: Update the existing RTStruct at output_path instead of
+            regenerating it, when a manifest from a previous run exists.
+        cancel_token: Optional CancellationToken checked before each
+            structure. Nothing is written when the conversion is cancelled.
+        progress: Optional function called with (converted, total) after
+            each structure is added.
 
     Returns:
         True if the conversion was successful.
@@ -72,82 +439,95 @@ def nifti_to_rtstruct_conversion(nifti_path: str, dicom_path: str, output_path:
         ValueError: If input paths are invalid or no NIfTI files are found.
         RuntimeError: If a NIfTI file cannot be read or processed, or if the
         RTStruct cannot be saved.
+        SegmentationCancelled: If cancel_token was cancelled.
     """
 
     logging.info("Converting NIfTI to RTStruct...")
     print("Converting NIfTI to RTStruct...")
 
-    try:
+    with _logged_conversion_errors():
         # Validate inputs
         _validate_inputs(nifti_path, dicom_path, output_path)
 
-        # Load the DICOM series as image using SimpleITK
-        dicom_img = _load_dicom_series_as_sitk(dicom_path)
+        # rt_utils always saves with a .dcm suffix, keep the manifest next to that file
+        if not output_path.endswith(".dcm"):
+            output_path += ".dcm"
 
-        # Orientate the dicom image to dicom standard (Left, Posterior, Superior)
-        dicom_img = sitk.DICOMOrient(dicom_img, 'LPS')
-
-        # Build the new rtstruct
-        rtstruct = RTStructBuilder.create_new(dicom_series_path=dicom_path)
-
-        # Get the list of nifti files from path
-        nifti_files_list: list[str] = glob.glob(os.path.join(nifti_path, "*.nii.gz"))
+        # Get the nifti files from path
+        nifti_files = _nifti_files(nifti_path)
 
         # Raise error if no Nifti files found
-        if not nifti_files_list:
+        if not nifti_files:
             logging.error(f"No NIfTI files found at: {nifti_path}")
             raise ValueError(f"No NIfTI files found at: {nifti_path}")
 
-        for img in nifti_files_list:
-            try:
-                # Get the file name from path (img)
-                nifti_file_name = os.path.basename(img)
-
-                # Get structure name
-                structure_name = os.path.splitext(os.path.splitext(nifti_file_name)[0])[0]
+        return _convert_structures(nifti_files, dicom_path, output_path, incremental, cancel_token, progress)
 
-                # Log progress
-                logging.info(f"Converting {os.path.basename(img)} to DICOM RTStruct")
 
-                # Load segmentation nifti image
-                nifti_img = sitk.ReadImage(img)
+def label_volume_to_rtstruct_conversion(label_volume: LabelVolume, dicom_path: str, output_path: str,
+                                        nifti_path: str | None = None, incremental: bool = False,
+                                        cancel_token=None, progress=None) -> bool:
+    """Converts an in-memory label map, as returned by TotalSegmentator, to an
+    RT Struct file based on the corresponding DICOM series.
 
-                # Orientate nifti image to the dicom standard
-                nifti_img = sitk.DICOMOrient(nifti_img, 'LPS')
+    Works as nifti_to_rtstruct_conversion without reading NIfTI files: the
+    label map is orientated and resampled onto the CT grid once, and each
+    structure's mask is taken from it within the structure's bounding box.
+    The manifest records a hash of each structure's voxels, completed with
+    the fingerprint of its NIfTI file by record_nifti_fingerprints.
 
-                # Ensure orientations match
-                nifti_img.CopyInformation(dicom_img)
+    Args:
+        label_volume: The LabelVolume to convert.
+        dicom_path: Path to the directory containing the DICOM series.
+        output_path: Path to save the generated RTStruct file.
+        nifti_path: Optional directory of NIfTI files from earlier runs. Their
+            structures are converted as well, so an incremental update keeps
+            them; a structure of the label volume replaces its NIfTI file.
+        incremental: See nifti_to_rtstruct_conversion.
+        cancel_token: See nifti_to_rtstruct_conversion.
+        progress: See nifti_to_rtstruct_conversion.
 
-                # Resample segmentation to match CT
-                aligned_seg_image = _resample_seg_to_ct(dicom_img, nifti_img)
+    Returns:
+        True if the conversion was successful.
 
-                # Access image data as array and convert to bool type for mask rt_util input
-                nifti_array = sitk.GetArrayFromImage(aligned_seg_image).astype(bool)
+    Raises:
+        As nifti_to_rtstruct_conversion, ValueError if the label volume holds no structure.
+    """
+    logging.info("Converting label volume to RTStruct...")
 
-                # Transpose the array before passing to rt_util as expects (y, x, z) configuration
-                nifti_array = np.transpose(nifti_array, (1, 2, 0))
+    with _logged_conversion_errors():
+        _validate_output(dicom_path, output_path)
+        if not output_path.endswith(".dcm"):
+            output_path += ".dcm"
 
-                rtstruct.add_roi(mask=nifti_array, name=structure_name)
-            except RuntimeError as e:
-                logging.error(f"Error reading or processing NIfTI file: {img}: {e}")
-                raise # Re-raise the exception after logging
-            except Exception as e:
-                logging.error(f"An unexpected error occurred while processing NIfTI file {img}: {e}")
-                raise
+        if not label_volume.labels:
+            raise ValueError("The label volume holds no structure")
 
-        rtstruct.save(output_path)
-        return True
+        sources = _nifti_files(nifti_path) if nifti_path is not None and os.path.isdir(nifti_path) else {}
+        sources.update({name: label_volume for name in label_volume.names})
+        sources = dict(sorted(sources.items()))
+        return _convert_structures(sources, dicom_path, output_path, incremental, cancel_token, progress)
 
-    except FileNotFoundError as e:
-        logging.error(f"FileNotFoundError: {e}")
-        raise
-    except ValueError as e:
-        logging.error(f"ValueError: {e}")
-        raise
-    except RuntimeError as e:
-        logging.error(f"RuntimeError: {e}")
-        raise
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {type(e).__name__}: {e}")
-        raise
 
+def record_nifti_fingerprints(output_path: str, nifti_files: dict[str, str]) -> None:
+    """
+    Record the fingerprints of NIfTI files written from a converted label
+    volume in the RTStruct's manifest, next to the voxel hashes of their
+    structures, so later conversions from the files as well as from a label
+    volume see them unchanged. Structures the manifest does not hold are left out.
+
+    :param output_path: path of the RTStruct
+    :param nifti_files: dict of {structure_name: path}
+    :return: None
+    """
+    if not output_path.endswith(".dcm"):
+        output_path += ".dcm"
+    manifest_path = manifest_path_for(output_path)
+    structures = load_manifest(manifest_path)
+    if structures is None:
+        return
+
+    for name, nifti_file in nifti_files.items():
+        if name in structures:
+            structures[name] = {**structures[name], **file_fingerprint(nifti_file)}
+    save_manifest(manifest_path, structures)
@@ -0,0 +1,315 @@
+"""Structured progress of the segmentation workflow.
+
+Each stage of the workflow (staging, preview, inference, conversion) reports
+ProgressEvents carrying the units completed out of the total (files
+staged, inference patches, structures converted), the throughput and the
+estimated time remaining. overall_percent() turns an event into the
+progress of the whole workflow for a progress bar, and JsonLinesProgressLog
+records the events as JSON lines to compare throughput between runs.
+"""
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+# Share of the whole workflow's duration taken by each stage, in workflow order
+STAGE_WEIGHTS = {
+    "staging": 0.05,
+    # Only run for a preview ahead of the full resolution inference, which it does not shorten
+    "preview": 0.0,
+    "inference": 0.85,
+    "conversion": 0.10,
+}
+
+# Events of a stage are emitted at most this often, besides its first and last event
+MIN_EVENT_INTERVAL = 0.25
+
+DEFAULT_PROGRESS_LOG = Path.home().joinpath("OnkoDICOM", "logs", "segmentation_progress.jsonl")
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    """Progress of one stage of the workflow of a study.
+
+    :param stage: one of STAGE_WEIGHTS
+    :param completed: units completed so far
+    :param total: units the stage has to complete, 0 if unknown
+    :param unit: what is counted, e.g. "files", "patches", "structures"
+    :param fraction: completed share of the stage, 0.0 to 1.0
+    :param elapsed: seconds since the stage started
+    :param throughput: units per second, None until measurable
+    :param eta: estimated seconds until the stage completes, None if unknown
+    :param study: study directory
+    :param message: extra detail, e.g. the model part being predicted
+    :param timestamp: time.time() of the event
+    """
+    stage: str
+    completed: int
+    total: int
+    unit: str
+    fraction: float
+    elapsed: float
+    throughput: float | None = None
+    eta: float | None = None
+    study: str = ""
+    message: str = ""
+    timestamp: float = 0.0
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    def describe(self) -> str:
+        text = f"{self.stage.capitalize()}: {self.completed}/{self.total} {self.unit}"
+        if self.message:
+            text += f" ({self.message})"
+        if self.throughput:
+            text += f", {self.throughput:.1f} {self.unit}/s"
+        if self.eta is not None:
+            text += f", {format_duration(self.eta)} left"
+        return text
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
+
+
+def overall_percent(event: ProgressEvent) -> int:
+    """
+    Progress of the whole workflow when the event's stage is at the event's fraction.
+
+    :param event:
+    :return: int, 0 to 100
+    """
+    done = 0.0
+    for stage, weight in STAGE_WEIGHTS.items():
+        if stage == event.stage:
+            done += weight * min(1.0, max(0.0, event.fraction))
+            break
+        done += weight
+    return int(round(100 * done / sum(STAGE_WEIGHTS.values())))
+
+
+class ProgressTracker:
+    """Measures one stage and emits its ProgressEvents.
+
+    Throughput and ETA are derived from the units completed since the
+    stage started. Events are throttled to MIN_EVENT_INTERVAL, the final
+    event of the stage is always emitted.
+
+    :param emit: called with each ProgressEvent
+    :param stage:
+    :param total: units the stage has to complete
+    :param unit:
+    :param study:
+    """
+
+    def __init__(self, emit, stage: str, total: int, unit: str, study: str = "") -> None:
+        self._emit = emit
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.study = study
+        self.completed = 0
+        self._fraction = 0.0
+        self._message = ""
+        self._started = time.monotonic()
+        self._last_emitted = None
+        self._finished = False
+
+    def advance(self, units: int = 1) -> None:
+        self.update(self.completed + units)
+
+    def update(self, completed: int, total: int | None = None, fraction: float | None = None,
+               message: str | None = None) -> None:
+        """
+        Record the units completed and emit an event unless throttled.
+
+        :param completed:
+        :param total: replaces the stage total, e.g. once it becomes known
+        :param fraction: completed share of the stage when it is not completed / total,
+                         e.g. for a stage made of several parts
+        :param message: detail shown with the event
+        :rtype: None
+        """
+        self.completed = completed
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self._message = message
+        if fraction is None:
+            fraction = completed / self.total if self.total else 0.0
+        self._fraction = min(1.0, max(0.0, fraction))
+
+        if self._finished:
+            return
+        now = time.monotonic()
+        self._finished = self._fraction >= 1.0
+        if not self._finished and self._last_emitted is not None and now - self._last_emitted < MIN_EVENT_INTERVAL:
+            return
+        self._last_emitted = now
+        self._emit(self._event(now))
+
+    def finish(self) -> None:
+        """
+        Emit the final event of the stage, unless it was already emitted.
+
+        :rtype: None
+        """
+        self.update(max(self.completed, self.total), fraction=1.0)
+
+    def _event(self, now: float) -> ProgressEvent:
+        elapsed = now - self._started
+        throughput = self.completed / elapsed if self.completed and elapsed > 0 else None
+        eta = None
+        if 0.0 < self._fraction:
+            eta = elapsed * (1.0 - self._fraction) / self._fraction
+        return ProgressEvent(self.stage, self.completed, self.total, self.unit, self._fraction, elapsed,
+                             throughput, eta, self.study, self._message, time.time())
+
+
+class InferenceOutputParser:
+    """Derives inference progress from TotalSegmentator's console output.
+
+    nnU-Net draws a tqdm bar over the sliding-window patches of each model
+    ("12/40 [00:05<00:11, 2.3it/s]"), and TotalSegmentator announces the
+    models of multi-part tasks ("Predicting part 2 of 5 ..."). Text is
+    passed on to the tracker as it arrives, in chunks of any size.
+
+    :param tracker: ProgressTracker of the inference stage
+    """
+
+    _PATTERN = re.compile(r"part (?P<part>\d+) of (?P<parts>\d+)|(?P<completed>\d+)/(?P<total>\d+) \[")
+
+    def __init__(self, tracker: ProgressTracker) -> None:
+        self.tracker = tracker
+        self.part = 1
+        self.parts = 1
+        self.fraction = 0.0
+        self._buffer = ""
+
+    def feed(self, text: str) -> None:
+        # Keep the end of the previous chunk, a match may span two chunks.
+        # Matches lying wholly in the kept text were handled with that chunk
+        previous_length = len(self._buffer)
+        text = self._buffer + text
+        self._buffer = text[-64:]
+
+        for match in self._PATTERN.finditer(text):
+            if match.end() <= previous_length:
+                continue
+            if match.group("part"):
+                self.part, self.parts = int(match.group("part")), max(1, int(match.group("parts")))
+                continue
+
+            completed, total = int(match.group("completed")), int(match.group("total"))
+            if total == 0:
+                continue
+            # Other bars, such as the one over the saved classes, must not move the progress back.
+            # The last patch of a part is not the end of the stage, the next part may follow
+            fraction = (self.part - 1 + completed / total) / self.parts
+            self.fraction = max(self.fraction, min(fraction, 0.999))
+            message = f"part {self.part} of {self.parts}" if self.parts > 1 else ""
+            self.tracker.update(completed, total, self.fraction, message)
+
+
+class JsonLinesProgressLog:
+    """Appends ProgressEvents to a file as JSON lines. Thread safe, and each
+    event is written with a single append so several processes may share
+    the file.
+
+    :param path: log file, its directory is created on the first event
+    """
+
+    def __init__(self, path: str = DEFAULT_PROGRESS_LOG) -> None:
+        self.path = str(path)
+        self._lock = threading.Lock()
+
+    def __call__(self, event: ProgressEvent) -> None:
+        line = event.to_json() + "\n"
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a") as log_file:
+                log_file.write(line)
+
+
+class _ThreadOutputTap:
+    """Stands in for sys.stdout or sys.stderr, writing to the stream it
+    replaced and passing the text written on a watched thread to that
+    thread's callback. Text written on other threads is only written.
+
+    :param stream: stream receiving the text
+    """
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.callbacks = {}
+
+    def write(self, text):
+        callback = self.callbacks.get(threading.get_ident())
+        if callback is not None:
+            callback(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        # Progress bars drawn for a watched thread stay plain text
+        isatty = getattr(self.stream, "isatty", None)
+        return threading.get_ident() not in self.callbacks and isatty is not None and isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_tap_lock = threading.Lock()
+
+
+def _installed_tap(name: str) -> _ThreadOutputTap:
+    """
+    The tap standing in for sys.<name>, installed over the current stream if it is not there.
+    """
+    stream = getattr(sys, name)
+    if not isinstance(stream, _ThreadOutputTap):
+        stream = _ThreadOutputTap(stream)
+        setattr(sys, name, stream)
+    return stream
+
+
+@contextlib.contextmanager
+def watch_thread_output(callback):
+    """
+    Pass the text written to sys.stdout and sys.stderr by the current thread
+    to callback within the context, while still writing it to the streams.
+    Unlike contextlib.redirect_stdout, the output of other threads, e.g. of
+    another study's pipeline stage, is not passed on, and overlapping contexts
+    on different threads may end in any order. The streams are restored when
+    the last context ends, unless they have been replaced again meanwhile.
+
+    :param callback: called with each chunk of text
+    """
+    thread = threading.get_ident()
+    with _tap_lock:
+        taps = {name: _installed_tap(name) for name in ("stdout", "stderr")}
+        for tap in taps.values():
+            tap.callbacks[thread] = callback
+    try:
+        yield
+    finally:
+        with _tap_lock:
+            for name, tap in taps.items():
+                tap.callbacks.pop(thread, None)
+                if not tap.callbacks and getattr(sys, name) is tap:
+                    setattr(sys, name, tap.stream)
@@ -1,8 +1,30 @@
 import logging
+import re
+import threading
 
-from PySide6.QtCore import QObject, Signal
+from PySide6.QtCore import QObject, QTimer, Qt, Signal
 import sys
 
+# Milliseconds between flushes of the buffered console output
+FLUSH_INTERVAL_MS = 100
+# Buffered characters which trigger a flush before the timer
+FLUSH_THRESHOLD = 8192
+
+# Text overwritten by a later carriage return on the same line
+_OVERWRITTEN_TEXT = re.compile(r"(?:[^\r\n]*\r(?!\n))+")
+
+
+def collapse_carriage_returns(text: str) -> str:
+    """
+    Drop the text of a line which a later carriage return overwrites,
+    keeping a single carriage return so the remaining text still replaces
+    the line shown so far, e.g. "a\\rb\\rc" -> "\\rc".
+
+    :param text:
+    :return: str
+    """
+    return _OVERWRITTEN_TEXT.sub("\r", text)
+
 
 class ConsoleOutputStream(QObject):
     """A QObject subclass to redirect console output to a GUI element.
@@ -10,16 +32,71 @@ class ConsoleOutputStream(QObject):
     This class intercepts text written to stdout and emits it as a Qt signal,
     allowing console output to be displayed in a GUI while maintaining original
     console visibility.
+
+    Writes are buffered and emitted in batches, every FLUSH_INTERVAL_MS or
+    once FLUSH_THRESHOLD characters are waiting, instead of once per write;
+    progress bars redrawn with carriage returns are collapsed to their last
+    state. Create the stream on the GUI thread, the text is emitted there;
+    writing to it is thread safe.
     """
     new_text = Signal(str)
+    # Asks the GUI thread to flush early, so the text is always emitted there and in order
+    _flush_requested = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._buffer = []
+        self._buffered_size = 0
+        self._flush_pending = False
+        self._lock = threading.Lock()
+        self._flush_requested.connect(self._emit_buffered, Qt.ConnectionType.QueuedConnection)
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(FLUSH_INTERVAL_MS)
+        self._timer.timeout.connect(self._emit_buffered)
+        self._timer.start()
 
     def write(self, text):
-        self.new_text.emit(text)
-        sys.__stdout__.write(text)  # Also write to original stdout for console visibility
-        sys.__stdout__.flush()
+        self._buffer_text(text, echo=True)
+        return len(text)
+
+    def write_to_gui(self, text):
+        """Buffer text for the GUI only, without echoing it to the console."""
+        self._buffer_text(text, echo=False)
+
+    def _buffer_text(self, text, echo):
+        if not text:
+            return
+        with self._lock:
+            self._buffer.append((text, echo))
+            self._buffered_size += len(text)
+            request_flush = self._buffered_size >= FLUSH_THRESHOLD and not self._flush_pending
+            self._flush_pending = self._flush_pending or request_flush
+        if request_flush:
+            self._flush_requested.emit()
 
     def flush(self):
-        sys.__stdout__.flush()
+        # Writers such as tqdm flush after every write, the timer flushes instead
+        pass
+
+    def _emit_buffered(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            buffered = self._buffer
+            self._buffer = []
+            self._buffered_size = 0
+            self._flush_pending = False
+
+        # Also write to original stdout for console visibility
+        console_text = "".join(text for text, echo in buffered if echo)
+        if console_text and sys.__stdout__ is not None:
+            sys.__stdout__.write(console_text)
+            sys.__stdout__.flush()
+        self.new_text.emit(collapse_carriage_returns("".join(text for text, _ in buffered)))
+
+    def isatty(self):
+        return False
 
 def redirect_output_to_gui(console_stream: ConsoleOutputStream):
     sys.stdout = console_stream
@@ -33,11 +110,16 @@ class QtLogHandler(logging.Handler):
 
     def emit(self, record):
         msg = self.format(record)
-        self.console_stream.new_text.emit(msg + "\n")
+        self.console_stream.write_to_gui(msg + "\n")
 
 def setup_logging(console_stream: ConsoleOutputStream):
+    logger = logging.getLogger()
+    # Only one handler per stream, however often the stream is connected
+    if any(isinstance(handler, QtLogHandler) and handler.console_stream is console_stream
+           for handler in logger.handlers):
+        return
+
     handler = QtLogHandler(console_stream)
     handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-    logger = logging.getLogger()
     logger.setLevel(logging.INFO)
-    logger.addHandler(handler)
\ No newline at end of file
+    logger.addHandler(handler)
@@ -0,0 +1,121 @@
+import logging
+import os
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> list[int]:
+    """
+    Get the CPU cores this process is allowed to run on.
+
+    :return: sorted list of core ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _set_affinity(cpus: tuple[int, ...], whole_process: bool) -> None:
+    """
+    Pin the calling thread, or every thread of the current process, to the given cores.
+    Threads and processes started afterwards by a pinned thread inherit its pinning.
+
+    :param cpus:
+    :param whole_process: pin every thread, only for processes dedicated to the run
+    :rtype: None
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU pinning is not supported on this platform")
+        return
+
+    # On Linux the affinity belongs to the thread, 0 being the calling one
+    thread_ids = [0]
+    if whole_process:
+        try:
+            thread_ids = [int(tid) for tid in os.listdir("/proc/self/task")]
+        except OSError:
+            pass
+
+    for thread_id in thread_ids:
+        try:
+            os.sched_setaffinity(thread_id, cpus)
+        except OSError:
+            # The thread may have exited since the listing
+            pass
+
+
+@dataclass(frozen=True)
+class ResourceProfile:
+    """CPU resources granted to a single segmentation run.
+
+    :param torch_threads: torch intra-op threads used by nnU-Net inference
+    :param nr_thr_resamp: TotalSegmentator resampling threads, also used as the
+                          number of nnU-Net preprocessing workers
+    :param nr_thr_saving: TotalSegmentator NIfTI saving threads
+    :param cpu_affinity: cores the run is pinned to, None to leave it unpinned
+    """
+    torch_threads: int
+    nr_thr_resamp: int = 1
+    nr_thr_saving: int = 6
+    cpu_affinity: tuple[int, ...] | None = None
+
+    @classmethod
+    def auto(cls, concurrent_runs: int = 1, slot: int = 0, pin: bool = False,
+             threads: int | None = None) -> "ResourceProfile":
+        """
+        Derive a profile from the available cores, splitting them evenly
+        between concurrent runs so they do not oversubscribe the machine.
+
+        :param concurrent_runs: number of runs sharing the machine
+        :param slot: index of this run among the concurrent runs, selects its cores when pinning
+        :param pin: pin the run to its share of the cores
+        :param threads: threads per run, overrides the even split
+        :return: ResourceProfile
+        """
+        cpus = available_cpus()
+        per_run = threads or max(1, len(cpus) // max(1, concurrent_runs))
+        per_run = max(1, min(per_run, len(cpus)))
+
+        cpu_affinity = None
+        if pin:
+            start = (slot * per_run) % len(cpus)
+            cpu_affinity = tuple((cpus + cpus)[start:start + per_run])
+
+        return cls(
+            torch_threads=per_run,
+            # Preprocessing and saving run alongside inference, keep them to a fraction of the share
+            nr_thr_resamp=max(1, min(6, per_run // 8)),
+            nr_thr_saving=max(1, min(6, per_run // 4)),
+            cpu_affinity=cpu_affinity,
+        )
+
+    def totalsegmentator_kwargs(self) -> dict:
+        """
+        Keyword arguments passing the profile's thread counts to totalsegmentator().
+
+        :return: dict
+        """
+        return {"nr_thr_resamp": self.nr_thr_resamp, "nr_thr_saving": self.nr_thr_saving}
+
+    def apply_to_current_process(self, whole_process: bool = False) -> None:
+        """
+        Apply the torch thread count and CPU pinning to the current process.
+        Only the calling thread is pinned unless whole_process is set, so running
+        in-process leaves the GUI thread and other jobs' threads unpinned. Torch's
+        worker threads and nnU-Net's preprocessing workers started afterwards
+        inherit the pinning, torch threads left from an earlier run keep theirs.
+
+        :param whole_process: pin every thread, only for processes dedicated to the run
+        :rtype: None
+        """
+        import torch
+        torch.set_num_threads(self.torch_threads)
+
+        if self.cpu_affinity:
+            _set_affinity(self.cpu_affinity, whole_process)
+
+    def describe(self) -> str:
+        pinning = f", pinned to cores {list(self.cpu_affinity)}" if self.cpu_affinity else ""
+        return (f"{self.torch_threads} inference threads, {self.nr_thr_resamp} preprocessing, "
+                f"{self.nr_thr_saving} saving{pinning}")
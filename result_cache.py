@@ -0,0 +1,467 @@
+"""Content-addressed cache of segmentation results.
+
+Entries are keyed by a digest of the input series (SeriesInstanceUID and
+file contents of every instance), the TotalSegmentator task, the fast flag,
+the structure subset if only some structures were segmented and the
+installed TotalSegmentator version, so re-running a task on an
+unchanged study restores the NIfTI segmentations (and the RTSTRUCT, when
+the study has none yet) instead of repeating the inference.
+
+Stored files are private, read-only copies. Segmentations are restored by
+hardlink when the cache and the study share a filesystem, or by copy
+otherwise; detach_hardlinks() gives a study back its own copies before
+they are overwritten. The RTSTRUCT, which the incremental conversion
+rewrites in place, is always restored by copy. The least recently used
+entries are evicted once the cache grows beyond its size limit.
+
+Example:
+    python result_cache.py list
+    python result_cache.py prune --max-size 10
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from ignore_files_in_dir import ignore_func
+from segmentation_manifest import load_manifest, manifest_path_for
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the key derivation or the entry layout changes
+CACHE_FORMAT_VERSION = 2
+CACHE_DIR_ENV = "ONKODICOM_RESULT_CACHE_DIR"
+DEFAULT_CACHE_DIR = Path.home().joinpath("OnkoDICOM", "cache", "segmentations")
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+_ENTRY_INFO = "entry.json"
+_SEGMENTATIONS = "segmentations"
+_RTSTRUCT = "rtss.dcm"
+_RTSTRUCT_MANIFEST = "rtss.dcm.manifest.json"
+
+
+def model_version() -> str:
+    """
+    Version of the installed TotalSegmentator, which determines the model weights used.
+
+    :return: str
+    """
+    from importlib.metadata import PackageNotFoundError, version
+    try:
+        return version("TotalSegmentator")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def _sha256_of_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Hash a file's contents in chunks, without holding the file in memory.
+
+    :param path:
+    :param chunk_size:
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def series_digest(dicom_dir: str) -> tuple[str, str]:
+    """
+    Digest the DICOM series in dicom_dir over the SeriesInstanceUID and the
+    file contents of each image instance, in SOPInstanceUID order. Only the
+    headers are parsed, the files are hashed as they are read. Files the
+    segmentation workflow does not copy (RTSTRUCTs, segmentations) are skipped.
+
+    :param dicom_dir:
+    :return: (SeriesInstanceUID, hex digest)
+    :raises ValueError: if the directory holds no DICOM image
+    """
+    import pydicom
+
+    contents = os.listdir(dicom_dir)
+    ignored = set(ignore_func(dicom_dir, contents))
+
+    instances = []
+    series_uids = set()
+    for name in contents:
+        path = os.path.join(dicom_dir, name)
+        if name in ignored or not os.path.isfile(path):
+            continue
+        try:
+            dataset = pydicom.dcmread(path, stop_before_pixels=True)
+        except pydicom.errors.InvalidDicomError:
+            continue
+        # Images, told apart by their header as the pixel data is not read
+        if "Rows" not in dataset:
+            continue
+        series_uids.add(str(dataset.SeriesInstanceUID))
+        instances.append((str(dataset.SOPInstanceUID), _sha256_of_file(path)))
+
+    if not instances:
+        raise ValueError(f"No DICOM images found at: {dicom_dir}")
+
+    series_uid = "\\".join(sorted(series_uids))
+    digest = hashlib.sha256(series_uid.encode())
+    for sop_instance_uid, file_digest in sorted(instances):
+        digest.update(sop_instance_uid.encode())
+        digest.update(file_digest.encode())
+    return series_uid, digest.hexdigest()
+
+
+def _link_or_copy(source: str, destination: str, link: bool = True) -> None:
+    """
+    Hardlink source to destination, copying when linking is not possible
+    (different filesystems, or a filesystem without hardlinks).
+
+    :param source:
+    :param destination: replaced if it exists
+    :param link: False to always copy
+    :rtype: None
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if link:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+    # The copy keeps the cache file's read-only mode
+    os.chmod(destination, os.stat(destination).st_mode | stat.S_IWUSR)
+
+
+def detach_hardlinks(directory: str) -> None:
+    """
+    Replace hardlinked files in directory with private copies, so writing
+    them cannot change the cache entry they were restored from.
+
+    :param directory:
+    :rtype: None
+    """
+    if not os.path.isdir(directory):
+        return
+
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or os.stat(path).st_nlink < 2:
+            continue
+        temporary_path = f"{path}.detach"
+        shutil.copy2(path, temporary_path)
+        os.chmod(temporary_path, os.stat(temporary_path).st_mode | stat.S_IWUSR)
+        os.replace(temporary_path, path)
+
+
+def _retry_writable(function, path: str, _) -> None:
+    """rmtree error handler making a read-only cache file writable and retrying its removal."""
+    os.chmod(path, stat.S_IWUSR | stat.S_IRUSR)
+    function(path)
+
+
+def _directory_size(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(directory) for name in files
+    )
+
+
+@dataclass
+class CacheEntry:
+    """Description of a cached segmentation result, stored as entry.json."""
+    key: str
+    series_uid: str
+    task: str
+    fast: bool
+    model_version: str
+    source: str
+    segmentations: list[str] = field(default_factory=list)
+    roi_subset: list[str] | None = None
+    has_rtstruct: bool = False
+    size: int = 0
+    created: float = 0.0
+    last_used: float = 0.0
+
+
+class ResultCache:
+    """Cache of segmentation results on disk, see the module docstring.
+
+    :param root: cache directory, defaults to $ONKODICOM_RESULT_CACHE_DIR or ~/OnkoDICOM/cache/segmentations
+    :param max_bytes: size the cache is pruned to after each store
+    """
+
+    def __init__(self, root: str | None = None, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.root = Path(root or os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+
+    def key_for(self, dicom_dir: str, task: str, fast: bool, roi_subset=None) -> tuple[str, str]:
+        """
+        Compute the cache key of running task on the series in dicom_dir.
+
+        :param dicom_dir:
+        :param task:
+        :param fast:
+        :param roi_subset: structures segmented, None for the whole task
+        :return: (key, SeriesInstanceUID)
+        """
+        series_uid, instances_digest = series_digest(dicom_dir)
+        description = {
+            "format": CACHE_FORMAT_VERSION,
+            "series": series_uid,
+            "instances": instances_digest,
+            "task": task,
+            "fast": bool(fast),
+            "model": model_version(),
+            "roi_subset": sorted(roi_subset) if roi_subset else None,
+        }
+        description = json.dumps(description, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest(), series_uid
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.root.joinpath(key[:2], key)
+
+    def _write_info(self, entry_dir: Path, entry: CacheEntry) -> None:
+        info_path = entry_dir.joinpath(_ENTRY_INFO)
+        temporary_path = info_path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(asdict(entry), indent=2))
+        os.replace(temporary_path, info_path)
+
+    def lookup(self, key: str) -> CacheEntry | None:
+        """
+        :param key:
+        :return: the entry stored under key, or None
+        """
+        try:
+            info = json.loads(self._entry_dir(key).joinpath(_ENTRY_INFO).read_text())
+            return CacheEntry(**info)
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def restore(self, key: str, output_dir: str, output_rt: str | None = None) -> bool:
+        """
+        Restore a cached result into a study. The RTSTRUCT and its manifest
+        are only restored when output_rt does not exist yet, an existing
+        RTSTRUCT is left for the incremental conversion to update.
+
+        :param key:
+        :param output_dir: directory receiving the NIfTI segmentations
+        :param output_rt: path of the study's rtss file
+        :return: True on a cache hit
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+
+        entry_dir = self._entry_dir(key)
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            for name in entry.segmentations:
+                _link_or_copy(str(entry_dir.joinpath(_SEGMENTATIONS, name)), os.path.join(output_dir, name))
+
+            if entry.has_rtstruct and output_rt is not None and not os.path.exists(output_rt):
+                _link_or_copy(str(entry_dir.joinpath(_RTSTRUCT)), output_rt, link=False)
+                _link_or_copy(str(entry_dir.joinpath(_RTSTRUCT_MANIFEST)), manifest_path_for(output_rt), link=False)
+
+            entry.last_used = time.time()
+            self._write_info(entry_dir, entry)
+        except OSError as e:
+            logger.warning(f"Could not restore cached segmentation {key}: {e}")
+            return False
+
+        logger.info(f"Restored {len(entry.segmentations)} cached segmentations of {entry.task} into {output_dir}")
+        return True
+
+    def store(self, key: str, series_uid: str, task: str, fast: bool, output_dir: str,
+              segmentation_files: list[str], source: str = "", roi_subset=None) -> CacheEntry | None:
+        """
+        Store read-only copies of the segmentation files of a run, then
+        evict old entries beyond the size limit. An existing entry is kept.
+
+        :param key: from key_for
+        :param series_uid:
+        :param task:
+        :param fast:
+        :param output_dir: directory holding the segmentation files
+        :param segmentation_files: names of the files the run produced
+        :param source: study directory, for information only
+        :param roi_subset: structures segmented, None for the whole task
+        :return: the stored entry, None if storing failed
+        """
+        existing = self.lookup(key)
+        if existing is not None:
+            return existing
+
+        entry_dir = self._entry_dir(key)
+        entry_dir.parent.mkdir(parents=True, exist_ok=True)
+        staging_dir = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=entry_dir.parent))
+        try:
+            segmentation_dir = staging_dir.joinpath(_SEGMENTATIONS)
+            segmentation_dir.mkdir()
+            for name in segmentation_files:
+                destination = segmentation_dir.joinpath(name)
+                shutil.copy2(os.path.join(output_dir, name), destination)
+                os.chmod(destination, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+            now = time.time()
+            entry = CacheEntry(key, series_uid, task, bool(fast), model_version(), source,
+                               sorted(segmentation_files), sorted(roi_subset) if roi_subset is not None else None,
+                               size=_directory_size(str(staging_dir)),
+                               created=now, last_used=now)
+            self._write_info(staging_dir, entry)
+            os.rename(staging_dir, entry_dir)
+        except OSError as e:
+            # Another process may have stored the same result meanwhile
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if self.lookup(key) is None:
+                logger.warning(f"Could not cache segmentation {key}: {e}")
+            return self.lookup(key)
+
+        logger.info(f"Cached {len(segmentation_files)} segmentations of {task} for series {series_uid}")
+        self.prune(self.max_bytes)
+        return entry
+
+    def store_rtstruct(self, key: str, output_rt: str) -> None:
+        """
+        Add the RTSTRUCT converted from a cached result, with its manifest, to
+        the entry. Skipped when the RTSTRUCT also holds structures of other
+        runs, restoring it would bring back structures the entry lacks.
+
+        :param key:
+        :param output_rt: path of the study's rtss file
+        :rtype: None
+        """
+        entry = self.lookup(key)
+        if entry is None or entry.has_rtstruct:
+            return
+
+        manifest_path = manifest_path_for(output_rt)
+        structures = load_manifest(manifest_path)
+        entry_structures = {name[:-len(".nii.gz")] for name in entry.segmentations}
+        if structures is None or set(structures) != entry_structures:
+            return
+
+        entry_dir = self._entry_dir(key)
+        try:
+            for source, name in ((output_rt, _RTSTRUCT), (manifest_path, _RTSTRUCT_MANIFEST)):
+                destination = entry_dir.joinpath(name)
+                shutil.copy2(source, destination)
+                os.chmod(destination, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        except OSError as e:
+            logger.warning(f"Could not cache RTSTRUCT {output_rt}: {e}")
+            return
+
+        entry.has_rtstruct = True
+        entry.size = _directory_size(str(entry_dir))
+        self._write_info(entry_dir, entry)
+
+    def entries(self) -> list[CacheEntry]:
+        """
+        :return: every entry, least recently used first
+        """
+        entries = []
+        if self.root.is_dir():
+            for info_path in self.root.glob(f"*/*/{_ENTRY_INFO}"):
+                entry = self.lookup(info_path.parent.name)
+                if entry is not None:
+                    entries.append(entry)
+        return sorted(entries, key=lambda entry: entry.last_used)
+
+    def total_size(self) -> int:
+        return sum(entry.size for entry in self.entries())
+
+    def remove(self, key: str) -> None:
+        entry_dir = self._entry_dir(key)
+        # Entries are read-only, allow removing their files
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(entry_dir, onexc=_retry_writable)
+        else:
+            shutil.rmtree(entry_dir, onerror=_retry_writable)
+
+    def prune(self, max_bytes: int | None = None, older_than: float | None = None) -> list[CacheEntry]:
+        """
+        Evict entries, least recently used first, until the cache fits in
+        max_bytes, and every entry unused for older_than seconds.
+
+        :param max_bytes: size limit, None for no limit
+        :param older_than: age limit in seconds, None for no limit
+        :return: the evicted entries
+        """
+        entries = self.entries()
+        total = sum(entry.size for entry in entries)
+        now = time.time()
+
+        evicted = []
+        for entry in entries:
+            too_big = max_bytes is not None and total > max_bytes
+            too_old = older_than is not None and now - entry.last_used > older_than
+            if not (too_big or too_old):
+                continue
+            self.remove(entry.key)
+            total -= entry.size
+            evicted.append(entry)
+            logger.info(f"Evicted cached segmentation {entry.key} ({entry.task}, {entry.source})")
+        return evicted
+
+
+def _format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Inspect and prune the segmentation result cache.")
+    parser.add_argument("--cache-dir", default=None,
+                        help=f"Cache directory (default: ${CACHE_DIR_ENV} or {DEFAULT_CACHE_DIR})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the cached results, least recently used first")
+    prune = commands.add_parser("prune", help="Evict cached results")
+    prune.add_argument("--max-size", type=float, default=None, help="Evict until the cache fits in this many GB")
+    prune.add_argument("--older-than", type=float, default=None, help="Evict results unused for this many days")
+    prune.add_argument("--all", action="store_true", help="Evict every cached result")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = _build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    cache = ResultCache(args.cache_dir)
+
+    if args.command == "list":
+        entries = cache.entries()
+        for entry in entries:
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used))
+            print(f"{entry.key[:12]}  {entry.task:<24} {'fast' if entry.fast else 'full':<4}  "
+                  f"{_format_size(entry.size):>9}  {last_used}  {len(entry.segmentations)} structures"
+                  f"{' + rtss' if entry.has_rtstruct else ''}  {entry.source}")
+        print(f"{len(entries)} entries, {_format_size(sum(entry.size for entry in entries))} in {cache.root}")
+        return 0
+
+    if args.all:
+        evicted = cache.prune(max_bytes=0)
+    elif args.max_size is None and args.older_than is None:
+        logger.error("prune needs --max-size, --older-than or --all")
+        return 2
+    else:
+        max_bytes = int(args.max_size * 1024 ** 3) if args.max_size is not None else None
+        older_than = args.older_than * 24 * 3600 if args.older_than is not None else None
+        evicted = cache.prune(max_bytes, older_than)
+
+    print(f"Evicted {len(evicted)} entries, {_format_size(sum(entry.size for entry in evicted))} freed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,26 +1,240 @@
+import bisect
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
 import numpy as np
-from rt_utils import RTStructBuilder
+from pydicom import dcmread
+from rt_utils.image_helper import (
+    apply_transformation_to_3d_points, get_patient_to_pixel_transformation_matrix, get_slice_directions,
+    get_slice_position
+)
+
+logger = logging.getLogger(__name__)
+
+# Memory the rasterised masks of an RTStructMaskProvider may take up
+DEFAULT_MASK_CACHE_BYTES = 2 * 1024 ** 3
+
+
+def _read_series_headers(dicom_series_dir: str, series_uid: str | None = None) -> list:
+    """
+    Read the headers of the image slices in a directory, without their pixel
+    data, sorted along the slice direction as rt_utils orders them.
+
+    :param dicom_series_dir: directory of the image series
+    :param series_uid: only keep slices of this series, if given
+    :return: list of pydicom datasets
+    """
+    series_data = []
+    for entry in os.scandir(dicom_series_dir):
+        if not entry.is_file():
+            continue
+        try:
+            ds = dcmread(entry.path, stop_before_pixels=True)
+        except Exception:
+            # Not a valid DICOM file
+            continue
+        if "ImagePositionPatient" not in ds or "PixelSpacing" not in ds:
+            continue
+        if series_uid is not None and ds.get("SeriesInstanceUID") != series_uid:
+            continue
+        series_data.append(ds)
+
+    if not series_data:
+        raise FileNotFoundError(f"No DICOM images found in {dicom_series_dir}")
+    series_data.sort(key=get_slice_position)
+    return series_data
+
+
+def _referenced_series_uid(rtstruct) -> str | None:
+    try:
+        return (rtstruct.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0]
+                .RTReferencedSeriesSequence[0].SeriesInstanceUID)
+    except (AttributeError, IndexError):
+        return None
+
+
+class RTStructMaskProvider:
+    """Rasterises the structures of an RTSTRUCT into 3D masks on demand.
+
+    Opening the provider reads the structure names and indexes each
+    structure's contours by slice, looking up each contour's position along
+    the slice direction among the sorted slice positions. This is quick
+    however many structures there are. axial_contours() returns the contours
+    of a slice in pixel coordinates straight from the file, without a mask.
+    A structure's mask is only rasterised when mask() is first asked for it,
+    filling just the slices that have contours. Masks are kept in a least
+    recently used cache bounded by max_cache_bytes.
+
+    Masks are boolean arrays in (z, y, x) order, z ascending along the slice
+    direction as in the viewer's LPS orientated image set. Treat them as read
+    only, they are shared with the cache.
+
+    :param rtstruct_path: path to DICOM RTSTRUCT file
+    :param dicom_series_dir: path to folder containing the CT series
+    :param max_cache_bytes: memory the cached masks may take up
+    """
+
+    def __init__(self, rtstruct_path: str, dicom_series_dir: str,
+                 max_cache_bytes: int = DEFAULT_MASK_CACHE_BYTES) -> None:
+        self.max_cache_bytes = max_cache_bytes
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+        rtstruct = dcmread(rtstruct_path)
+        series_data = _read_series_headers(dicom_series_dir, _referenced_series_uid(rtstruct))
+        self.shape = (len(series_data), int(series_data[0].Rows), int(series_data[0].Columns))
+        self._transformation = get_patient_to_pixel_transformation_matrix(series_data)
+
+        # Sorted positions of the slices along the slice direction, a contour belongs
+        # to the nearest slice within half the slice spacing
+        _, _, self._slice_direction = get_slice_directions(series_data[0])
+        self._slice_positions = [float(get_slice_position(ds)) for ds in series_data]
+        if len(self._slice_positions) > 1:
+            self._slice_tolerance = float(np.min(np.diff(self._slice_positions))) / 2
+        else:
+            self._slice_tolerance = float(series_data[0].get("SliceThickness") or 1) / 2
+
+        names = {roi.ROINumber: roi.ROIName for roi in rtstruct.get("StructureSetROISequence", [])}
+        self._contours: dict[str, dict[int, list]] = {name: {} for name in names.values()}
+        for roi_contour in rtstruct.get("ROIContourSequence", []):
+            name = names.get(roi_contour.ReferencedROINumber)
+            if name is None:
+                continue
+            by_slice = self._contours[name]
+            for contour in roi_contour.get("ContourSequence", []):
+                index = self._slice_index(contour)
+                if index is not None:
+                    by_slice.setdefault(index, []).append(contour)
+
+    def _slice_index(self, contour) -> int | None:
+        """
+        Index of the slice a contour lies on, from the position of its first point.
+        """
+        if not contour.get("ContourData"):
+            return None
+        position = float(np.dot(self._slice_direction, [float(value) for value in contour.ContourData[:3]]))
+
+        index = bisect.bisect_left(self._slice_positions, position)
+        nearest = min((i for i in (index - 1, index) if 0 <= i < len(self._slice_positions)),
+                      key=lambda i: abs(self._slice_positions[i] - position))
+        if abs(self._slice_positions[nearest] - position) > self._slice_tolerance:
+            return None
+        return nearest
+
+    @property
+    def names(self) -> list[str]:
+        """
+        Structure names, in the order of the RTSTRUCT
+        """
+        return list(self._contours)
+
+    def slices(self, name: str) -> list[int]:
+        """
+        Indexes of the slices on which a structure has contours, ascending.
+
+        :param name:
+        :return: list of int
+        """
+        return sorted(self._contours[name])
+
+    def axial_contours(self, name: str, index: int) -> list[np.ndarray]:
+        """
+        The contours of a structure on an axial slice, as stored in the RTSTRUCT,
+        in pixel coordinates of the slice. The points of all the slice's
+        contours are transformed together.
+
+        :param name:
+        :param index: slice index
+        :return: list of np.ndarray of float, shape (points, 2), columns (x, y)
+        """
+        contours = self._contours[name].get(index)
+        if not contours:
+            return []
+        points = [np.asarray(contour.ContourData, dtype=float).reshape(-1, 3) for contour in contours]
+        pixels = apply_transformation_to_3d_points(np.concatenate(points), self._transformation)[:, :2]
+        return np.split(pixels, np.cumsum([len(contour_points) for contour_points in points])[:-1])
+
+    def mask(self, name: str) -> np.ndarray:
+        """
+        The 3D mask of a structure, rasterised on the first request.
+
+        :param name:
+        :return: np.ndarray of bool, shape (z, y, x)
+        """
+        with self._lock:
+            mask = self._cache.get(name)
+            if mask is not None:
+                self.hits += 1
+                self._cache.move_to_end(name)
+                return mask
+            self.misses += 1
+
+        mask = self._rasterise(name)
+
+        with self._lock:
+            if name not in self._cache:
+                self._cache[name] = mask
+                self._cached_bytes += mask.nbytes
+            # Always keep the newest mask, even if it alone exceeds the limit
+            while self._cached_bytes > self.max_cache_bytes and len(self._cache) > 1:
+                evicted_name, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted.nbytes
+                logger.debug(f"Evicted rasterised mask of {evicted_name}")
+        return mask
+
+    def is_rasterised(self, name: str) -> bool:
+        with self._lock:
+            return name in self._cache
+
+    def cache_stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "items": len(self._cache),
+                    "bytes": self._cached_bytes, "hit_rate": self.hits / lookups if lookups else None}
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
+
+    def _rasterise(self, name: str) -> np.ndarray:
+        """
+        Fill the contours of a structure slice by slice into a new mask.
+        """
+        if name not in self._contours:
+            raise KeyError(f"ROI of name `{name}` does not exist in RTStruct")
+
+        mask = np.zeros(self.shape, dtype=bool)
+        slice_mask = np.zeros(self.shape[1:], dtype=np.uint8)
+        for index in self._contours[name]:
+            polygons = [np.around(pixels).astype(np.int32) for pixels in self.axial_contours(name, index)]
+            slice_mask.fill(0)
+            cv2.fillPoly(slice_mask, polygons, 1)
+            mask[index] = slice_mask
+        return mask
+
 
 def load_rtstruct_masks(rtstruct_path: str, dicom_series_dir: str) -> dict:
     """
     Load binary masks from a DICOM RTSTRUCT and its corresponding CT series.
+    Rasterises every structure up front, see RTStructMaskProvider to load
+    them on demand instead.
 
     :param rtstruct_path: path to DICOM RTSTRUCT file
     :param dicom_series_dir: path to folder containing the CT series
-    :return: dict of {roi_name: np.ndarray (3D binary mask)}
+    :return: dict of {roi_name: np.ndarray (3D binary mask, (z, y, x))}
     """
-    # Load RTStruct object
-    rtstruct = RTStructBuilder.create_from(
-        dicom_series_path=dicom_series_dir,
-        rt_struct_path=rtstruct_path
-    )
-
-    roi_names = rtstruct.get_roi_names()
+    provider = RTStructMaskProvider(rtstruct_path, dicom_series_dir, max_cache_bytes=0)
+    roi_names = provider.names
     print("ROI names:", roi_names)
-    masks = {}
 
+    masks = {}
     for name in roi_names:
-        mask_3d = rtstruct.get_roi_mask_by_name(name)  # shape: (z, y, x)
-        masks[name] = mask_3d.astype(np.uint8)
-
+        masks[name] = provider.mask(name).view(np.uint8)
     return masks
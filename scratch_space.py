@@ -0,0 +1,374 @@
+"""Scratch space for the staged copies of the studies being segmented.
+
+A study is copied into a scratch directory before TotalSegmentator reads it.
+The directory is allocated on the first location with room for the study's
+estimated size: the RAM disk (/dev/shm, or $ONKODICOM_RAM_SCRATCH_DIR) for
+studies up to $ONKODICOM_RAM_SCRATCH_LIMIT GB (default 2), then the scratch
+disk ($ONKODICOM_SCRATCH_DIR, default the system temporary directory), whose
+studies may together reserve at most $ONKODICOM_SCRATCH_QUOTA GB. A location
+is only used while a fifth of it stays free.
+
+Every scratch directory has a record next to it naming the process which
+owns it and the size reserved, so concurrent processes share the quota.
+A directory is removed when it is released, when it is garbage collected and
+when its process exits; directories left behind by a process which was killed
+are removed by sweep(), which runs when a process first allocates scratch
+space and when the application starts.
+
+Example:
+    python scratch_space.py list
+    python scratch_space.py sweep
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, allocations are only serialised within the process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_DIR_ENV = "ONKODICOM_SCRATCH_DIR"
+RAM_SCRATCH_DIR_ENV = "ONKODICOM_RAM_SCRATCH_DIR"
+RAM_SCRATCH_LIMIT_ENV = "ONKODICOM_RAM_SCRATCH_LIMIT"
+SCRATCH_QUOTA_ENV = "ONKODICOM_SCRATCH_QUOTA"
+
+DEFAULT_RAM_SCRATCH_DIR = "/dev/shm"
+DEFAULT_RAM_SCRATCH_LIMIT = 2 * 1024 ** 3
+# Share of a location kept free for the rest of the system
+MIN_FREE_FRACTION = 0.2
+# Age after which a directory whose owner cannot be checked, e.g. on another host, is an orphan
+ORPHAN_AGE = 7 * 24 * 3600
+
+_SCRATCH_SUBDIR = "onkodicom-scratch"
+_RECORD_SUFFIX = ".json"
+_LOCK_FILE = ".lock"
+
+
+class ScratchSpaceError(OSError):
+    """Raised when no scratch location has room for a study."""
+
+
+@dataclass
+class ScratchLocation:
+    """A directory scratch directories are created in.
+
+    :param name: short name used in the logs, e.g. "ram" or "disk"
+    :param root: directory holding the scratch directories
+    :param max_study_bytes: largest study placed here, None for any size
+    :param quota_bytes: total size the studies placed here may reserve, None for no limit
+    """
+    name: str
+    root: str
+    max_study_bytes: int | None = None
+    quota_bytes: int | None = None
+
+    @property
+    def directory(self) -> str:
+        return os.path.join(self.root, _SCRATCH_SUBDIR)
+
+
+@dataclass
+class ScratchRecord:
+    """Owner of a scratch directory, stored next to it."""
+    path: str
+    location: str
+    reserved: int
+    pid: int
+    host: str
+    created: float
+    label: str = ""
+
+
+def _remove(path: str, record_path: str) -> None:
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.remove(record_path)
+    except FileNotFoundError:
+        pass
+
+
+class ScratchDirectory:
+    """A scratch directory allocated by ScratchManager.allocate.
+
+    The directory is removed by release(), when the object is garbage
+    collected, or when the process exits, whichever comes first.
+    """
+
+    def __init__(self, record: ScratchRecord) -> None:
+        self.record = record
+        self.path = record.path
+        self._finalizer = weakref.finalize(self, _remove, record.path, record.path + _RECORD_SUFFIX)
+
+    @property
+    def released(self) -> bool:
+        return not self._finalizer.alive
+
+    def release(self) -> None:
+        """
+        Remove the directory and its contents. Safe to call more than once.
+
+        :rtype: None
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _process_exists(pid: int) -> bool | None:
+    """
+    Whether a process of this host is running, None if it cannot be told.
+    """
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _directory_size(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(directory) for name in files
+    )
+
+
+def _gigabytes_from_env(name: str, default: int | None) -> int | None:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(float(value) * 1024 ** 3)
+    except ValueError:
+        logger.warning(f"Ignoring {name}={value!r}, expected a number of GB")
+        return default
+
+
+class ScratchManager:
+    """Allocates scratch directories on the configured locations, see the module docstring.
+
+    :param locations: ScratchLocations tried in order, defaults to the RAM disk and the scratch disk
+                      configured by the environment
+    """
+
+    def __init__(self, locations: list[ScratchLocation] | None = None) -> None:
+        self.locations = locations if locations is not None else self.locations_from_environment()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def locations_from_environment() -> list[ScratchLocation]:
+        """
+        Get the scratch locations configured by the environment, see the module docstring.
+
+        :return: list of ScratchLocation
+        """
+        locations = []
+        ram_dir = os.environ.get(RAM_SCRATCH_DIR_ENV, DEFAULT_RAM_SCRATCH_DIR)
+        ram_limit = _gigabytes_from_env(RAM_SCRATCH_LIMIT_ENV, DEFAULT_RAM_SCRATCH_LIMIT)
+        if ram_dir and ram_limit and os.path.isdir(ram_dir) and os.access(ram_dir, os.W_OK):
+            locations.append(ScratchLocation("ram", ram_dir, max_study_bytes=ram_limit))
+
+        disk_dir = os.environ.get(SCRATCH_DIR_ENV) or tempfile.gettempdir()
+        locations.append(ScratchLocation("disk", disk_dir, quota_bytes=_gigabytes_from_env(SCRATCH_QUOTA_ENV, None)))
+        return locations
+
+    @contextmanager
+    def _locked(self, location: ScratchLocation):
+        """
+        Serialises the allocations of a location across threads and processes.
+        """
+        os.makedirs(location.directory, exist_ok=True)
+        with self._lock, open(os.path.join(location.directory, _LOCK_FILE), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def records(self, location: ScratchLocation) -> list[ScratchRecord]:
+        """
+        Get the records of the scratch directories of a location.
+
+        :param location:
+        :return: list of ScratchRecord
+        """
+        records = []
+        if not os.path.isdir(location.directory):
+            return records
+        for name in os.listdir(location.directory):
+            if not name.endswith(_RECORD_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(location.directory, name)) as record_file:
+                    records.append(ScratchRecord(**json.load(record_file)))
+            except (OSError, ValueError, TypeError):
+                # Being written or removed by another process
+                continue
+        return records
+
+    def _has_room(self, location: ScratchLocation, size: int) -> bool:
+        if location.max_study_bytes is not None and size > location.max_study_bytes:
+            return False
+        if location.quota_bytes is not None:
+            reserved = sum(record.reserved for record in self.records(location))
+            if reserved + size > location.quota_bytes:
+                logger.info(f"Scratch quota of {location.name} reached: {reserved / 1024 ** 3:.1f} GB reserved")
+                return False
+        usage = shutil.disk_usage(location.root)
+        return usage.free - size >= usage.total * MIN_FREE_FRACTION
+
+    def allocate(self, estimated_bytes: int, label: str = "") -> ScratchDirectory:
+        """
+        Create a scratch directory on the first location with room for estimated_bytes.
+
+        :param estimated_bytes: size the directory is expected to grow to
+        :param label: name of what is stored, e.g. the study, shown by list
+        :return: ScratchDirectory
+        :raises ScratchSpaceError: if no location has room
+        """
+        for location in self.locations:
+            try:
+                with self._locked(location):
+                    if not self._has_room(location, estimated_bytes):
+                        continue
+                    path = os.path.join(location.directory, f"{os.getpid()}-{uuid.uuid4().hex[:12]}")
+                    record = ScratchRecord(path, location.name, estimated_bytes, os.getpid(), socket.gethostname(),
+                                           time.time(), label)
+                    # The record is written first, so the directory is never left without one
+                    with open(path + _RECORD_SUFFIX, "w") as record_file:
+                        json.dump(asdict(record), record_file)
+                    os.mkdir(path)
+            except OSError as e:
+                logger.warning(f"Scratch location {location.root} is not usable: {e}")
+                continue
+
+            logger.info(f"Allocated {estimated_bytes / 1024 ** 2:.0f} MB of scratch space on {location.name}: {path}")
+            return ScratchDirectory(record)
+
+        raise ScratchSpaceError(f"No scratch location has room for {estimated_bytes / 1024 ** 3:.1f} GB, "
+                                f"tried {', '.join(location.root for location in self.locations)}")
+
+    def _is_orphan(self, record: ScratchRecord, now: float) -> bool:
+        if record.host == socket.gethostname():
+            exists = _process_exists(record.pid)
+            if exists is not None:
+                return not exists
+        return now - record.created > ORPHAN_AGE
+
+    def sweep(self) -> list[ScratchRecord]:
+        """
+        Remove the scratch directories of processes which are no longer running.
+
+        :return: list of ScratchRecord removed
+        """
+        removed = []
+        now = time.time()
+        for location in self.locations:
+            if not os.path.isdir(location.directory):
+                continue
+            with self._locked(location):
+                records = self.records(location)
+                for record in records:
+                    if self._is_orphan(record, now):
+                        _remove(record.path, record.path + _RECORD_SUFFIX)
+                        removed.append(record)
+
+                # Directories whose record could not be read, left for an hour in case one is being written
+                recorded = {os.path.basename(record.path) for record in records}
+                for name in os.listdir(location.directory):
+                    path = os.path.join(location.directory, name)
+                    if (name not in recorded and os.path.isdir(path)
+                            and now - os.path.getmtime(path) > 3600):
+                        shutil.rmtree(path, ignore_errors=True)
+                        removed.append(ScratchRecord(path, location.name, 0, 0, "", 0.0))
+
+        for record in removed:
+            logger.info(f"Removed orphaned scratch directory {record.path}")
+        return removed
+
+
+_default_manager: ScratchManager | None = None
+_default_manager_lock = threading.Lock()
+
+
+def default_scratch_manager() -> ScratchManager:
+    """
+    Get the ScratchManager configured by the environment, shared by the process.
+    Orphaned scratch directories are swept when it is first requested.
+
+    :return: ScratchManager
+    """
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            manager = ScratchManager()
+            try:
+                manager.sweep()
+            except OSError as e:
+                logger.warning(f"Failed to sweep scratch directories: {e}")
+            _default_manager = manager
+        return _default_manager
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Inspect and clean up the scratch directories of segmentation runs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the scratch locations and the directories allocated on them")
+    commands.add_parser("sweep", help="Remove the directories of processes which are no longer running")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = _build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    manager = ScratchManager()
+
+    if args.command == "sweep":
+        removed = manager.sweep()
+        print(f"Removed {len(removed)} orphaned scratch directories")
+        return 0
+
+    for location in manager.locations:
+        limits = []
+        if location.max_study_bytes is not None:
+            limits.append(f"studies up to {location.max_study_bytes / 1024 ** 3:.1f} GB")
+        if location.quota_bytes is not None:
+            limits.append(f"quota {location.quota_bytes / 1024 ** 3:.1f} GB")
+        usage = shutil.disk_usage(location.root)
+        print(f"{location.name}: {location.directory} ({', '.join(limits) or 'no limit'}, "
+              f"{usage.free / 1024 ** 3:.1f} GB free)")
+        for record in manager.records(location):
+            size = _directory_size(record.path) if os.path.isdir(record.path) else 0
+            created = time.strftime("%Y-%m-%d %H:%M", time.localtime(record.created))
+            print(f"  {os.path.basename(record.path)}  {size / 1024 ** 2:>8.0f} MB of "
+                  f"{record.reserved / 1024 ** 2:.0f} MB  pid {record.pid} on {record.host}  {created}  {record.label}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
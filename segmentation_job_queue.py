@@ -0,0 +1,199 @@
+import heapq
+import itertools
+import os
+import threading
+from dataclasses import dataclass
+
+
+class JobStatus:
+    """Status values of a SegmentationJob."""
+    QUEUED = "Queued"
+    RUNNING = "Running"
+    FINISHED = "Finished"
+    FAILED = "Failed"
+    CANCELLED = "Cancelled"
+
+    ACTIVE = (QUEUED, RUNNING)
+
+
+def study_key(dicom_dir: str) -> str:
+    """Normalised study path, equal for every spelling of the same directory."""
+    return os.path.normcase(os.path.abspath(dicom_dir))
+
+
+@dataclass
+class SegmentationJob:
+    """A segmentation task requested for a study, optionally restricted to some of its structures."""
+    job_id: int
+    dicom_dir: str
+    task: str
+    fast: bool
+    priority: int = 0
+    roi_subset: tuple[str, ...] | None = None
+    # Show a fastest mode preview first, does not change the result
+    preview: bool = False
+    status: str = JobStatus.QUEUED
+    progress: int = 0
+    message: str = ""
+
+    @property
+    def key(self) -> tuple[str, str, bool, tuple[str, ...] | None]:
+        """Identifies identical requests, which are only run once."""
+        return study_key(self.dicom_dir), self.task, self.fast, self.roi_subset
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in JobStatus.ACTIVE
+
+
+class SegmentationJobQueue:
+    """Priority queue of segmentation jobs with a concurrency limit.
+
+    Jobs with a higher priority start first, jobs of equal priority start in
+    the order they were submitted. Submitting a (study, task, fast, structures) request
+    that is already queued or running returns the existing job instead of
+    adding a duplicate; a higher priority is applied to the queued job.
+    Jobs of the same study never run at the same time. The queue only
+    tracks state, starting the jobs is left to the caller.
+
+    :param max_concurrent: number of jobs allowed to run at the same time
+    """
+
+    def __init__(self, max_concurrent: int = 1) -> None:
+        self.max_concurrent = max(1, max_concurrent)
+        self._jobs: dict[int, SegmentationJob] = {}
+        self._heap: list[tuple[int, int, int]] = []
+        self._ids = itertools.count(1)
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit(self, dicom_dir: str, task: str, fast: bool, priority: int = 0,
+               roi_subset=None, preview: bool = False) -> tuple[SegmentationJob, bool]:
+        """
+        Queue a job unless an identical one is already queued or running.
+
+        :param dicom_dir:
+        :param task:
+        :param fast:
+        :param priority: higher values start first
+        :param roi_subset: structures of the task to segment, None for all of them
+        :param preview: show a fastest mode preview before the full resolution run
+        :return: (job, whether it was newly queued)
+        """
+        roi_subset = tuple(sorted(roi_subset)) if roi_subset else None
+        with self._lock:
+            job = SegmentationJob(next(self._ids), dicom_dir, task, fast, priority, roi_subset=roi_subset,
+                                  preview=preview)
+            for existing in self._jobs.values():
+                if existing.is_active and existing.key == job.key:
+                    if existing.status == JobStatus.QUEUED and priority > existing.priority:
+                        existing.priority = priority
+                        self._push(existing)
+                    return existing, False
+
+            self._jobs[job.job_id] = job
+            self._push(job)
+            return job, True
+
+    def _push(self, job: SegmentationJob) -> None:
+        # Entries left behind by a priority change are skipped when popped
+        heapq.heappush(self._heap, (-job.priority, next(self._order), job.job_id))
+
+    def next_runnable(self) -> SegmentationJob | None:
+        """
+        Mark the next job as running if the concurrency limit allows it.
+        Jobs of a study which already has a running job wait, as jobs of the
+        same study write to the same segmentation directory and RTSTRUCT.
+
+        :return: the job to start, or None
+        """
+        with self._lock:
+            if self.running_count >= self.max_concurrent:
+                return None
+
+            busy_studies = {job.key[0] for job in self._jobs.values() if job.status == JobStatus.RUNNING}
+            waiting = []
+            runnable = None
+            while self._heap:
+                entry = heapq.heappop(self._heap)
+                job = self._jobs[entry[2]]
+                if job.status != JobStatus.QUEUED or -entry[0] != job.priority:
+                    continue
+                if job.key[0] in busy_studies:
+                    waiting.append(entry)
+                    continue
+                job.status = JobStatus.RUNNING
+                runnable = job
+                break
+
+            for entry in waiting:
+                heapq.heappush(self._heap, entry)
+            return runnable
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Cancel a queued job straight away. A running job is left running,
+        the caller must interrupt it and then call finish(cancelled=True).
+
+        :param job_id:
+        :return: True if the job was queued and is now cancelled
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            if job.status != JobStatus.QUEUED:
+                return False
+            job.status = JobStatus.CANCELLED
+            job.message = "Cancelled before it started"
+            return True
+
+    def finish(self, job_id: int, success: bool, message: str = "",
+               cancelled: bool = False) -> SegmentationJob | None:
+        """
+        Record the outcome of a running job. A job is only finished once,
+        a later outcome (e.g. an error after it finished) is ignored.
+
+        :param job_id:
+        :param success:
+        :param message:
+        :param cancelled: the job stopped because it was cancelled
+        :return: the finished job, or None if it was not running
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            if job.status != JobStatus.RUNNING:
+                return None
+            if cancelled:
+                job.status = JobStatus.CANCELLED
+            else:
+                job.status = JobStatus.FINISHED if success else JobStatus.FAILED
+            job.message = message
+            if success:
+                job.progress = 100
+            return job
+
+    def set_max_concurrent(self, max_concurrent: int) -> None:
+        with self._lock:
+            self.max_concurrent = max(1, max_concurrent)
+
+    def get(self, job_id: int) -> SegmentationJob:
+        return self._jobs[job_id]
+
+    def jobs(self) -> list[SegmentationJob]:
+        """
+        :return: every job in submission order
+        """
+        with self._lock:
+            return list(self._jobs.values())
+
+    def active_jobs(self, dicom_dir: str) -> list[SegmentationJob]:
+        """
+        :param dicom_dir:
+        :return: the queued and running jobs of the study
+        """
+        study = study_key(dicom_dir)
+        with self._lock:
+            return [job for job in self._jobs.values() if job.is_active and job.key[0] == study]
+
+    @property
+    def running_count(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.status == JobStatus.RUNNING)
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def manifest_path_for(rtstruct_path: str) -> str:
+    """
+    Get the path of the sidecar manifest stored next to an RTSTRUCT file.
+
+    :param rtstruct_path: path to the RTSTRUCT file
+    :return: str
+    """
+    return rtstruct_path + MANIFEST_SUFFIX
+
+
+def _sha256_of_file(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Hash a file's contents in chunks so large NIfTI files are never
+    held in memory.
+
+    :param file_path:
+    :param chunk_size:
+    :return: str
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path: str, previous: dict | None = None) -> dict:
+    """
+    Fingerprint a segmentation file by size, mtime and content hash.
+    The hash of the previous fingerprint is reused when the size and
+    mtime have not changed, so unchanged files are not re-read.
+
+    :param file_path: path to the file to fingerprint
+    :param previous: fingerprint recorded for this file on the last run
+    :return: dict
+    """
+    stat = os.stat(file_path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        fingerprint["sha256"] = previous.get("sha256")
+    else:
+        fingerprint["sha256"] = _sha256_of_file(file_path)
+    return fingerprint
+
+
+def _read_manifest(manifest_path: str) -> dict | None:
+    """
+    Read a manifest file of the supported version.
+
+    :param manifest_path:
+    :return: dict or None if there is no usable manifest
+    """
+    if not os.path.isfile(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable manifest {manifest_path}: {e}")
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Ignoring manifest {manifest_path} with unsupported version {manifest.get('version')}")
+        return None
+    return manifest
+
+
+def load_manifest(manifest_path: str) -> dict | None:
+    """
+    Load the structures recorded in a manifest.
+
+    :param manifest_path:
+    :return: dict of {structure_name: fingerprint} or None if there is no usable manifest
+    """
+    manifest = _read_manifest(manifest_path)
+    return manifest.get("structures", {}) if manifest is not None else None
+
+
+def run_settings(task: str, fast: bool, roi_subset: list[str] | None = None) -> dict:
+    """
+    The TotalSegmentator settings a set of segmentations was produced with,
+    as recorded in the manifest.
+
+    :param task: TotalSegmentator task
+    :param fast: TotalSegmentator's fastest mode
+    :param roi_subset: structures the run was restricted to, None for all of them
+    :return: dict
+    """
+    return {"task": task, "fast": bool(fast), "roi_subset": sorted(roi_subset) if roi_subset else None}
+
+
+def load_settings(manifest_path: str) -> dict | None:
+    """
+    Load the segmentation settings recorded in a manifest, see run_settings.
+
+    :param manifest_path:
+    :return: dict or None if the manifest holds no settings
+    """
+    manifest = _read_manifest(manifest_path)
+    return manifest.get("settings") if manifest is not None else None
+
+
+def save_manifest(manifest_path: str, structures: dict, settings: dict | None = None) -> None:
+    """
+    Write the manifest atomically so an interrupted run never leaves
+    a half written file behind.
+
+    :param manifest_path:
+    :param structures: dict of {structure_name: fingerprint}
+    :param settings: segmentation settings of the structures, None to keep those already recorded
+    :return: None
+    """
+    if settings is None:
+        settings = load_settings(manifest_path)
+
+    manifest = {"version": MANIFEST_VERSION, "structures": structures}
+    if settings is not None:
+        manifest["settings"] = settings
+
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def record_settings(manifest_path: str, settings: dict) -> None:
+    """
+    Record the segmentation settings in an existing manifest.
+
+    :param manifest_path:
+    :param settings: see run_settings
+    :return: None
+    """
+    structures = load_manifest(manifest_path)
+    if structures is not None:
+        save_manifest(manifest_path, structures, settings)
+
+
+def same_content(previous: dict, current: dict) -> bool:
+    """
+    Compare two fingerprints of a structure by a hash both of them hold: the
+    voxel hash of a label map ("voxels") or the content hash of its NIfTI
+    file ("sha256"). Fingerprints without a common hash differ.
+
+    :param previous:
+    :param current:
+    :return: bool
+    """
+    for key in ("voxels", "sha256"):
+        if key in previous and key in current:
+            return previous[key] == current[key]
+    return False
+
+
+def diff_structures(previous: dict, current: dict) -> tuple[list[str], list[str], list[str]]:
+    """
+    Compare two sets of structure fingerprints by content hash, see same_content.
+
+    :param previous: fingerprints recorded on the last run
+    :param current: fingerprints of the segmentations now
+    :return: (added, changed, removed) structure names
+    """
+    added = sorted(name for name in current if name not in previous)
+    removed = sorted(name for name in previous if name not in current)
+    changed = sorted(
+        name for name in current
+        if name in previous and not same_content(previous[name], current[name])
+    )
+    return added, changed, removed
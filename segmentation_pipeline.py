@@ -0,0 +1,166 @@
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream of studies passed between the stages
+_END_OF_STUDIES = None
+
+
+@dataclass
+class PipelineStudy:
+    """A study travelling through the segmentation pipeline."""
+    dicom_dir: str
+    task: str
+    fast: bool
+    segmentation: object = None
+    failed_stage: str | None = None
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def success(self) -> bool:
+        return self.failed_stage is None
+
+
+class SegmentationPipeline:
+    """Runs the segmentation workflow of many studies as overlapping stages.
+
+    Each study goes through staging (copy to the temporary directory),
+    inference (TotalSegmentator), conversion (NIfTI to RTSTRUCT) and loading
+    (the on_converted callback, e.g. loading the results into a viewer).
+    Every stage runs on its own thread and hands studies to the next one
+    through a bounded queue, so while study N is in inference, study N+1 is
+    staged and study N-1 is converted. Only one study is in inference at a
+    time, as inference already uses every core it is given.
+
+    :param queue_size: number of studies that may wait between two stages
+    :param on_converted: called with the PipelineStudy of each study whose
+                         rtss file was written, on the loading thread
+    :param segmentation_factory: creates the headless AutoSegmentation for a study
+    """
+
+    STAGES = ("staging", "inference", "conversion", "loading")
+
+    def __init__(self, queue_size: int = 1, on_converted: Callable[[PipelineStudy], None] | None = None,
+                 segmentation_factory: Callable[[], object] | None = None) -> None:
+        if segmentation_factory is None:
+            # Imported here so constructing a pipeline does not pull in torch until needed
+            from auto_segmentation import AutoSegmentation
+            segmentation_factory = AutoSegmentation
+
+        self._segmentation_factory = segmentation_factory
+        self._on_converted = on_converted
+        self._queues = {stage: queue.Queue(maxsize=max(1, queue_size)) for stage in self.STAGES}
+        self._results: list[PipelineStudy] = []
+        self._results_lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run_stage, args=(stage,), name=f"pipeline-{stage}", daemon=True)
+            for stage in self.STAGES
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, dicom_dir: str, task: str, fast: bool) -> None:
+        """
+        Queue a study for segmentation. Blocks while the staging queue is full.
+
+        :param dicom_dir:
+        :param task:
+        :param fast:
+        :rtype: None
+        """
+        self._queues["staging"].put(PipelineStudy(dicom_dir, task, fast))
+
+    def close(self) -> list[PipelineStudy]:
+        """
+        Signal that no more studies will be submitted and wait for the queued
+        studies to pass through every stage.
+
+        :return: the studies in the order they completed
+        """
+        self._queues["staging"].put(_END_OF_STUDIES)
+        for thread in self._threads:
+            thread.join()
+        return list(self._results)
+
+    def run(self, studies: list[tuple[str, str, bool]]) -> list[PipelineStudy]:
+        """
+        Push (dicom_dir, task, fast) studies through the pipeline and wait for them.
+
+        :param studies:
+        :return: the studies in the order they completed
+        """
+        for dicom_dir, task, fast in studies:
+            self.submit(dicom_dir, task, fast)
+        return self.close()
+
+    def _run_stage(self, stage: str) -> None:
+        """
+        Thread body of a stage, processes studies until the end marker arrives
+        and then forwards the marker to the next stage.
+
+        :param stage:
+        :rtype: None
+        """
+        next_stage = self._next_stage(stage)
+        while True:
+            study = self._queues[stage].get()
+            if study is _END_OF_STUDIES:
+                if next_stage is not None:
+                    self._queues[next_stage].put(_END_OF_STUDIES)
+                return
+
+            if study.success:
+                try:
+                    if not self._process(stage, study):
+                        study.failed_stage = stage
+                except Exception as e:
+                    logger.exception(f"Pipeline {stage} failed for {study.dicom_dir}")
+                    study.errors.append(str(e))
+                    study.failed_stage = stage
+
+            # A failed study's temporary copy is not needed by the later stages
+            if not study.success and study.segmentation is not None:
+                study.segmentation.cleanup()
+                study.segmentation.report_timing(study.dicom_dir)
+                study.segmentation = None
+
+            # Failed studies are passed along without work so results stay in order
+            if next_stage is not None:
+                self._queues[next_stage].put(study)
+            else:
+                with self._results_lock:
+                    self._results.append(study)
+
+    def _process(self, stage: str, study: PipelineStudy) -> bool:
+        """
+        Perform a single stage of the workflow for a study.
+
+        :param stage:
+        :param study:
+        :return: bool, whether the stage succeeded
+        """
+        logger.info(f"Pipeline {stage}: {study.dicom_dir}")
+
+        if stage == "staging":
+            study.segmentation = self._segmentation_factory()
+            study.segmentation.signals.error.connect(study.errors.append)
+            return study.segmentation.stage(study.dicom_dir)
+        if stage == "inference":
+            return study.segmentation.infer(study.dicom_dir, study.task, study.fast)
+        if stage == "conversion":
+            return study.segmentation.convert(study.dicom_dir)
+
+        # Loading stage
+        study.segmentation.report_timing(study.dicom_dir)
+        study.segmentation = None
+        if self._on_converted is not None:
+            self._on_converted(study)
+        return True
+
+    def _next_stage(self, stage: str) -> str | None:
+        index = self.STAGES.index(stage) + 1
+        return self.STAGES[index] if index < len(self.STAGES) else None
@@ -0,0 +1,227 @@
+"""Parallel decoding of compressed DICOM series.
+
+SimpleITK's ImageSeriesReader decodes the slices of a series one after the
+other on a single core, which dominates loading JPEG 2000 or JPEG-LS
+compressed series. read_series() splits the slices of such a series across
+a pool of processes. Each decodes its slices with SimpleITK and writes them
+into one volume in shared memory. The volume is assembled into an image
+with the geometry ImageSeriesReader would give it, read from the headers.
+Uncompressed and short series are still read by ImageSeriesReader.
+
+series_geometry() and orient_lps() give the geometry of a series, as read
+and LPS orientated, from its headers alone, for callers which need the grid
+but not the pixels.
+
+The number of worker processes defaults to the number of CPUs and can be
+set with $ONKODICOM_DECODE_WORKERS, 1 disabling the parallel decoding.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import SimpleITK as sitk
+
+logger = logging.getLogger(__name__)
+
+DECODE_WORKERS_ENV = "ONKODICOM_DECODE_WORKERS"
+
+# Series with fewer slices are not worth handing to the worker processes
+MIN_PARALLEL_SLICES = 16
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def decode_workers() -> int:
+    """
+    Number of processes decoding a compressed series.
+
+    :rtype: int
+    """
+    configured = os.environ.get(DECODE_WORKERS_ENV)
+    if configured:
+        return max(1, int(configured))
+    return os.cpu_count() or 1
+
+
+def _get_executor(workers: int) -> ProcessPoolExecutor:
+    """
+    The decoding process pool, kept between series so the workers only start once.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # spawn keeps the workers free of the GUI's threads and Qt state
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _executor_workers = workers
+        return _executor
+
+
+def _reset_executor() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def _read_headers(files: list[str]) -> tuple:
+    """
+    Headers of the first and last slices of a sorted series, without pixel data.
+    """
+    from pydicom import dcmread
+
+    return dcmread(files[0], stop_before_pixels=True), dcmread(files[-1], stop_before_pixels=True)
+
+
+def _is_compressed(header) -> bool:
+    file_meta = getattr(header, "file_meta", None)
+    transfer_syntax = file_meta.get("TransferSyntaxUID") if file_meta is not None else None
+    return transfer_syntax is not None and transfer_syntax.is_compressed
+
+
+def series_geometry(files: list[str]) -> tuple:
+    """
+    Size, origin, spacing and direction of a series as ImageSeriesReader reads it,
+    from the headers of its first and last slices.
+
+    :param files: slices sorted along the slice direction, see series_index.series_files
+    :return: (size, origin, spacing, direction) in SimpleITK's conventions
+    """
+    first, last = _read_headers(files)
+    orientation = np.asarray(first.ImageOrientationPatient, dtype=float)
+    row_direction, column_direction = orientation[:3], orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+
+    origin = np.asarray(first.ImagePositionPatient, dtype=float)
+    row_spacing, column_spacing = (float(value) for value in first.PixelSpacing)
+    if len(files) > 1:
+        distance = np.dot(normal, np.asarray(last.ImagePositionPatient, dtype=float) - origin)
+        slice_spacing = abs(float(distance)) / (len(files) - 1)
+    else:
+        slice_spacing = float(first.get("SliceThickness") or 1)
+
+    size = (int(first.Columns), int(first.Rows), len(files))
+    direction = np.column_stack((row_direction, column_direction, normal))
+    return size, tuple(origin.tolist()), (column_spacing, row_spacing, slice_spacing), tuple(direction.ravel().tolist())
+
+
+def orient_lps(size: tuple, origin: tuple, spacing: tuple, direction: tuple) -> tuple:
+    """
+    The geometry sitk.DICOMOrient(image, 'LPS') gives an image of this geometry,
+    computed without an image.
+
+    :return: (size, origin, spacing, direction)
+    """
+    direction = np.asarray(direction, dtype=float).reshape(3, 3)
+    axes = [int(np.argmax(np.abs(direction[:, axis]))) for axis in range(3)]
+    if sorted(axes) != [0, 1, 2]:
+        # Oblique enough for two axes to share a closest patient axis, let SimpleITK decide
+        image = sitk.Image([int(value) for value in size], sitk.sitkUInt8)
+        image.SetOrigin(origin)
+        image.SetSpacing(spacing)
+        image.SetDirection(tuple(direction.ravel()))
+        image = sitk.DICOMOrient(image, "LPS")
+        return image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection()
+
+    oriented_size, oriented_spacing = [0] * 3, [0.0] * 3
+    oriented_direction = np.zeros((3, 3))
+    oriented_origin = np.asarray(origin, dtype=float)
+    for axis, patient_axis in enumerate(axes):
+        sign = np.sign(direction[patient_axis, axis])
+        oriented_size[patient_axis] = int(size[axis])
+        oriented_spacing[patient_axis] = float(spacing[axis])
+        oriented_direction[:, patient_axis] = direction[:, axis] * sign
+        if sign < 0:
+            # Flipped axes start at the far end
+            oriented_origin = oriented_origin + (size[axis] - 1) * spacing[axis] * direction[:, axis]
+    return (tuple(oriented_size), tuple(oriented_origin.tolist()), tuple(oriented_spacing),
+            tuple(oriented_direction.ravel().tolist()))
+
+
+def _decode_slices(shared_memory_name: str, shape: tuple, dtype: str, start: int, files: list[str]) -> int:
+    """
+    Decode slices into the shared volume, runs in a worker process.
+
+    :param shared_memory_name:
+    :param shape: (z, y, x) shape of the volume
+    :param dtype: numpy dtype of the volume
+    :param start: index of the first slice in the volume
+    :param files: slices to decode
+    :return: number of slices decoded
+    """
+    shared = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        volume = np.ndarray(shape, dtype=dtype, buffer=shared.buf)
+        for offset, path in enumerate(files):
+            volume[start + offset] = sitk.GetArrayViewFromImage(sitk.ReadImage(path)).reshape(shape[1:])
+        # Release the view before the buffer is closed
+        del volume
+    finally:
+        shared.close()
+    return len(files)
+
+
+def _read_with_series_reader(files: list[str]) -> sitk.Image:
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(files)
+    return reader.Execute()
+
+
+def read_series(files: list[str], workers: int | None = None) -> sitk.Image:
+    """
+    Read a series into one image, as ImageSeriesReader would, decoding compressed
+    slices on several processes.
+
+    :param files: slices sorted along the slice direction, see series_index.series_files
+    :param workers: decoding processes, defaults to decode_workers()
+    :return: SimpleITK.Image
+    """
+    workers = decode_workers() if workers is None else workers
+    if workers < 2 or len(files) < MIN_PARALLEL_SLICES or not _is_compressed(_read_headers(files)[0]):
+        return _read_with_series_reader(files)
+
+    # Pixel type of the decoded, rescaled slices, from the first slice's header
+    information = sitk.ImageFileReader()
+    information.SetFileName(files[0])
+    information.ReadImageInformation()
+    if information.GetNumberOfComponents() != 1:
+        return _read_with_series_reader(files)
+    dtype = sitk.GetArrayViewFromImage(sitk.Image([1, 1], information.GetPixelID())).dtype
+
+    size, origin, spacing, direction = series_geometry(files)
+    shape = (size[2], size[1], size[0])
+    shared = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * dtype.itemsize)
+    try:
+        executor = _get_executor(workers)
+        chunk = -(-len(files) // workers)
+        futures = [executor.submit(_decode_slices, shared.name, shape, dtype.str, start, files[start:start + chunk])
+                   for start in range(0, len(files), chunk)]
+        for future in futures:
+            future.result()
+    except BrokenProcessPool:
+        # A worker died, start a new pool for the next series and read this one in process
+        logger.warning("Decoding processes stopped unexpectedly, reading the series in process")
+        _reset_executor()
+        return _read_with_series_reader(files)
+    else:
+        volume = np.ndarray(shape, dtype=dtype, buffer=shared.buf)
+        image = sitk.GetImageFromArray(volume)
+        del volume
+    finally:
+        shared.close()
+        shared.unlink()
+
+    image.SetOrigin(origin)
+    image.SetSpacing(spacing)
+    image.SetDirection(direction)
+    logger.debug(f"Decoded {len(files)} compressed slices on {min(workers, len(futures))} processes")
+    return image
@@ -0,0 +1,282 @@
+"""Index of the DICOM series in a directory, kept across runs.
+
+Opening a folder with SimpleITK's GetGDCMSeriesFileNames parses the header
+of every file each time and only returns the first series found. The index
+reads the headers without pixel data on a thread pool, groups the image
+files by SeriesInstanceUID and sorts each series along its slice direction.
+What was read is stored in a SQLite database keyed by path, modification
+time and size, so re-opening a folder only reads the files that are new or
+have changed since.
+
+Series are sorted by the position of each slice along the normal of its
+image orientation, as GDCM does, falling back to InstanceNumber. When no
+series is asked for, the one with the most slices is used.
+
+Example:
+    python series_index.py list /path/to/dicom
+    python series_index.py clear
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the stored columns change, older databases are rebuilt
+INDEX_FORMAT_VERSION = 1
+INDEX_PATH_ENV = "ONKODICOM_SERIES_INDEX"
+DEFAULT_INDEX_PATH = Path.home().joinpath("OnkoDICOM", "cache", "series_index.sqlite")
+
+# Header elements stored for each file, pydicom stops parsing after the last one needed
+_HEADER_TAGS = ["Modality", "SOPInstanceUID", "SeriesInstanceUID", "SeriesDescription", "InstanceNumber",
+                "ImagePositionPatient", "ImageOrientationPatient", "Rows"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    series_uid TEXT,
+    sop_uid TEXT,
+    modality TEXT,
+    description TEXT,
+    instance_number INTEGER,
+    position REAL,
+    is_image INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+"""
+
+
+@dataclass
+class SeriesInfo:
+    """An image series of a directory, its files sorted along the slice direction."""
+    series_uid: str
+    modality: str
+    description: str
+    files: list[str] = field(default_factory=list)
+
+
+def _read_header(path: str) -> tuple:
+    """
+    Read the indexed elements of a file's header, without its pixel data.
+
+    :param path:
+    :return: (series_uid, sop_uid, modality, description, instance_number, position, is_image),
+        all None for files that are not DICOM
+    """
+    import pydicom
+
+    try:
+        dataset = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=_HEADER_TAGS)
+    except Exception:
+        # Not a valid DICOM file
+        return None, None, None, None, None, None, False
+
+    position = None
+    if "ImagePositionPatient" in dataset and "ImageOrientationPatient" in dataset:
+        orientation = np.asarray(dataset.ImageOrientationPatient, dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        position = float(np.dot(normal, np.asarray(dataset.ImagePositionPatient, dtype=float)))
+
+    instance_number = dataset.get("InstanceNumber")
+    series_uid = dataset.get("SeriesInstanceUID")
+    return (str(series_uid) if series_uid else None, str(dataset.get("SOPInstanceUID", "")) or None,
+            str(dataset.get("Modality", "")), str(dataset.get("SeriesDescription", "")),
+            int(instance_number) if instance_number not in (None, "") else None, position,
+            "Rows" in dataset and series_uid is not None)
+
+
+class SeriesIndex:
+    """Persistent index of the DICOM series in directories, see the module docstring.
+
+    :param path: SQLite database, defaults to $ONKODICOM_SERIES_INDEX or
+        ~/OnkoDICOM/cache/series_index.sqlite. Held in memory only if it cannot be opened.
+    :param max_workers: threads reading headers, defaults to the ThreadPoolExecutor default
+    """
+
+    def __init__(self, path: str | None = None, max_workers: int | None = None) -> None:
+        self.path = str(path or os.environ.get(INDEX_PATH_ENV) or DEFAULT_INDEX_PATH)
+        self.max_workers = max_workers
+        # Serialises scans, so a folder opened twice at once is only read once
+        self._lock = threading.Lock()
+        self._connection = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        try:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            if connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_FORMAT_VERSION:
+                connection.executescript("DROP TABLE IF EXISTS files;")
+                connection.execute(f"PRAGMA user_version = {INDEX_FORMAT_VERSION}")
+            connection.executescript(_SCHEMA)
+            return connection
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Series index {self.path} could not be opened, keeping it in memory: {e}")
+            self.path = ":memory:"
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.executescript(_SCHEMA)
+            return connection
+
+    def scan(self, directory: str) -> list[SeriesInfo]:
+        """
+        Index the files of a directory, reading the headers of files which are new
+        or changed since the last scan, and return its image series.
+
+        :param directory:
+        :return: list of SeriesInfo, most slices first
+        """
+        directory = os.path.realpath(directory)
+        with self._lock:
+            files = {}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+            known = {
+                row[0]: row for row in self._connection.execute(
+                    "SELECT path, mtime_ns, size, series_uid, sop_uid, modality, description, instance_number,"
+                    " position, is_image FROM files WHERE directory = ?", (directory,))
+            }
+            changed = [path for path, key in files.items() if known.get(path, (None,) * 3)[1:3] != key]
+            removed = [path for path in known if path not in files]
+
+            rows = [row for path, row in known.items() if path in files and path not in changed]
+            if changed:
+                with ThreadPoolExecutor(self.max_workers, thread_name_prefix="series-index") as executor:
+                    headers = list(executor.map(_read_header, changed))
+                new_rows = [(path, *files[path], *header) for path, header in zip(changed, headers)]
+                rows.extend(new_rows)
+
+            with self._connection:
+                self._connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+                if changed:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(row[0], directory, *row[1:]) for row in new_rows]
+                    )
+            logger.debug(f"Indexed {directory}: {len(changed)} files read, {len(files) - len(changed)} unchanged")
+
+        return self._group(rows)
+
+    @staticmethod
+    def _group(rows: list[tuple]) -> list[SeriesInfo]:
+        """
+        Group the image rows of a scan by series, sorting each along the slice direction.
+        """
+        grouped = {}
+        for path, _, _, series_uid, _, modality, description, instance_number, position, is_image in rows:
+            if not is_image:
+                continue
+            series = grouped.setdefault(series_uid, (SeriesInfo(series_uid, modality, description), []))
+            series[1].append((position, instance_number, path))
+
+        result = []
+        for series, slices in grouped.values():
+            # Sorted by position, by instance number for slices without one
+            slices.sort(key=lambda item: (item[0] is None, item[0] if item[0] is not None else 0,
+                                          item[1] if item[1] is not None else 0, item[2]))
+            series.files = [path for _, _, path in slices]
+            result.append(series)
+        result.sort(key=lambda series: len(series.files), reverse=True)
+        return result
+
+    def series_files(self, directory: str, series_uid: str | None = None) -> list[str]:
+        """
+        The sorted files of an image series in a directory, ready for SimpleITK's ImageSeriesReader.
+
+        :param directory:
+        :param series_uid: the series to return, the one with the most slices if None
+        :return: list of paths
+        :raises FileNotFoundError: if the directory holds no such image series
+        """
+        series = self.scan(directory)
+        if series_uid is not None:
+            series = [info for info in series if info.series_uid == series_uid]
+        if not series:
+            raise FileNotFoundError(f"No DICOM image series found in {directory}")
+        if series_uid is None and len(series) > 1:
+            logger.info(f"{directory} holds {len(series)} series, using {series[0].series_uid} "
+                        f"({len(series[0].files)} slices)")
+        return series[0].files
+
+    def clear(self) -> None:
+        """
+        Forget every indexed file.
+
+        :rtype: None
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM files")
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def default_index() -> SeriesIndex:
+    """
+    The series index shared by the viewer and the converter.
+
+    :rtype: SeriesIndex
+    """
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = SeriesIndex()
+        return _default_index
+
+
+def series_files(directory: str, series_uid: str | None = None) -> list[str]:
+    """
+    The sorted files of an image series in a directory, using the default index.
+    See SeriesIndex.series_files.
+    """
+    return default_index().series_files(directory, series_uid)
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Inspect the index of DICOM series.")
+    parser.add_argument("--index", default=None,
+                        help=f"Index database (default: ${INDEX_PATH_ENV} or {DEFAULT_INDEX_PATH})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_series = commands.add_parser("list", help="Index a directory and list its image series")
+    list_series.add_argument("directory")
+    commands.add_parser("clear", help="Forget every indexed file")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = _build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    index = SeriesIndex(args.index)
+
+    if args.command == "clear":
+        index.clear()
+        print(f"Cleared {index.path}")
+        return 0
+
+    series = index.scan(args.directory)
+    for info in series:
+        print(f"{info.series_uid}  {info.modality:<4} {len(info.files):>5} slices  {info.description}")
+    print(f"{len(series)} series in {args.directory}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
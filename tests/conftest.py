@@ -0,0 +1,17 @@
+import pytest
+
+import series_index
+from synthetic_data import generate_ct
+
+
+@pytest.fixture(autouse=True)
+def private_series_index(tmp_path, monkeypatch):
+    """Keep the default series index of the tests out of the user's cache directory."""
+    monkeypatch.setenv(series_index.INDEX_PATH_ENV, str(tmp_path / "series_index.sqlite"))
+    monkeypatch.setattr(series_index, "_default_index", None)
+
+
+@pytest.fixture
+def ct_series(tmp_path) -> str:
+    """A small synthetic CT series, one file per slice, see benchmarks/synthetic_data.py."""
+    return generate_ct(str(tmp_path / "data"), (16, 16, 4))
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from auto_segmentation import AutoSegmentation
+from scratch_space import ScratchLocation, ScratchManager
+
+
+@pytest.fixture
+def scratch_location(tmp_path) -> ScratchLocation:
+    return ScratchLocation("disk", str(tmp_path / "scratch"))
+
+
+@pytest.fixture
+def study(ct_series) -> str:
+    """A segmented study, with the Nifti file of an earlier run."""
+    os.makedirs(os.path.join(ct_series, "segmentations"))
+    with open(os.path.join(ct_series, "segmentations", "liver.nii.gz"), "w") as file:
+        file.write("earlier run")
+    return ct_series
+
+
+def _segment_in_files_mode(study, scratch_location, error=None) -> bool:
+    segmentation = AutoSegmentation(nifti_output="files", scratch=ScratchManager([scratch_location]))
+
+    def totalsegmentator(settings, return_labels=False):
+        assert not settings["output"].startswith(study)
+        for name in ("liver", "spleen"):
+            with open(os.path.join(settings["output"], f"{name}.nii.gz"), "w") as file:
+                file.write("this run")
+        if error is not None:
+            raise error
+    segmentation._run_totalsegmentator = totalsegmentator
+
+    try:
+        return segmentation.stage(study) and segmentation.infer(study, "total", False)
+    finally:
+        segmentation.cleanup()
+
+
+def _segmentations(study) -> dict:
+    directory = os.path.join(study, "segmentations")
+    return {name: open(os.path.join(directory, name)).read() for name in sorted(os.listdir(directory))}
+
+
+def test_segmentations_are_moved_into_the_study_once_complete(study, scratch_location):
+    assert _segment_in_files_mode(study, scratch_location)
+
+    assert _segmentations(study) == {"liver.nii.gz": "this run", "spleen.nii.gz": "this run"}
+    assert not [name for name in os.listdir(scratch_location.directory)
+                if os.path.isdir(os.path.join(scratch_location.directory, name))]
+
+
+def test_failed_inference_leaves_the_study_segmentations(study, scratch_location):
+    assert not _segment_in_files_mode(study, scratch_location, RuntimeError("out of memory"))
+
+    assert _segmentations(study) == {"liver.nii.gz": "earlier run"}
+    assert not [name for name in os.listdir(scratch_location.directory)
+                if os.path.isdir(os.path.join(scratch_location.directory, name))]
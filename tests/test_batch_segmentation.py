@@ -0,0 +1,69 @@
+import os
+import time
+
+import pytest
+
+from batch_segmentation import _study_log_path, is_study_up_to_date, main
+from segmentation_manifest import manifest_path_for, run_settings, save_manifest
+
+
+def _segmented(study_dir: str, task: str = "total", fast: bool = False) -> str:
+    """Give the study an RTSTRUCT newer than its series, recording the run settings."""
+    rtstruct_path = os.path.join(study_dir, "rtss.dcm")
+    with open(rtstruct_path, "wb") as file:
+        file.write(b"rtstruct")
+    save_manifest(manifest_path_for(rtstruct_path), {}, run_settings(task, fast))
+    later = time.time() + 10
+    os.utime(rtstruct_path, (later, later))
+    return rtstruct_path
+
+
+def test_study_without_rtstruct_is_not_up_to_date(ct_series):
+    assert not is_study_up_to_date(ct_series)
+    assert not is_study_up_to_date(ct_series, convert_only=True)
+
+
+def test_study_is_up_to_date_for_the_settings_it_was_segmented_with(ct_series):
+    _segmented(ct_series, "total", fast=False)
+
+    assert is_study_up_to_date(ct_series, task="total", fast=False)
+    assert not is_study_up_to_date(ct_series, task="total", fast=True)
+    assert not is_study_up_to_date(ct_series, task="lung_vessels", fast=False)
+    assert not is_study_up_to_date(ct_series, task="total", fast=False, roi_subset=["liver"])
+    # Converting does not depend on how the segmentations were made
+    assert is_study_up_to_date(ct_series, convert_only=True, task="lung_vessels")
+
+
+def test_newer_inputs_make_a_study_out_of_date(ct_series):
+    rtstruct_path = _segmented(ct_series)
+    segmentation_dir = os.path.join(ct_series, "segmentations")
+    os.makedirs(segmentation_dir)
+    nifti_path = os.path.join(segmentation_dir, "liver.nii.gz")
+    with open(nifti_path, "wb") as file:
+        file.write(b"mask")
+    newer = os.path.getmtime(rtstruct_path) + 10
+    os.utime(nifti_path, (newer, newer))
+
+    # The segmentations only count when converting them
+    assert is_study_up_to_date(ct_series)
+    assert not is_study_up_to_date(ct_series, convert_only=True)
+
+    os.utime(os.path.join(ct_series, "ct.0.dcm"), (newer, newer))
+    assert not is_study_up_to_date(ct_series)
+
+
+def test_study_log_names_are_unique(tmp_path):
+    log_dir = str(tmp_path / "logs")
+    first = _study_log_path(log_dir, "/data/site_a/patient")
+    second = _study_log_path(log_dir, "/data/site_b/patient")
+
+    assert first != second
+    assert os.path.basename(first).startswith("patient-") and first.endswith(".log")
+    assert _study_log_path(log_dir, "/data/site_a/patient") == first
+
+
+def test_pipeline_rejects_convert_only(tmp_path):
+    with pytest.raises(SystemExit) as exit_info:
+        main(["--pipeline", "--convert-only", str(tmp_path)])
+
+    assert exit_info.value.code == 2
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from cancellation import CancellationToken, SegmentationCancelled
+from inference_session import PredictorCache
+
+
+def test_token_raises_once_cancelled():
+    token = CancellationToken()
+    token.raise_if_cancelled()
+    assert not token.is_cancelled
+
+    token.cancel()
+    assert token.is_cancelled
+    with pytest.raises(SegmentationCancelled):
+        token.raise_if_cancelled()
+
+
+def test_callbacks_run_once_on_cancel():
+    token = CancellationToken()
+    calls = []
+    token.add_callback(lambda: calls.append("kept"))
+    removed = lambda: calls.append("removed")
+    token.add_callback(removed)
+    token.remove_callback(removed)
+
+    token.cancel()
+    token.cancel()
+    assert calls == ["kept"]
+
+    # Registered after the cancellation, called straight away
+    token.add_callback(lambda: calls.append("late"))
+    assert calls == ["kept", "late"]
+
+
+class _Predictor:
+    def __init__(self):
+        self.patches = 0
+
+    def _internal_maybe_mirror_and_predict(self, patch):
+        self.patches += 1
+        return patch
+
+
+def test_cached_predictor_stops_between_patches_of_the_cancelled_run():
+    cache = PredictorCache(_Predictor)
+    predictor = cache.get(("total",), _Predictor)
+    token = CancellationToken()
+
+    with cache.cancellable(token):
+        predictor._internal_maybe_mirror_and_predict(1)
+        token.cancel()
+        with pytest.raises(SegmentationCancelled):
+            predictor._internal_maybe_mirror_and_predict(2)
+    assert predictor.patches == 1
+
+    # Outside the context, and on other threads, the token is not checked
+    predictor._internal_maybe_mirror_and_predict(3)
+    with cache.cancellable(token):
+        thread = threading.Thread(target=predictor._internal_maybe_mirror_and_predict, args=(4,))
+        thread.start()
+        thread.join()
+    assert predictor.patches == 3
+    assert cache.get(("total",), _Predictor) is predictor and cache.hits == 1
+
+
+def test_cancelled_conversion_writes_nothing(ct_series, tmp_path):
+    from nifti_converter import nifti_to_rtstruct_conversion
+    from synthetic_data import generate_masks
+
+    mask_dir = generate_masks(str(tmp_path / "data"), (16, 16, 4), 2)
+    output_path = tmp_path / "rtss.dcm"
+    token = CancellationToken()
+    token.cancel()
+
+    with pytest.raises(SegmentationCancelled):
+        nifti_to_rtstruct_conversion(mask_dir, ct_series, str(output_path), cancel_token=token)
+    assert not output_path.exists()
+    assert nifti_to_rtstruct_conversion(mask_dir, ct_series, str(output_path))
+    assert output_path.exists()
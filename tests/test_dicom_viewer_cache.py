@@ -0,0 +1,28 @@
+from dicom_viewer_tab import _LRUCache
+
+
+def test_lru_cache_evicts_the_least_recently_used_item():
+    cache = _LRUCache(max_items=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats() == {"hits": 3, "misses": 1, "items": 2, "hit_rate": 0.75}
+
+
+def test_lru_cache_discard_and_clear():
+    cache = _LRUCache(max_items=4)
+    for view in ("axial", "coronal"):
+        for index in range(2):
+            cache.put((view, index), f"{view}{index}")
+
+    cache.discard(lambda key: key[0] == "axial")
+    assert cache.get(("axial", 0)) is None
+    assert cache.get(("coronal", 1)) == "coronal1"
+    assert cache.stats()["items"] == 2
+
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "items": 0, "hit_rate": None}
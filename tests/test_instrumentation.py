@@ -0,0 +1,40 @@
+import time
+
+from instrumentation import PROFILE_ENV, TRACE_DIR_ENV, Recorder, profiled, span
+
+
+def test_spans_start_from_the_recorder_origin():
+    recorder = Recorder("study")
+    with recorder.activate():
+        with span("staging", files=2):
+            with span("copy"):
+                pass
+        time.sleep(0.01)
+        with span("inference"):
+            pass
+
+    by_name = {record.name: record for record in recorder.spans}
+    assert by_name["copy"].depth == 1 and by_name["staging"].depth == 0
+    assert 0 <= by_name["staging"].start < by_name["inference"].start
+    assert by_name["staging"].attributes == {"files": 2}
+    assert [total["name"] for total in recorder.summary()] == ["staging", "copy", "inference"]
+
+
+def test_span_without_recorder_records_nothing():
+    recorder = Recorder()
+    with span("staging"):
+        pass
+    assert recorder.spans == []
+
+
+def test_overlapping_runs_profile_only_the_first(tmp_path, monkeypatch):
+    monkeypatch.setenv(PROFILE_ENV, "cprofile")
+    monkeypatch.setenv(TRACE_DIR_ENV, str(tmp_path))
+
+    with profiled("first"):
+        with profiled("second"):
+            pass
+    with profiled("third"):
+        pass
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["first.prof", "third.prof"]
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pytest
+
+from cancellation import CancellationToken, SegmentationCancelled
+from label_volume import LabelVolume
+
+
+def _label_volume() -> LabelVolume:
+    array = np.zeros((6, 6, 4), dtype=np.uint8)
+    array[1:3, 1:3, 1:3] = 1
+    array[3:5, 3:5, :] = 2
+    return LabelVolume(array, np.eye(4), {1: "liver", 2: "spleen"})
+
+
+def test_write_nifti_writes_a_mask_per_structure(tmp_path):
+    import SimpleITK as sitk
+
+    written = _label_volume().write_nifti(str(tmp_path))
+
+    assert sorted(written) == ["liver", "spleen"]
+    assert sorted(os.listdir(tmp_path)) == ["liver.nii.gz", "spleen.nii.gz"]
+    mask = sitk.GetArrayFromImage(sitk.ReadImage(written["liver"])).T
+    assert mask.sum() == 8 and mask[1, 1, 1] == 1
+
+
+def test_cancelled_write_nifti_keeps_the_earlier_files(tmp_path):
+    (tmp_path / "liver.nii.gz").write_bytes(b"earlier run")
+    token = CancellationToken()
+    checks = []
+
+    def raise_on_second_structure():
+        checks.append(None)
+        if len(checks) == 2:
+            raise SegmentationCancelled()
+    token.raise_if_cancelled = raise_on_second_structure
+
+    with pytest.raises(SegmentationCancelled):
+        _label_volume().write_nifti(str(tmp_path), token)
+    assert os.listdir(tmp_path) == ["liver.nii.gz"]
+    assert (tmp_path / "liver.nii.gz").read_bytes() == b"earlier run"
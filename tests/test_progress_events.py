@@ -0,0 +1,139 @@
+import io
+import json
+import sys
+import threading
+
+import progress_events
+from progress_events import (InferenceOutputParser, JsonLinesProgressLog, ProgressEvent, ProgressTracker,
+                             overall_percent, watch_thread_output)
+
+
+class _RecordingTracker:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, completed, total=None, fraction=None, message=None):
+        self.updates.append((completed, total, fraction, message))
+
+
+def test_parser_follows_the_patch_bar_across_chunks():
+    tracker = _RecordingTracker()
+    parser = InferenceOutputParser(tracker)
+
+    parser.feed("100%|####| 5/20 [00:01<00:03,")
+    parser.feed(" 4.0it/s]\r 1")
+    parser.feed("0/20 [00:02<00:02, 4.0it/s]")
+
+    # Every match is reported once, although the kept end of a chunk is parsed again
+    assert tracker.updates == [(5, 20, 0.25, ""), (10, 20, 0.5, "")]
+
+
+def test_parser_spreads_the_stage_over_the_parts_of_a_task():
+    tracker = _RecordingTracker()
+    parser = InferenceOutputParser(tracker)
+
+    parser.feed("Predicting part 2 of 4 ...\n")
+    parser.feed("10/10 [00:05<00:00, 2.0it/s]")
+    assert tracker.updates == [(10, 10, 0.5, "part 2 of 4")]
+
+    # The last patch of the last part leaves the end of the stage to finish()
+    parser.feed("Predicting part 4 of 4 ...\n 10/10 [00:05<00:00]")
+    assert parser.fraction == 0.999
+
+
+def test_parser_never_moves_back():
+    parser = InferenceOutputParser(_RecordingTracker())
+
+    parser.feed("15/20 [00:03<00:01]")
+    # e.g. the bar over the classes being saved
+    parser.feed("1/104 [00:00<00:10]")
+    parser.feed("0/0 [00:00<?]")
+    assert parser.fraction == 0.75
+
+
+def test_tracker_throttles_events_but_emits_the_last(monkeypatch):
+    monkeypatch.setattr(progress_events, "MIN_EVENT_INTERVAL", 60)
+    events = []
+    tracker = ProgressTracker(events.append, "conversion", 100, "structures", "/studies/a")
+
+    for _ in range(99):
+        tracker.advance()
+    tracker.finish()
+    tracker.finish()
+
+    assert [event.completed for event in events] == [1, 100]
+    assert events[-1].fraction == 1.0 and events[-1].eta == 0.0
+    assert events[-1].describe().startswith("Conversion: 100/100 structures")
+
+
+def test_overall_percent_weights_the_stages():
+    def at(stage, fraction):
+        return overall_percent(ProgressEvent(stage, 0, 0, "", fraction, 0.0))
+
+    assert at("staging", 0.0) == 0
+    assert at("staging", 1.0) == 5
+    assert at("preview", 0.5) == 5
+    assert at("inference", 0.5) == 48
+    assert at("conversion", 1.0) == 100
+
+
+def test_json_lines_progress_log(tmp_path):
+    path = tmp_path / "logs" / "progress.jsonl"
+    log = JsonLinesProgressLog(str(path))
+    tracker = ProgressTracker(log, "staging", 2, "files")
+    tracker.update(1)
+    tracker.finish()
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(line["stage"], line["completed"], line["fraction"]) for line in lines] == \
+        [("staging", 1, 0.5), ("staging", 2, 1.0)]
+
+
+def test_watch_thread_output_only_passes_on_the_watching_thread(monkeypatch):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    monkeypatch.setattr(sys, "stdout", stdout)
+    monkeypatch.setattr(sys, "stderr", stderr)
+    watched = []
+    started, written = threading.Event(), threading.Event()
+
+    def other_thread():
+        started.wait()
+        print("other")
+        written.set()
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    with watch_thread_output(watched.append):
+        print("mine")
+        sys.stderr.write("error")
+        started.set()
+        written.wait()
+    thread.join()
+    print("after")
+
+    assert "".join(watched) == "mine\nerror"
+    assert stdout.getvalue() == "mine\nother\nafter\n"
+    assert stderr.getvalue() == "error"
+
+
+def test_watch_thread_output_restores_the_streams_after_the_last_watcher(monkeypatch):
+    stdout = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", stdout)
+    entered, leave = threading.Event(), threading.Event()
+
+    def other_watcher():
+        with watch_thread_output(lambda text: None):
+            entered.set()
+            leave.wait()
+
+    thread = threading.Thread(target=other_watcher)
+    thread.start()
+    entered.wait()
+    with watch_thread_output(lambda text: None):
+        pass
+    # Still watched by the other thread
+    assert sys.stdout is not stdout
+
+    leave.set()
+    thread.join()
+    assert sys.stdout is stdout
@@ -0,0 +1,66 @@
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import redirect_stdout
+from redirect_stdout import ConsoleOutputStream, collapse_carriage_returns
+
+
+@pytest.fixture
+def qt_app():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+def _process_events_until(qt_app, condition, timeout=2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        qt_app.processEvents()
+        time.sleep(0.01)
+
+
+def test_collapse_carriage_returns_keeps_the_last_state_of_a_line():
+    assert collapse_carriage_returns("a\rb\rc") == "\rc"
+    assert collapse_carriage_returns(" 10%\r 50%\r100%\ndone\n") == "\r100%\ndone\n"
+    # Windows line endings are not overwrites
+    assert collapse_carriage_returns("first\r\nsecond\r\n") == "first\r\nsecond\r\n"
+
+
+def test_console_output_is_emitted_in_batches(qt_app, monkeypatch):
+    echoed = io.StringIO()
+    monkeypatch.setattr(sys, "__stdout__", echoed)
+    stream = ConsoleOutputStream()
+    emitted = []
+    stream.new_text.connect(emitted.append)
+
+    for text in (" 10%\r", " 50%\r", "100%\n"):
+        stream.write(text)
+        stream.flush()
+    stream.write_to_gui("gui only\n")
+    assert emitted == []
+
+    _process_events_until(qt_app, lambda: emitted)
+    assert emitted == ["\r100%\ngui only\n"]
+    assert echoed.getvalue() == " 10%\r 50%\r100%\n"
+
+
+def test_console_output_flushes_early_past_the_threshold(qt_app, monkeypatch):
+    monkeypatch.setattr(sys, "__stdout__", io.StringIO())
+    monkeypatch.setattr(redirect_stdout, "FLUSH_INTERVAL_MS", 60_000)
+    monkeypatch.setattr(redirect_stdout, "FLUSH_THRESHOLD", 16)
+    stream = ConsoleOutputStream()
+    emitted = []
+    stream.new_text.connect(emitted.append)
+
+    stream.write("short\n")
+    writer = threading.Thread(target=stream.write, args=("x" * 16,))
+    writer.start()
+    writer.join()
+
+    _process_events_until(qt_app, lambda: emitted)
+    assert emitted == ["short\n" + "x" * 16]
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from resource_profile import ResourceProfile, _set_affinity, available_cpus
+
+
+@pytest.fixture
+def pinned_threads(monkeypatch) -> list[int]:
+    """Record the thread ids pinned instead of pinning them."""
+    pinned = []
+    monkeypatch.setattr(os, "sched_setaffinity", lambda thread_id, cpus: pinned.append(thread_id), raising=False)
+    return pinned
+
+
+def test_pinning_in_process_only_pins_calling_thread(pinned_threads):
+    _set_affinity((0,), whole_process=False)
+
+    assert pinned_threads == [0]
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/task"), reason="needs /proc to list the threads")
+def test_pinning_whole_process_pins_every_thread(pinned_threads):
+    _set_affinity((0,), whole_process=True)
+
+    assert sorted(pinned_threads) == sorted(int(tid) for tid in os.listdir("/proc/self/task"))
+
+
+@pytest.mark.skipif(len(available_cpus()) < 2, reason="needs at least two cores")
+def test_auto_splits_cores_between_slots():
+    cpus = available_cpus()
+    first = ResourceProfile.auto(concurrent_runs=2, slot=0, pin=True)
+    second = ResourceProfile.auto(concurrent_runs=2, slot=1, pin=True)
+
+    assert first.torch_threads == second.torch_threads == len(cpus) // 2
+    assert not set(first.cpu_affinity) & set(second.cpu_affinity)
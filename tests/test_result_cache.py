@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import pydicom
+
+from result_cache import ResultCache, detach_hardlinks, series_digest
+
+
+def _segment(output_dir, names=("liver", "spleen")) -> list[str]:
+    os.makedirs(output_dir, exist_ok=True)
+    files = []
+    for name in names:
+        with open(os.path.join(output_dir, f"{name}.nii.gz"), "wb") as file:
+            file.write(name.encode() * 100)
+        files.append(f"{name}.nii.gz")
+    return files
+
+
+def test_series_digest_follows_the_image_files(ct_series, tmp_path):
+    series_uid, digest = series_digest(ct_series)
+    assert series_uid == str(pydicom.dcmread(os.path.join(ct_series, "ct.0.dcm")).SeriesInstanceUID)
+
+    copy = shutil.copytree(ct_series, tmp_path / "copy")
+    # Files the workflow does not copy are left out
+    (copy / "rtss.dcm").write_bytes(b"not an image")
+    (copy / "notes.txt").write_text("not DICOM")
+    assert series_digest(str(copy)) == (series_uid, digest)
+
+    dataset = pydicom.dcmread(copy / "ct.2.dcm")
+    dataset.PixelData = bytes(len(dataset.PixelData))
+    dataset.save_as(copy / "ct.2.dcm")
+    assert series_digest(str(copy))[1] != digest
+
+
+def test_key_depends_on_the_run_settings(ct_series, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key, _ = cache.key_for(ct_series, "total", False)
+
+    assert cache.key_for(ct_series, "total", False)[0] == key
+    assert cache.key_for(ct_series, "total", True)[0] != key
+    assert cache.key_for(ct_series, "lung_vessels", False)[0] != key
+    assert cache.key_for(ct_series, "total", False, ["spleen", "liver"])[0] == \
+        cache.key_for(ct_series, "total", False, ["liver", "spleen"])[0] != key
+
+
+def test_store_and_restore(ct_series, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key, series_uid = cache.key_for(ct_series, "total", False)
+    files = _segment(str(tmp_path / "run"))
+    assert cache.restore(key, str(tmp_path / "missing")) is False
+
+    entry = cache.store(key, series_uid, "total", False, str(tmp_path / "run"), files, ct_series)
+    assert entry.segmentations == files and cache.lookup(key) == entry
+
+    restored_dir = str(tmp_path / "study" / "segmentations")
+    assert cache.restore(key, restored_dir)
+    assert sorted(os.listdir(restored_dir)) == files
+    assert cache.lookup(key).last_used >= entry.last_used
+
+    # Writing the restored files once detached leaves the cache entry intact
+    detach_hardlinks(restored_dir)
+    with open(os.path.join(restored_dir, "liver.nii.gz"), "wb") as file:
+        file.write(b"overwritten")
+    cache.restore(key, str(tmp_path / "other"))
+    with open(tmp_path / "other" / "liver.nii.gz", "rb") as file:
+        assert file.read() == b"liver" * 100
+
+
+def test_failed_restore_is_a_miss(ct_series, tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key, series_uid = cache.key_for(ct_series, "total", False)
+    cache.store(key, series_uid, "total", False, str(tmp_path / "run"), _segment(str(tmp_path / "run")))
+
+    def fail(*_):
+        raise OSError("read-only cache")
+    monkeypatch.setattr(cache, "_write_info", fail)
+    assert cache.restore(key, str(tmp_path / "study")) is False
+
+
+def test_prune_evicts_least_recently_used(ct_series, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    keys = []
+    for task in ("total", "lung_vessels", "body"):
+        key, series_uid = cache.key_for(ct_series, task, False)
+        cache.store(key, series_uid, task, False, str(tmp_path / task), _segment(str(tmp_path / task)))
+        keys.append(key)
+    # The first entry becomes the most recently used
+    cache.restore(keys[0], str(tmp_path / "study"))
+
+    evicted = cache.prune(max_bytes=cache.lookup(keys[0]).size)
+    assert [entry.key for entry in evicted] == keys[1:]
+    assert [entry.key for entry in cache.entries()] == keys[:1]
@@ -0,0 +1,82 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+
+import pytest
+
+from scratch_space import ORPHAN_AGE, ScratchLocation, ScratchManager, ScratchRecord, ScratchSpaceError
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def _leave_directory(location: ScratchLocation, name: str, pid: int, host: str, created: float) -> str:
+    """Write a scratch directory and its record as a process that did not release it would."""
+    path = os.path.join(location.directory, name)
+    os.makedirs(path)
+    record = ScratchRecord(path, location.name, 1024, pid, host, created)
+    with open(path + ".json", "w") as record_file:
+        json.dump(asdict(record), record_file)
+    return path
+
+
+@pytest.fixture
+def locations(tmp_path) -> list[ScratchLocation]:
+    return [ScratchLocation("ram", str(tmp_path / "ram"), max_study_bytes=1000),
+            ScratchLocation("disk", str(tmp_path / "disk"), quota_bytes=3000)]
+
+
+def test_allocate_on_the_first_location_with_room(locations):
+    manager = ScratchManager(locations)
+
+    small = manager.allocate(500, "small")
+    large = manager.allocate(2000, "large")
+    assert small.record.location == "ram" and large.record.location == "disk"
+    assert os.path.isdir(small.path) and os.path.isdir(large.path)
+    assert [record.label for record in manager.records(locations[1])] == ["large"]
+
+    # The disk quota is reserved by the large study
+    with pytest.raises(ScratchSpaceError):
+        manager.allocate(2000)
+
+    large.release()
+    large.release()
+    assert large.released and not os.path.exists(large.path)
+    assert manager.records(locations[1]) == []
+    assert manager.allocate(2000).record.location == "disk"
+
+
+def test_directory_removed_when_garbage_collected(locations):
+    path = ScratchManager(locations).allocate(10).path
+    assert not os.path.exists(path)
+
+
+def test_sweep_removes_directories_of_dead_processes(locations):
+    manager = ScratchManager(locations)
+    location = locations[1]
+    host = socket.gethostname()
+    now = time.time()
+
+    alive = manager.allocate(2000)
+    dead = _leave_directory(location, "dead", _dead_pid(), host, now)
+    other_host_recent = _leave_directory(location, "recent", 1, "elsewhere", now)
+    other_host_old = _leave_directory(location, "old", 1, "elsewhere", now - ORPHAN_AGE - 1)
+    unrecorded_recent = os.path.join(location.directory, "unrecorded-recent")
+    unrecorded_old = os.path.join(location.directory, "unrecorded-old")
+    for path in (unrecorded_recent, unrecorded_old):
+        os.makedirs(path)
+    os.utime(unrecorded_old, (now - 7200, now - 7200))
+
+    removed = sorted(os.path.basename(record.path) for record in manager.sweep())
+    assert removed == ["dead", "old", "unrecorded-old"]
+    for path in (dead, other_host_old, unrecorded_old):
+        assert not os.path.exists(path)
+    for path in (alive.path, other_host_recent, unrecorded_recent):
+        assert os.path.isdir(path)
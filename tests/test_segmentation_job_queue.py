@@ -0,0 +1,118 @@
+from segmentation_job_queue import JobStatus, SegmentationJobQueue
+
+
+def test_higher_priority_starts_first_then_submission_order():
+    queue = SegmentationJobQueue(max_concurrent=3)
+    low, _ = queue.submit("/studies/a", "total", False, priority=0)
+    first, _ = queue.submit("/studies/b", "total", False, priority=1)
+    second, _ = queue.submit("/studies/c", "total", False, priority=1)
+
+    assert [queue.next_runnable() for _ in range(3)] == [first, second, low]
+    assert queue.next_runnable() is None
+
+
+def test_concurrency_limit():
+    queue = SegmentationJobQueue(max_concurrent=1)
+    first, _ = queue.submit("/studies/a", "total", False)
+    second, _ = queue.submit("/studies/b", "total", False)
+
+    assert queue.next_runnable() is first
+    assert queue.next_runnable() is None
+
+    queue.finish(first.job_id, success=True)
+    assert queue.next_runnable() is second
+
+
+def test_identical_request_returns_existing_job():
+    queue = SegmentationJobQueue()
+    job, is_new = queue.submit("/studies/a", "total", False, roi_subset=["liver", "spleen"])
+    duplicate, duplicate_is_new = queue.submit("/studies/a/", "total", False, roi_subset=["spleen", "liver"])
+
+    assert is_new and not duplicate_is_new
+    assert duplicate is job
+    assert len(queue.jobs()) == 1
+
+
+def test_different_settings_are_separate_jobs():
+    queue = SegmentationJobQueue()
+    queue.submit("/studies/a", "total", False)
+    _, fast_is_new = queue.submit("/studies/a", "total", True)
+    _, subset_is_new = queue.submit("/studies/a", "total", False, roi_subset=["liver"])
+
+    assert fast_is_new and subset_is_new
+    assert len(queue.jobs()) == 3
+
+
+def test_duplicate_raises_priority_of_queued_job():
+    queue = SegmentationJobQueue()
+    other, _ = queue.submit("/studies/a", "total", False, priority=1)
+    job, _ = queue.submit("/studies/b", "total", False, priority=0)
+    queue.submit("/studies/b", "total", False, priority=2)
+
+    assert job.priority == 2
+    assert queue.next_runnable() is job
+    queue.finish(job.job_id, success=True)
+    assert queue.next_runnable() is other
+    queue.finish(other.job_id, success=True)
+    # The entry left behind by the priority change does not start the job again
+    assert queue.next_runnable() is None
+
+
+def test_finished_job_can_be_submitted_again():
+    queue = SegmentationJobQueue()
+    job, _ = queue.submit("/studies/a", "total", False)
+    queue.next_runnable()
+    queue.finish(job.job_id, success=True)
+
+    again, is_new = queue.submit("/studies/a", "total", False)
+    assert is_new and again is not job
+
+
+def test_jobs_of_one_study_never_run_together():
+    queue = SegmentationJobQueue(max_concurrent=2)
+    first, _ = queue.submit("/studies/a", "total", False, priority=2)
+    same_study, _ = queue.submit("/studies/a", "lung_vessels", False, priority=1)
+    other_study, _ = queue.submit("/studies/b", "total", False, priority=0)
+
+    assert queue.next_runnable() is first
+    # The study is busy, the lower priority job of another study starts instead
+    assert queue.next_runnable() is other_study
+    assert same_study.status == JobStatus.QUEUED
+
+    queue.finish(first.job_id, success=True)
+    assert queue.next_runnable() is same_study
+
+
+def test_cancel_only_stops_queued_jobs():
+    queue = SegmentationJobQueue()
+    running, _ = queue.submit("/studies/a", "total", False)
+    queued, _ = queue.submit("/studies/b", "total", False)
+    queue.next_runnable()
+
+    assert not queue.cancel(running.job_id)
+    assert queue.cancel(queued.job_id)
+    assert queued.status == JobStatus.CANCELLED
+
+    queue.finish(running.job_id, success=False, cancelled=True)
+    assert running.status == JobStatus.CANCELLED
+    assert queue.next_runnable() is None
+    assert queue.active_jobs("/studies/a") == []
+
+
+def test_finish_only_records_the_first_outcome():
+    queue = SegmentationJobQueue()
+    job, _ = queue.submit("/studies/a", "total", False)
+    queue.next_runnable()
+
+    assert queue.finish(job.job_id, success=True) is job
+    assert queue.finish(job.job_id, success=False, message="late error") is None
+    assert job.status == JobStatus.FINISHED
+    assert job.message == ""
+
+
+def test_finish_ignores_jobs_which_did_not_start():
+    queue = SegmentationJobQueue()
+    job, _ = queue.submit("/studies/a", "total", False)
+
+    assert queue.finish(job.job_id, success=True) is None
+    assert job.status == JobStatus.QUEUED
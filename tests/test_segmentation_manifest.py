@@ -0,0 +1,69 @@
+import json
+import os
+
+from segmentation_manifest import (MANIFEST_VERSION, diff_structures, file_fingerprint, load_manifest,
+                                   load_settings, manifest_path_for, record_settings, run_settings, same_content,
+                                   save_manifest)
+
+
+def test_diff_structures():
+    previous = {"liver": {"sha256": "a"}, "spleen": {"sha256": "b"}, "heart": {"sha256": "c"}}
+    current = {"liver": {"sha256": "a"}, "spleen": {"sha256": "changed"}, "aorta": {"sha256": "d"}}
+
+    assert diff_structures(previous, current) == (["aorta"], ["spleen"], ["heart"])
+
+
+def test_same_content_compares_a_common_hash():
+    voxels_and_file = {"voxels": "v", "sha256": "f", "size": 1}
+
+    assert same_content({"voxels": "v"}, voxels_and_file)
+    assert same_content({"sha256": "f", "size": 1}, voxels_and_file)
+    assert not same_content({"voxels": "other"}, voxels_and_file)
+    # A voxel hash is never compared with a file hash
+    assert not same_content({"voxels": "v"}, {"sha256": "v", "size": 1})
+
+
+def test_file_fingerprint_reuses_hash_of_unchanged_file(tmp_path):
+    path = tmp_path / "liver.nii.gz"
+    path.write_bytes(b"segmentation")
+    fingerprint = file_fingerprint(str(path))
+
+    # A hash reused from the previous run, as size and mtime are unchanged
+    assert file_fingerprint(str(path), {**fingerprint, "sha256": "recorded"})["sha256"] == "recorded"
+
+    path.write_bytes(b"another segmentation")
+    assert file_fingerprint(str(path), fingerprint)["sha256"] != fingerprint["sha256"]
+
+
+def test_save_and_load_manifest(tmp_path):
+    manifest_path = manifest_path_for(str(tmp_path / "rtss.dcm"))
+    structures = {"liver": {"voxels": "v"}}
+    save_manifest(manifest_path, structures)
+
+    assert manifest_path.endswith("rtss.dcm.manifest.json")
+    assert load_manifest(manifest_path) == structures
+    assert not os.path.exists(manifest_path + ".tmp")
+
+
+def test_unusable_manifests_are_ignored(tmp_path):
+    missing = str(tmp_path / "missing.json")
+    unreadable = tmp_path / "unreadable.json"
+    unreadable.write_text("{")
+    other_version = tmp_path / "other_version.json"
+    other_version.write_text(json.dumps({"version": MANIFEST_VERSION + 1, "structures": {}}))
+
+    assert load_manifest(missing) is None
+    assert load_manifest(str(unreadable)) is None
+    assert load_manifest(str(other_version)) is None
+
+
+def test_settings_are_kept_by_later_saves(tmp_path):
+    manifest_path = str(tmp_path / "rtss.dcm.manifest.json")
+    save_manifest(manifest_path, {"liver": {"voxels": "v"}})
+    assert load_settings(manifest_path) is None
+
+    record_settings(manifest_path, run_settings("total", True, ["spleen", "liver"]))
+    save_manifest(manifest_path, {"liver": {"voxels": "changed"}})
+
+    assert load_settings(manifest_path) == {"task": "total", "fast": True, "roi_subset": ["liver", "spleen"]}
+    assert load_manifest(manifest_path) == {"liver": {"voxels": "changed"}}
@@ -0,0 +1,71 @@
+import threading
+
+from headless_signals import HeadlessWorkerSignals
+from segmentation_pipeline import SegmentationPipeline
+
+
+class _Segmentation:
+    """Stands in for AutoSegmentation, failing the stage named after the study."""
+
+    def __init__(self, log: list) -> None:
+        self.signals = HeadlessWorkerSignals()
+        self.log = log
+
+    def _step(self, stage, dicom_dir) -> bool:
+        self.log.append((stage, dicom_dir))
+        if dicom_dir == f"raises-in-{stage}":
+            raise RuntimeError(f"{stage} broke")
+        if dicom_dir == f"fails-in-{stage}":
+            self.signals.error.emit(f"{stage} failed")
+            return False
+        return True
+
+    def stage(self, dicom_dir):
+        return self._step("staging", dicom_dir)
+
+    def infer(self, dicom_dir, task, fast):
+        return self._step("inference", dicom_dir)
+
+    def convert(self, dicom_dir):
+        return self._step("conversion", dicom_dir)
+
+    def cleanup(self):
+        self.log.append(("cleanup", None))
+
+    def report_timing(self, dicom_dir):
+        pass
+
+
+def test_stage_errors_fail_only_their_study_and_the_pipeline_shuts_down():
+    log = []
+    converted = []
+    pipeline = SegmentationPipeline(on_converted=converted.append, segmentation_factory=lambda: _Segmentation(log))
+
+    studies = ["first", "raises-in-inference", "fails-in-conversion", "last"]
+    results = pipeline.run([(study, "total", False) for study in studies])
+
+    assert [study.dicom_dir for study in results] == studies
+    by_dir = {study.dicom_dir: study for study in results}
+    assert by_dir["raises-in-inference"].failed_stage == "inference"
+    assert by_dir["raises-in-inference"].errors == ["inference broke"]
+    assert by_dir["fails-in-conversion"].failed_stage == "conversion"
+    assert by_dir["fails-in-conversion"].errors == ["conversion failed"]
+    assert by_dir["first"].success and by_dir["last"].success
+    assert [study.dicom_dir for study in converted] == ["first", "last"]
+
+    # The failed studies skip the later stages and release their scratch copy
+    assert ("conversion", "raises-in-inference") not in log
+    assert log.count(("cleanup", None)) == 2
+    assert not any(thread.name.startswith("pipeline-") for thread in threading.enumerate())
+
+
+def test_loading_errors_do_not_stop_the_pipeline():
+    def load(study):
+        raise RuntimeError("viewer closed")
+
+    results = SegmentationPipeline(on_converted=load, segmentation_factory=lambda: _Segmentation([])).run(
+        [("first", "total", False), ("second", "total", False)]
+    )
+
+    assert [study.failed_stage for study in results] == ["loading", "loading"]
+    assert not any(thread.name.startswith("pipeline-") for thread in threading.enumerate())
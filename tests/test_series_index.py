@@ -0,0 +1,75 @@
+import os
+
+import pydicom
+import pytest
+
+import series_index
+from series_index import SeriesIndex
+
+
+def _count_header_reads(monkeypatch) -> list[str]:
+    reads = []
+    read_header = series_index._read_header
+
+    def counting_read_header(path):
+        reads.append(path)
+        return read_header(path)
+    monkeypatch.setattr(series_index, "_read_header", counting_read_header)
+    return reads
+
+
+def test_series_sorted_along_the_slice_direction(ct_series, tmp_path):
+    # File names in the opposite order of the slices
+    for index in range(4):
+        os.rename(os.path.join(ct_series, f"ct.{index}.dcm"), os.path.join(ct_series, f"slice-{3 - index}.dcm"))
+    with open(os.path.join(ct_series, "notes.txt"), "w") as file:
+        file.write("not DICOM")
+
+    files = SeriesIndex(str(tmp_path / "index.sqlite")).series_files(ct_series)
+    assert [os.path.basename(path) for path in files] == [f"slice-{index}.dcm" for index in (3, 2, 1, 0)]
+
+
+def test_series_with_most_slices_is_the_default(ct_series, tmp_path):
+    dataset = pydicom.dcmread(os.path.join(ct_series, "ct.0.dcm"))
+    dataset.SeriesInstanceUID = "1.2.3.4"
+    dataset.SOPInstanceUID = "1.2.3.4.1"
+    dataset.save_as(os.path.join(ct_series, "scout.dcm"))
+    index = SeriesIndex(str(tmp_path / "index.sqlite"))
+
+    series = index.scan(ct_series)
+    assert [len(info.files) for info in series] == [4, 1]
+    assert index.series_files(ct_series) == series[0].files
+    assert index.series_files(ct_series, "1.2.3.4") == [os.path.join(os.path.realpath(ct_series), "scout.dcm")]
+    with pytest.raises(FileNotFoundError):
+        index.series_files(ct_series, "5.6.7")
+
+
+def test_only_new_and_changed_files_are_read_again(ct_series, tmp_path, monkeypatch):
+    reads = _count_header_reads(monkeypatch)
+    index_path = str(tmp_path / "index.sqlite")
+    files = SeriesIndex(index_path).series_files(ct_series)
+    assert len(reads) == 4
+
+    # Kept across instances through the database
+    reads.clear()
+    assert SeriesIndex(index_path).series_files(ct_series) == files
+    assert reads == []
+
+    os.utime(files[1], ns=(0, 0))
+    os.remove(files[3])
+    assert SeriesIndex(index_path).series_files(ct_series) == files[:3]
+    assert reads == [files[1]]
+
+
+def test_directory_without_images(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        SeriesIndex(":memory:").series_files(str(tmp_path))
+
+
+def test_unusable_database_is_kept_in_memory(ct_series, tmp_path):
+    not_a_directory = tmp_path / "file"
+    not_a_directory.write_text("")
+
+    index = SeriesIndex(str(not_a_directory / "index.sqlite"))
+    assert index.path == ":memory:"
+    assert len(index.series_files(ct_series)) == 4
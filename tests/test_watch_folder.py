@@ -0,0 +1,142 @@
+import json
+import os
+import time
+
+import pytest
+
+from segmentation_manifest import manifest_path_for, run_settings, save_manifest
+from watch_folder import FAILED, QUEUED, RUNNING, STATE_FORMAT_VERSION, QueuedStudy, WatchFolder, study_signature
+
+
+def _export(inbox, name, files=2) -> str:
+    study_dir = os.path.join(inbox, name)
+    os.makedirs(study_dir, exist_ok=True)
+    for index in range(files):
+        with open(os.path.join(study_dir, f"ct.{index}.dcm"), "wb") as file:
+            file.write(b"slice" * (index + 1))
+    return study_dir
+
+
+@pytest.fixture
+def watcher(tmp_path) -> WatchFolder:
+    os.makedirs(tmp_path / "inbox")
+    return WatchFolder(str(tmp_path / "inbox"), str(tmp_path / "outbox"), "total", False, str(tmp_path / "logs"),
+                       settle_seconds=30)
+
+
+def test_signature_leaves_out_the_outputs(tmp_path):
+    study_dir = _export(str(tmp_path), "study")
+    signature = study_signature(study_dir)
+    assert signature[:2] == [2, 15]
+
+    os.makedirs(os.path.join(study_dir, "segmentations"))
+    with open(os.path.join(study_dir, "segmentations", "liver.nii.gz"), "wb") as file:
+        file.write(b"mask")
+    with open(os.path.join(study_dir, "rtss.dcm"), "wb") as file:
+        file.write(b"rtstruct")
+    assert study_signature(study_dir) == signature
+
+
+def test_study_queued_once_its_files_settle(watcher):
+    _export(watcher.inbox, "study")
+    os.makedirs(os.path.join(watcher.inbox, "empty"))
+    os.makedirs(os.path.join(watcher.inbox, ".hidden"))
+
+    assert watcher.scan(now=0) == []
+    assert watcher.scan(now=20) == []
+    # Still being copied
+    _export(watcher.inbox, "study", files=3)
+    assert watcher.scan(now=40) == []
+    assert watcher.scan(now=60) == []
+    assert watcher.scan(now=70) == ["study"]
+    assert watcher.scan(now=100) == []
+
+    study = watcher.studies["study"]
+    assert study.status == QUEUED and study.signature[0] == 3
+    assert os.path.isfile(watcher.state_path)
+
+
+def test_state_recovered_after_a_restart(watcher, tmp_path):
+    for name in ("queued", "running", "last_attempt"):
+        _export(watcher.inbox, name)
+    watcher.studies = {
+        "queued": QueuedStudy("queued", QUEUED, [2, 15, 0]),
+        "running": QueuedStudy("running", RUNNING, [2, 15, 0], attempts=1),
+        "last_attempt": QueuedStudy("last_attempt", RUNNING, [2, 15, 0], attempts=2),
+        "removed": QueuedStudy("removed", QUEUED, [2, 15, 0]),
+    }
+    watcher.save_state()
+
+    restarted = WatchFolder(watcher.inbox, watcher.outbox, "total", False, watcher.log_dir, max_attempts=2)
+    restarted.load_state()
+    assert {name: study.status for name, study in restarted.studies.items()} == \
+        {"queued": QUEUED, "running": QUEUED, "last_attempt": FAILED}
+    assert restarted.studies["running"].attempts == 1
+
+
+def test_unusable_state_is_ignored(watcher):
+    with open(watcher.state_path, "w") as state_file:
+        json.dump({"version": STATE_FORMAT_VERSION + 1, "studies": [{"name": "study"}]}, state_file)
+    watcher.load_state()
+    assert watcher.studies == {}
+
+    with open(watcher.state_path, "w") as state_file:
+        state_file.write("{")
+    watcher.load_state()
+    assert watcher.studies == {}
+
+
+def test_failed_study_retried_then_queued_again_once_changed(watcher):
+    _export(watcher.inbox, "study")
+    watcher.scan(now=0)
+    watcher.scan(now=30)
+    study = watcher.studies["study"]
+
+    for attempt in (1, 2):
+        study.attempts = attempt
+        watcher._finish(study, False, "failed")
+    assert study.status == FAILED and watcher.failed == 1
+    assert watcher.scan(now=100) == []
+
+    _export(watcher.inbox, "study", files=3)
+    watcher.scan(now=200)
+    assert watcher.scan(now=230) == ["study"]
+    assert watcher.studies["study"].attempts == 0
+
+
+def test_finished_study_moved_to_the_outbox(watcher):
+    _export(watcher.inbox, "study")
+    os.makedirs(os.path.join(watcher.outbox, "study"))
+    watcher.studies["study"] = QueuedStudy("study", RUNNING, [2, 15, 0], attempts=1)
+
+    watcher._finish(watcher.studies["study"], True, "done")
+    assert watcher.studies == {}
+    assert not os.path.exists(os.path.join(watcher.inbox, "study"))
+    # The outbox already held a study of that name
+    assert len(os.listdir(watcher.outbox)) == 2
+
+
+def test_recovered_study_already_segmented_is_only_moved(watcher):
+    study_dir = _export(watcher.inbox, "study")
+    rtstruct_path = os.path.join(study_dir, "rtss.dcm")
+    with open(rtstruct_path, "wb") as file:
+        file.write(b"rtstruct")
+    later = time.time() + 10
+    os.utime(rtstruct_path, (later, later))
+
+    save_manifest(manifest_path_for(rtstruct_path), {}, run_settings("total", True))
+    watcher.studies["study"] = QueuedStudy("study", QUEUED, study_signature(study_dir), attempts=1)
+
+    class NoWorkers:
+        def submit(self, *args, **kwargs):
+            raise AssertionError("segmented again")
+
+    # Segmented with other settings
+    with pytest.raises(AssertionError):
+        watcher._submit(NoWorkers(), {})
+
+    save_manifest(manifest_path_for(rtstruct_path), {}, run_settings("total", False))
+    watcher.studies["study"].status = QUEUED
+    watcher._submit(NoWorkers(), {})
+    assert watcher.studies == {}
+    assert os.path.isdir(os.path.join(watcher.outbox, "study"))
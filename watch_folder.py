@@ -0,0 +1,443 @@
+"""Headless watch-folder service segmenting the studies exported into an inbox.
+
+Every subdirectory of the inbox is a study. A new study is queued once its
+file count and size have not changed for --settle seconds, so a study still
+being copied by the scanner export is never picked up half written. Queued
+studies run through AutoSegmentation.run_segmentation_workflow on a pool of
+worker processes, as in batch_segmentation, which write the NIfTI
+segmentations and rtss.dcm into the study. Finished studies are then moved
+to the outbox, failed ones are retried up to --attempts times and left in
+the inbox (or moved to --failed-dir). A failed study left in the inbox is
+queued again once its files change.
+
+The queue is kept in a JSON state file (by default .onkodicom-watch.json in
+the inbox), so studies queued or running when the service stopped are
+processed again after a restart. A recovered study whose rtss.dcm is
+already up to date is moved to the outbox without segmenting it again.
+PySide6 is never imported.
+
+Example:
+    python watch_folder.py /data/inbox /data/outbox --task total --fast --workers 2
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass
+
+from batch_segmentation import _init_worker, is_study_up_to_date, process_study
+from ignore_files_in_dir import ignore_func
+from instrumentation import PROFILE_ENV, TRACE_DIR_ENV
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the layout of the state file changes
+STATE_FORMAT_VERSION = 1
+STATE_FILE_NAME = ".onkodicom-watch.json"
+
+QUEUED = "queued"
+RUNNING = "running"
+FAILED = "failed"
+
+
+def study_signature(study_dir: str) -> list[int]:
+    """
+    Describe a study's input files by their count, total size and newest
+    modification time. Outputs of the workflow (segmentations, RTSTRUCT)
+    are left out, so segmenting a study does not change its signature.
+
+    :param study_dir:
+    :return: [file count, total bytes, newest mtime in ns]
+    """
+    count = size = newest = 0
+    for root, directories, files in os.walk(study_dir):
+        ignored = set(ignore_func(root, directories + files)) if root == study_dir else set()
+        directories[:] = [name for name in directories if name not in ignored]
+        for name in files:
+            if name in ignored:
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                # Removed while scanning, e.g. a temporary file of the export
+                continue
+            count += 1
+            size += stat.st_size
+            newest = max(newest, stat.st_mtime_ns)
+    return [count, size, newest]
+
+
+@dataclass
+class QueuedStudy:
+    """A study of the inbox known to the watcher, stored in the state file."""
+    name: str
+    status: str
+    signature: list[int]
+    queued: float = 0.0
+    attempts: int = 0
+    message: str = ""
+
+
+class WatchFolder:
+    """Watches an inbox and segments the studies arriving in it, see the module docstring.
+
+    :param inbox: directory the studies are exported into
+    :param outbox: directory finished studies are moved to
+    :param task: TotalSegmentator task
+    :param fast: use TotalSegmentator's fastest mode
+    :param log_dir: directory receiving the per-study logs
+    :param workers: number of studies segmented concurrently
+    :param settle_seconds: time a study's files must stay unchanged before it is queued
+    :param poll_interval: seconds between scans of the inbox
+    :param max_attempts: runs of a study before it is given up
+    :param failed_dir: directory failed studies are moved to, None to leave them in the inbox
+    :param state_path: state file, defaults to .onkodicom-watch.json in the inbox
+    :param study_options: further keyword arguments of batch_segmentation.process_study
+    """
+
+    def __init__(self, inbox: str, outbox: str, task: str, fast: bool, log_dir: str, workers: int = 1,
+                 settle_seconds: float = 30.0, poll_interval: float = 5.0, max_attempts: int = 2,
+                 failed_dir: str | None = None, state_path: str | None = None, threads: int | None = None,
+                 pin_cpus: bool = False, **study_options) -> None:
+        self.inbox = os.path.abspath(inbox)
+        self.outbox = os.path.abspath(outbox)
+        self.task = task
+        self.fast = fast
+        self.log_dir = os.path.abspath(log_dir)
+        self.workers = max(1, workers)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max(1, max_attempts)
+        self.failed_dir = os.path.abspath(failed_dir) if failed_dir else None
+        self.state_path = state_path or os.path.join(self.inbox, STATE_FILE_NAME)
+        self.threads = threads
+        self.pin_cpus = pin_cpus
+        self.study_options = study_options
+
+        self.studies: dict[str, QueuedStudy] = {}
+        # Signature of each new study and the time it was last seen changing
+        self._settling: dict[str, tuple[list[int], float]] = {}
+        self._stop = threading.Event()
+        # Studies given up since the watcher started
+        self.failed = 0
+
+    def stop(self) -> None:
+        """
+        Stop queuing studies, the running ones are finished first. May be called from any thread.
+
+        :rtype: None
+        """
+        self._stop.set()
+
+    def _study_dir(self, name: str) -> str:
+        return os.path.join(self.inbox, name)
+
+    def load_state(self) -> None:
+        """
+        Restore the queue of the previous run. Studies which were running are
+        queued again, unless they have used up their attempts, and studies which
+        are no longer in the inbox are forgotten.
+
+        :rtype: None
+        """
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable watch state {self.state_path}: {e}")
+            return
+        if state.get("version") != STATE_FORMAT_VERSION:
+            logger.warning(f"Ignoring watch state {self.state_path} of another format")
+            return
+
+        for entry in state.get("studies", []):
+            study = QueuedStudy(**entry)
+            if not os.path.isdir(self._study_dir(study.name)):
+                continue
+            if study.status == RUNNING:
+                if study.attempts >= self.max_attempts:
+                    study.status, study.message = FAILED, "Interrupted on its last attempt"
+                else:
+                    study.status = QUEUED
+                    logger.info(f"Recovered interrupted study {study.name}")
+            self.studies[study.name] = study
+
+        queued = sum(study.status == QUEUED for study in self.studies.values())
+        logger.info(f"Restored {len(self.studies)} studies from {self.state_path}, {queued} queued")
+
+    def save_state(self) -> None:
+        """
+        Write the queue to the state file, replacing it atomically.
+
+        :rtype: None
+        """
+        state = {"version": STATE_FORMAT_VERSION, "studies": [asdict(study) for study in self.studies.values()]}
+        temporary_path = f"{self.state_path}.tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(state, state_file, indent=2)
+        os.replace(temporary_path, self.state_path)
+
+    def scan(self, now: float | None = None) -> list[str]:
+        """
+        Look for new studies in the inbox, queuing those whose files have settled.
+        A failed study whose files have changed since is queued again.
+
+        :param now: time of the scan, defaults to the current time
+        :return: names of the studies queued by this scan
+        """
+        now = time.time() if now is None else now
+        try:
+            names = sorted(
+                entry.name for entry in os.scandir(self.inbox)
+                if entry.is_dir() and not entry.name.startswith(".")
+            )
+        except FileNotFoundError:
+            logger.error(f"Inbox {self.inbox} does not exist")
+            return []
+
+        self._settling = {name: value for name, value in self._settling.items() if name in names}
+        queued = []
+        for name in names:
+            study = self.studies.get(name)
+            if study is not None and study.status != FAILED:
+                continue
+
+            signature = study_signature(self._study_dir(name))
+            if study is not None and signature == study.signature:
+                continue
+            if signature[0] == 0:
+                continue
+
+            previous, changed = self._settling.get(name, (None, now))
+            if signature != previous:
+                self._settling[name] = (signature, now)
+                continue
+            if now - changed < self.settle_seconds:
+                continue
+
+            del self._settling[name]
+            self.studies[name] = QueuedStudy(name, QUEUED, signature, queued=now)
+            queued.append(name)
+            logger.info(f"Queued {name}: {signature[0]} files")
+
+        if queued:
+            self.save_state()
+        return queued
+
+    def _next_queued(self) -> QueuedStudy | None:
+        queued = [study for study in self.studies.values() if study.status == QUEUED]
+        return min(queued, key=lambda study: study.queued) if queued else None
+
+    def _submit(self, executor, running: dict) -> None:
+        """
+        Start queued studies until every worker is busy, oldest first.
+        """
+        while len(running) < self.workers:
+            study = self._next_queued()
+            if study is None:
+                return
+            study_dir = self._study_dir(study.name)
+
+            # Segmented before an interruption, only the move is left
+            if study.attempts and is_study_up_to_date(study_dir, task=self.task, fast=self.fast):
+                self._finish(study, True, "Already segmented")
+                continue
+
+            study.status = RUNNING
+            study.attempts += 1
+            self.save_state()
+            logger.info(f"Segmenting {study.name} (attempt {study.attempts} of {self.max_attempts})")
+            future = executor.submit(process_study, study_dir, self.task, self.fast, self.log_dir,
+                                     **self.study_options)
+            running[future] = study.name
+
+    def _collect(self, done, running: dict) -> bool:
+        """
+        Record the outcome of the finished studies.
+        Returns True if a worker process died, which breaks the pool.
+        """
+        broken = False
+        for future in done:
+            study = self.studies[running.pop(future)]
+            try:
+                _, success, message = future.result()
+            except BrokenProcessPool as e:
+                logger.error(f"Worker process died while segmenting {study.name}: {e}")
+                broken, success, message = True, False, str(e)
+            except Exception as e:
+                logger.exception(f"Worker process failed on {study.name}: {e}")
+                success, message = False, str(e)
+            self._finish(study, success, message)
+        return broken
+
+    def _start_workers(self) -> ProcessPoolExecutor:
+        # Each worker keeps its nnU-Net models loaded between the studies it processes
+        # and gets its own share of the CPU cores
+        slot_counter = multiprocessing.Value("i", 0)
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(slot_counter, self.workers, self.threads, self.pin_cpus))
+
+    def _finish(self, study: QueuedStudy, success: bool, message: str) -> None:
+        """
+        Move a finished study to the outbox, or queue a failed one again while it has attempts left.
+        """
+        study.message = message
+        if success:
+            destination = self._move(study.name, self.outbox)
+            del self.studies[study.name]
+            logger.info(f"Finished {study.name}, moved to {destination} ({message})")
+        elif study.attempts < self.max_attempts:
+            study.status = QUEUED
+            logger.warning(f"Failed {study.name}, queued again: {message}")
+        else:
+            study.status = FAILED
+            self.failed += 1
+            logger.error(f"Failed {study.name} after {study.attempts} attempts: {message}")
+            if self.failed_dir:
+                self._move(study.name, self.failed_dir)
+                del self.studies[study.name]
+        self.save_state()
+
+    def _move(self, name: str, directory: str) -> str:
+        """
+        Move a study out of the inbox, adding a timestamp to its name if the destination is taken.
+        """
+        os.makedirs(directory, exist_ok=True)
+        destination = os.path.join(directory, name)
+        if os.path.exists(destination):
+            destination = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}")
+        shutil.move(self._study_dir(name), destination)
+        return destination
+
+    def _is_idle(self, running: dict) -> bool:
+        return not running and not self._settling and self._next_queued() is None
+
+    def run(self, once: bool = False) -> int:
+        """
+        Watch the inbox until stop() is called, or with once until every study
+        found in the inbox has been processed.
+
+        :param once: return once there is nothing left to do
+        :return: number of studies given up on while watching
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.load_state()
+        logger.info(f"Watching {self.inbox} with {self.workers} workers, finished studies go to {self.outbox}")
+
+        running = {}
+        executor = self._start_workers()
+        try:
+            while True:
+                if not self._stop.is_set():
+                    self.scan()
+                    self._submit(executor, running)
+                if not running and (self._stop.is_set() or (once and self._is_idle(running))):
+                    break
+
+                if not running:
+                    self._stop.wait(self.poll_interval)
+                    continue
+                done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                if self._collect(done, running):
+                    # The other studies of a broken pool fail as well, they are queued again
+                    # on a fresh pool while they have attempts left
+                    self._collect(wait(running)[0], running)
+                    executor.shutdown(wait=False)
+                    executor = self._start_workers()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        logger.info(f"Stopped watching {self.inbox}, {self.failed} studies failed")
+        return self.failed
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Watch an inbox for exported DICOM studies, segment each with TotalSegmentator, write rtss.dcm "
+                    "and move it to the outbox, without the GUI."
+    )
+    parser.add_argument("inbox", help="Directory the studies are exported into, one subdirectory per study")
+    parser.add_argument("outbox", help="Directory finished studies are moved to")
+    parser.add_argument("--task", default="total", help="TotalSegmentator task (default: total)")
+    parser.add_argument("--fast", action="store_true", help="Use the lower resolution fastest mode")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of studies processed concurrently (default: 1)")
+    parser.add_argument("--settle", type=float, default=30.0,
+                        help="Seconds a study's files must stay unchanged before it is queued (default: 30)")
+    parser.add_argument("--poll-interval", type=float, default=5.0,
+                        help="Seconds between scans of the inbox (default: 5)")
+    parser.add_argument("--attempts", type=int, default=2,
+                        help="Runs of a study before it is given up (default: 2)")
+    parser.add_argument("--failed-dir", default=None,
+                        help="Directory failed studies are moved to (default: leave them in the inbox)")
+    parser.add_argument("--state-file", default=None,
+                        help=f"File keeping the queue across restarts (default: {STATE_FILE_NAME} in the inbox)")
+    parser.add_argument("--once", action="store_true",
+                        help="Exit once the studies found in the inbox are processed instead of watching it")
+    parser.add_argument("--log-dir", default="logs", help="Directory for the per-study log files (default: logs)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="CPU threads per study (default: available cores split evenly between workers)")
+    parser.add_argument("--pin-cpus", action="store_true",
+                        help="Pin each worker to its own CPU cores so concurrent studies do not thrash each other")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always run the inference instead of restoring results from the result cache")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Result cache directory (default: $ONKODICOM_RESULT_CACHE_DIR or "
+                             "~/OnkoDICOM/cache/segmentations)")
+    parser.add_argument("--progress-log", default=None,
+                        help="JSON-lines file receiving the progress events of every study "
+                             "(default: progress.jsonl in the log directory)")
+    parser.add_argument("--nifti-output", choices=("files", "background", "skip"), default="background",
+                        help="How the NIfTI segmentations are written, see batch_segmentation.py "
+                             "(default: background)")
+    parser.add_argument("--trace-dir", default=None,
+                        help="Directory receiving the timing spans of every study as JSON and Chrome trace "
+                             f"(default: ${TRACE_DIR_ENV})")
+    parser.add_argument("--profile", choices=("cprofile", "pyinstrument"), default=None,
+                        help=f"Profile every study and write the profile into the trace directory "
+                             f"(default: ${PROFILE_ENV})")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = _build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    log_dir = os.path.abspath(args.log_dir)
+    # The worker processes inherit the environment
+    if args.trace_dir:
+        os.environ[TRACE_DIR_ENV] = os.path.abspath(args.trace_dir)
+    if args.profile:
+        os.environ[PROFILE_ENV] = args.profile
+
+    watcher = WatchFolder(
+        args.inbox, args.outbox, args.task, args.fast, log_dir, args.workers, args.settle, args.poll_interval,
+        args.attempts, args.failed_dir, args.state_file, args.threads, args.pin_cpus,
+        use_cache=not args.no_cache, cache_dir=args.cache_dir,
+        progress_log_path=os.path.abspath(args.progress_log or os.path.join(log_dir, "progress.jsonl")),
+        nifti_output=args.nifti_output,
+    )
+
+    # Finish the running studies on SIGTERM (e.g. a service manager stopping it) or Ctrl+C,
+    # the queued ones are picked up again by the next start
+    def request_stop(signum, frame):
+        logger.info("Stopping once the running studies have finished")
+        watcher.stop()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    return 1 if watcher.run(once=args.once) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())